@@ -1,25 +1,37 @@
-from flask import Flask, request, jsonify, render_template, flash, redirect, url_for, send_from_directory, session
-import mysql.connector
+from flask import Flask, Request, request, jsonify, render_template, flash, redirect, url_for, send_from_directory, session, Response, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session, object_session
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 import os
 import jwt
 from datetime import datetime, timedelta
 from functools import wraps
 import json
-import numpy as np
-import joblib
-import tensorflow as tf
-import pandas as pd
-
-# Import ML modules
-try:
-    from nail_shape_analyzer import NailShapeAnalyzer
-except ImportError as e:
-    print(f"Warning: ML modules not available: {e}")
-    NailShapeAnalyzer = None
+import base64
+import hashlib
+import hmac
+import time
+import threading
+from collections import Counter
+import atexit
+import subprocess
+import sys
+from bisect import bisect_left
+# numpy, pandas, joblib and TensorFlow are imported inside the inference and
+# dataset functions that need them, so pages that never touch a model do not
+# pay their import time or memory
+from caching import TTLCache
+from import_report import loaded_ml_modules
+from model_manifest import load_from_manifest, manifest_path, resolve_loader, write_manifest
+from model_registry import ModelRegistry, ModelSlot, file_version
+from upload_jobs import JobRegistry, DONE, FINISHED_STATES, RUNNING
+from upload_maintenance import UploadMaintenance
+from write_behind import WriteBehindQueue
+from stats_counters import CounterBuffer, read_counters, seed_counters, shape_counter as _shape_counter
+from file_lock import FileLock, INHERITABLE as LOCK_INHERITABLE
+import upload_store
 
 app = Flask(__name__, template_folder='template', static_folder='static')
 
@@ -27,17 +39,196 @@ app = Flask(__name__, template_folder='template', static_folder='static')
 app.config['SECRET_KEY'] = 'your-secret-key-here-change-in-production'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://root:@localhost/glossify'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# One pooled engine serves both the ORM and the raw SQL in get_db_connection()
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_recycle': 280,
-    'pool_timeout': 20,
-    'pool_pre_ping': True
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 280)),
+    'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 20)),
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
 }
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Uploads stream to disk (see upload_store.py); files over UPLOAD_MAX_BYTES or
+# images declaring more than UPLOAD_MAX_PIXELS are refused while they arrive
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_BYTES', 16 * 1024 * 1024))
+app.config['UPLOAD_MAX_PIXELS'] = int(os.environ.get('UPLOAD_MAX_PIXELS', 50_000_000))
+app.config['MAX_CONTENT_LENGTH'] = app.config['UPLOAD_MAX_BYTES'] + 64 * 1024  # room for the multipart framing
+# Uploads are stored as a working copy of at most UPLOAD_WORKING_MAX_SIDE pixels
+# (0 keeps the original instead) plus a thumbnail; originals are only kept when
+# UPLOAD_KEEP_ORIGINALS=1, outside the served static folder
+app.config['UPLOAD_WORKING_FORMAT'] = os.environ.get('UPLOAD_WORKING_FORMAT', 'webp').strip().lower()
+if app.config['UPLOAD_WORKING_FORMAT'] not in upload_store.WORKING_FORMATS:
+    raise RuntimeError(f"UPLOAD_WORKING_FORMAT must be one of {', '.join(sorted(upload_store.WORKING_FORMATS))}, "
+                       f"got {app.config['UPLOAD_WORKING_FORMAT']!r}")
+app.config['UPLOAD_WORKING_MAX_SIDE'] = int(os.environ.get('UPLOAD_WORKING_MAX_SIDE', 1024))
+app.config['UPLOAD_WORKING_QUALITY'] = int(os.environ.get('UPLOAD_WORKING_QUALITY', 82))
+app.config['UPLOAD_THUMB_SIDE'] = int(os.environ.get('UPLOAD_THUMB_SIDE', 256))
+app.config['UPLOAD_KEEP_ORIGINALS'] = os.environ.get('UPLOAD_KEEP_ORIGINALS', '0') == '1'
+app.config['UPLOAD_ORIGINALS_FOLDER'] = os.environ.get(
+    'UPLOAD_ORIGINALS_FOLDER',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'upload_originals'),
+)
+# /api/metrics is open to admin sessions, and to scrapers sending this value in
+# the X-Metrics-Token header; empty leaves it admin-only
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Result cache in front of recommend_from_dataset (live quiz calls repeat a lot)
+app.config['RECOMMEND_CACHE_SIZE'] = int(os.environ.get('RECOMMEND_CACHE_SIZE', 4096))
+app.config['RECOMMEND_CACHE_TTL'] = float(os.environ.get('RECOMMEND_CACHE_TTL', 600))
+# Batch endpoint limits: MAX_PROFILES applies at the default top_n of 3 and
+# shrinks as top_n grows, so profiles * top_n stays bounded
+app.config['RECOMMEND_BATCH_MAX_PROFILES'] = int(os.environ.get('RECOMMEND_BATCH_MAX_PROFILES', 10000))
+app.config['RECOMMEND_BATCH_MAX_TOP_N'] = int(os.environ.get('RECOMMEND_BATCH_MAX_TOP_N', 10))
+# Page size for the per-user history APIs (?limit=, capped at the max)
+app.config['HISTORY_API_DEFAULT_LIMIT'] = int(os.environ.get('HISTORY_API_DEFAULT_LIMIT', 50))
+app.config['HISTORY_API_MAX_LIMIT'] = int(os.environ.get('HISTORY_API_MAX_LIMIT', 500))
+# Seconds the admin dashboard payload is cached; counters are flushed every STATS_FLUSH_SECONDS
+app.config['DASHBOARD_CACHE_TTL'] = float(os.environ.get('DASHBOARD_CACHE_TTL', 15))
+app.config['STATS_FLUSH_SECONDS'] = float(os.environ.get('STATS_FLUSH_SECONDS', 2))
+# Per-user customer history cache; HISTORY_CACHE_SIZE=0 turns it off
+app.config['HISTORY_CACHE_SIZE'] = int(os.environ.get('HISTORY_CACHE_SIZE', 1024))
+app.config['HISTORY_CACHE_TTL'] = float(os.environ.get('HISTORY_CACHE_TTL', 600))
+# Background classification of uploads (async upload mode). Clients poll the
+# status URL; the SSE stream is opt-in because it holds a worker while open
+app.config['UPLOAD_JOB_WORKERS'] = int(os.environ.get('UPLOAD_JOB_WORKERS', 2))
+app.config['UPLOAD_JOB_SSE_ENABLED'] = os.environ.get('UPLOAD_JOB_SSE_ENABLED', '0') == '1'
+app.config['UPLOAD_JOB_SSE_TIMEOUT'] = float(os.environ.get('UPLOAD_JOB_SSE_TIMEOUT', 30))
+# Write-behind persistence of quiz, recommendation and upload rows
+app.config['WRITE_BEHIND_ENABLED'] = os.environ.get('WRITE_BEHIND_ENABLED', '1') == '1'
+app.config['WRITE_BEHIND_FLUSH_MS'] = float(os.environ.get('WRITE_BEHIND_FLUSH_MS', 200))
+app.config['WRITE_BEHIND_BATCH_ROWS'] = int(os.environ.get('WRITE_BEHIND_BATCH_ROWS', 500))
+app.config['WRITE_BEHIND_MAX_ROWS'] = int(os.environ.get('WRITE_BEHIND_MAX_ROWS', 10000))
+app.config['WRITE_BEHIND_SPILL_DIR'] = os.environ.get(
+    'WRITE_BEHIND_SPILL_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'write_behind'),
+)
+app.config['WRITE_BEHIND_SPILL_MAX_MB'] = int(os.environ.get('WRITE_BEHIND_SPILL_MAX_MB', 256))
+# /admin/retrain runs retrain_v3.py as a separate low-priority process and writes
+# each run's artifacts to its own directory under RETRAIN_OUTPUT_DIR
+app.config['RETRAIN_OUTPUT_DIR'] = os.environ.get(
+    'RETRAIN_OUTPUT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'trained_models', 'NailPolish_Model', 'candidates'),
+)
+app.config['RETRAIN_THREADS'] = int(os.environ.get('RETRAIN_THREADS', 1))
+app.config['RETRAIN_NICE'] = int(os.environ.get('RETRAIN_NICE', 10))
+app.config['RETRAIN_EPOCHS'] = int(os.environ.get('RETRAIN_EPOCHS', 150))
+# Background upkeep of UPLOAD_FOLDER (see upload_maintenance.py): stale part files
+# are always removed. Deleting orphans (files without a nailshapeimages row), the
+# budget, TTL, per-user quota and moving flat files into shards are off at 0
+app.config['UPLOAD_MAINTENANCE_INTERVAL'] = float(os.environ.get('UPLOAD_MAINTENANCE_INTERVAL', 3600))
+app.config['UPLOAD_BUDGET_MB'] = int(os.environ.get('UPLOAD_BUDGET_MB', 0))
+app.config['UPLOAD_TTL_DAYS'] = float(os.environ.get('UPLOAD_TTL_DAYS', 0))
+app.config['UPLOAD_USER_QUOTA_MB'] = int(os.environ.get('UPLOAD_USER_QUOTA_MB', 0))
+app.config['UPLOAD_ORPHAN_GRACE_SECONDS'] = float(os.environ.get('UPLOAD_ORPHAN_GRACE_SECONDS', 0))
+app.config['UPLOAD_SHARD_FLAT'] = os.environ.get('UPLOAD_SHARD_FLAT', '0') == '1'
+app.config['UPLOAD_MAINTENANCE_DIR'] = os.environ.get(
+    'UPLOAD_MAINTENANCE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'upload_maintenance'),
+)
+# Seconds between checks of each model's active.json (see model_registry.py); 0 turns hot swap off
+app.config['MODEL_REGISTRY_POLL_SECONDS'] = float(os.environ.get('MODEL_REGISTRY_POLL_SECONDS', 5))
+# Publish each successful retrain straight to the active version instead of waiting for /admin/models
+app.config['RETRAIN_AUTO_ACTIVATE'] = os.environ.get('RETRAIN_AUTO_ACTIVATE', '0') == '1'
+# ML_ENABLED=0 runs a web-only process: TensorFlow, Keras and MediaPipe are never
+# imported, nail shape analysis is unavailable and the v3 polish model is served
+# from its NumPy export only. See import_report.py for the import-time check.
+app.config['ML_ENABLED'] = os.environ.get('ML_ENABLED', '1') == '1'
+# Load and warm every model at startup; /readyz reports ready once this finishes
+app.config['EAGER_WARMUP'] = os.environ.get('EAGER_WARMUP', '1') == '1'
+# Warm-up components that must succeed for /readyz (dataset, polish_model, nail_shape_model)
+app.config['WARMUP_REQUIRED'] = [
+    c.strip() for c in os.environ.get('WARMUP_REQUIRED', 'dataset,polish_model').split(',') if c.strip()
+]
+
+# Import ML modules (nail_shape_analyzer itself defers TensorFlow to first use)
+NailShapeAnalyzer = None
+nail_shape_model_version = None
+nail_shape_warmup = None
+nail_shape_batcher_stats = None
+hands_pool_stats = None
+nail_shape_model_slot = None
+if app.config['ML_ENABLED']:
+    try:
+        from nail_shape_analyzer import NailShapeAnalyzer, batcher_stats as nail_shape_batcher_stats, hands_pool_stats
+        from nail_shape_analyzer import current_model_version as nail_shape_model_version
+        from nail_shape_analyzer import warmup as nail_shape_warmup
+        from nail_shape_analyzer import model_slot as nail_shape_model_slot
+    except ImportError as e:
+        print(f"Warning: ML modules not available: {e}")
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Part files of uploads interrupted by a crash or restart
+upload_store.remove_stale_parts(app.config['UPLOAD_FOLDER'])
+
+
+class UploadRequest(Request):
+    """Request that streams file parts through upload_store.UploadSink once a view opts in.
+
+    Views call ``_receive_upload()``, which sets ``upload_sinks`` before the
+    form is parsed; other requests keep Werkzeug's default spooling.
+    """
+
+    upload_sinks = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.upload_sinks is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if self.upload_sinks:
+            raise upload_store.UploadRejected('Upload one file per request')
+        sink = upload_store.UploadSink(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_MAX_BYTES'],
+                                       app.config['UPLOAD_MAX_PIXELS'], content_length)
+        self.upload_sinks.append(sink)
+        return sink
+
+
+app.request_class = UploadRequest
+
+
+def _receive_upload():
+    """Stream the 'file' part in and store its working copy; returns (filename, content_hash, file_path).
+
+    Raises upload_store.UploadRejected for a missing, oversized or non-image file.
+    """
+    max_length = app.config['MAX_CONTENT_LENGTH']
+    if request.content_length is not None and request.content_length > max_length:
+        # Refuse before reading any of the body
+        raise upload_store.too_large(app.config['UPLOAD_MAX_BYTES'])
+    request.upload_sinks = []
+    if 'file' not in request.files:
+        raise upload_store.UploadRejected('No file provided')
+    file = request.files['file']
+    if file.filename == '':
+        raise upload_store.UploadRejected('No file selected')
+    filename, content_hash = upload_store.store(
+        file.stream,
+        working_format=app.config['UPLOAD_WORKING_FORMAT'],
+        max_side=app.config['UPLOAD_WORKING_MAX_SIDE'],
+        thumb_side=app.config['UPLOAD_THUMB_SIDE'],
+        quality=app.config['UPLOAD_WORKING_QUALITY'],
+        originals_folder=app.config['UPLOAD_ORIGINALS_FOLDER'] if app.config['UPLOAD_KEEP_ORIGINALS'] else None,
+    )
+    return filename, content_hash, os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+
+def _thumbnail_path(filename: str):
+    """Static path of an upload's thumbnail, or None when only the original was stored."""
+    thumb = upload_store.thumbnail_name(filename)
+    return f"uploads/{thumb}" if upload_store.exists(app.config['UPLOAD_FOLDER'], thumb) else None
+
+
+@app.teardown_request
+def _discard_upload_parts(_exc=None):
+    # Parts of rejected or failed uploads never reach their final name
+    for sink in getattr(request, 'upload_sinks', None) or ():
+        sink.discard()
+
+
+UPLOAD_JOBS = JobRegistry(max_workers=app.config['UPLOAD_JOB_WORKERS'])
+
+# In-process front for the image_predictions table, keyed by (content_hash, model_version)
+_PREDICTION_CACHE = TTLCache(maxsize=4096, ttl=0)
+
 # Initialize extensions
 db = SQLAlchemy(app)
 login_manager = LoginManager()
@@ -63,6 +254,12 @@ class User(UserMixin, db.Model):
 
 class NailShapeImage(db.Model):
     __tablename__ = "nailshapeimages"
+    # Serves the per-user, newest-first keyset pagination of /api/nails/my-images;
+    # image_path is looked up when upload_maintenance.py moves a file into its shard
+    __table_args__ = (
+        db.Index('ix_nailshapeimages_user_time', 'user_id', 'uploaded_at', 'id'),
+        db.Index('ix_nailshapeimages_image_path', 'image_path'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -70,12 +267,24 @@ class NailShapeImage(db.Model):
     predicted_shape = db.Column(db.String(50), nullable=True)
     confidence_score = db.Column(db.Float, nullable=True)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)  # SHA-256 of the uploaded bytes
     
     # Relationships
     user = db.relationship("User", back_populates="nail_images")
 
+class ImagePrediction(db.Model):
+    """Nail shape prediction cached by image content hash and model version."""
+    __tablename__ = "image_predictions"
+    
+    content_hash = db.Column(db.String(64), primary_key=True)
+    predicted_shape = db.Column(db.String(50), nullable=True)
+    confidence_score = db.Column(db.Float, nullable=True)
+    model_version = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class QuizResult(db.Model):
     __tablename__ = "quiz_results"
+    __table_args__ = (db.Index('ix_quiz_results_user_time', 'user_id', 'created_at', 'id'),)
     
     id = db.Column(db.Integer, primary_key=True, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -91,6 +300,8 @@ class QuizResult(db.Model):
 
 class Product(db.Model):
     __tablename__ = "products"
+    # One row per shade; the quiz write path upserts against this key
+    __table_args__ = (db.UniqueConstraint('hex_color', 'brand_name', name='uq_products_hex_brand'),)
     
     id = db.Column(db.Integer, primary_key=True, index=True)
     name = db.Column(db.String(100), nullable=False)
@@ -107,6 +318,7 @@ class Product(db.Model):
 
 class Recommendation(db.Model):
     __tablename__ = "recommendations"
+    __table_args__ = (db.Index('ix_recommendations_user_time', 'user_id', 'created_at', 'id'),)
     
     id = db.Column(db.Integer, primary_key=True, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -119,6 +331,28 @@ class Recommendation(db.Model):
     user = db.relationship("User", back_populates="recommendations")
     product = db.relationship("Product", back_populates="recommendations")
 
+class StatCounter(db.Model):
+    """Running totals for the admin dashboard, maintained on insert instead of COUNT(*)."""
+    __tablename__ = "stats_counters"
+
+    name = db.Column(db.String(120), primary_key=True)  # e.g. 'quizzes', 'shape:Almond'
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class ModelTrainingLog(db.Model):
+    """One row per retraining run; retrain_v3.py updates it while it trains."""
+    __tablename__ = "modeltraininglog"
+
+    id = db.Column(db.Integer, primary_key=True)
+    training_date = db.Column(db.Date)
+    training_time = db.Column(db.Time)
+    status = db.Column(db.String(20))  # Running, Success or Failed
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    progress = db.Column(db.Integer, nullable=True)  # percent
+    duration_seconds = db.Column(db.Float, nullable=True)
+    metrics = db.Column(db.Text, nullable=True)  # JSON of validation metrics
+    message = db.Column(db.Text, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
@@ -294,47 +528,184 @@ def admin_dashboard_page():
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'error')
         return redirect(url_for('home'))
+    payload = dashboard_payload()
+    return render_template(
+        'admin_dashboard.html',
+        total_users=payload['total_users'],
+        total_quizzes=payload['total_quizzes'],
+        total_uploads=payload['total_uploads'],
+        training_history=payload['training_history'],
+        last_retrained=payload['last_retrained']
+    )
+
+
+_DASHBOARD_CACHE = TTLCache(maxsize=1, ttl=app.config['DASHBOARD_CACHE_TTL'])
+
+
+def dashboard_stats() -> dict:
+    """Counter totals from stats_counters plus increments not flushed yet."""
+    totals = Counter()
     try:
-        total_users = User.query.count()
-        total_quizzes = QuizResult.query.count()
-    except Exception:
-        total_users = 0
-        total_quizzes = 0
+        with _db_engine().connect() as conn:
+            totals.update(read_counters(conn, StatCounter.__table__))
+    except Exception as e:
+        print(f"Failed to load dashboard counters: {e}")
+    totals.update(STATS.pending())
+    by_prefix = {'shape': {}, 'skin_tone': {}}
+    for name, value in totals.items():
+        prefix, _, label = name.partition(':')
+        if label and prefix in by_prefix:
+            by_prefix[prefix][label] = value
+    return {
+        'users': totals.get('users', 0),
+        'quizzes': totals.get('quizzes', 0),
+        'uploads': totals.get('uploads', 0),
+        'recommendations': totals.get('recommendations', 0),
+        'by_shape': dict(sorted(by_prefix['shape'].items())),
+        'by_skin_tone': dict(sorted(by_prefix['skin_tone'].items())),
+    }
+
 
+def _format_clock(value) -> str:
+    # MySQL TIME columns come back from PyMySQL as timedelta
+    if value is None:
+        return ''
+    if isinstance(value, timedelta):
+        minutes = int(value.total_seconds()) // 60
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+    return value.strftime('%H:%M') if hasattr(value, 'strftime') else str(value)
+
+
+def _training_row(row) -> dict:
+    try:
+        metrics = json.loads(row.metrics) if row.metrics else None
+    except (TypeError, ValueError):
+        metrics = None
+    return {
+        'id': row.id,
+        'date': row.training_date.strftime('%Y-%m-%d') if row.training_date else '',
+        'time': _format_clock(row.training_time),
+        'status': row.status,
+        'created_at': row.created_at.strftime('%Y-%m-%d %H:%M') if row.created_at else '',
+        'progress': row.progress,
+        'duration_seconds': row.duration_seconds,
+        'message': row.message or '',
+        'metrics': metrics,
+    }
+
+
+def _load_training_history(limit: int = 50) -> list:
+    rows = (ModelTrainingLog.query
+            .order_by(ModelTrainingLog.created_at.desc(), ModelTrainingLog.id.desc())
+            .limit(limit).all())
+    return [_training_row(r) for r in rows]
+
+
+def dashboard_payload() -> dict:
+    """Everything the admin dashboard shows, cached for DASHBOARD_CACHE_TTL seconds."""
+    cached = _DASHBOARD_CACHE.get('dashboard')
+    if cached is not None:
+        return cached
+    stats = dashboard_stats()
     # Load model training history from DB so it persists across refresh
-    training_history = []
-    last_retrained = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, training_date, training_time, status, created_at FROM modeltraininglog ORDER BY created_at DESC LIMIT 50"
-        )
-        rows = cur.fetchall()
-        training_history = [
-            {
-                'id': r[0],
-                'date': r[1].strftime('%Y-%m-%d') if r[1] else '',
-                'time': r[2].strftime('%H:%M') if r[2] else '',
-                'status': r[3],
-                'created_at': r[4].strftime('%Y-%m-%d %H:%M') if r[4] else ''
-            }
-            for r in rows
-        ]
-        if training_history:
-            last_retrained = training_history[0]['created_at']
-        cur.close()
-        conn.close()
+        training_history = _load_training_history()
     except Exception as e:
         print(f"Failed to load training history: {e}")
+        training_history = []
+    payload = {
+        'total_users': stats['users'],
+        'total_quizzes': stats['quizzes'],
+        'total_uploads': stats['uploads'],
+        'stats': stats,
+        'training_history': training_history,
+        'last_retrained': training_history[0]['created_at'] if training_history else None,
+    }
+    _DASHBOARD_CACHE.set('dashboard', payload)
+    return payload
+
+
+@app.route('/admin/stats', methods=['GET'])
+@login_required
+def admin_stats():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify(dashboard_payload()['stats'])
 
-    return render_template(
-        'admin_dashboard.html',
-        total_users=total_users,
-        total_quizzes=total_quizzes,
-        training_history=training_history,
-        last_retrained=last_retrained
-    )
+
+_RETRAIN_LOCK_FILE = os.path.join(app.config['RETRAIN_OUTPUT_DIR'], '.retrain.lock')
+_RETRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retrain_v3.py')
+
+
+def _mark_run_failed(log_id: int, message: str) -> None:
+    """Close a run that is still 'Running' after its process went away."""
+    table = ModelTrainingLog.__table__
+    query = table.update().where(table.c.status == 'Running')
+    if log_id is not None:
+        query = query.where(table.c.id == log_id)
+    with _db_engine().begin() as conn:
+        conn.execute(query.values(status='Failed', message=message, finished_at=datetime.now()))
+
+
+def _watch_retrain(proc, log_id: int, lock) -> None:
+    code = proc.wait()
+    lock.release()  # no-op when the child inherited the lock
+    if code != 0:
+        try:
+            _mark_run_failed(log_id, f"Training process exited with code {code}")
+        except Exception as e:
+            print(f"Failed to record retrain failure: {e}")
+    _DASHBOARD_CACHE.clear()
+
+
+def start_retraining():
+    """Log a run and start retrain_v3.py for it; None if a run is already going.
+
+    Training happens in its own process at lower CPU priority, so a web
+    worker never trains. The training process inherits the locked
+    descriptor of the lock file, so no second run starts until it exits,
+    even if this worker restarts meanwhile, and a crash cannot leave the
+    lock behind.
+    """
+    lock = FileLock(_RETRAIN_LOCK_FILE)
+    if not lock.acquire():
+        return None
+    log_id = None
+    try:
+        # We hold the lock, so a run still marked Running lost its process
+        _mark_run_failed(None, 'Training process exited unexpectedly')
+        now = datetime.now()
+        row = ModelTrainingLog(training_date=now.date(), training_time=now.time().replace(microsecond=0),
+                               status='Running', created_at=now, progress=0, message='Starting')
+        db.session.add(row)
+        db.session.commit()
+        log_id = row.id
+        out_dir = os.path.join(app.config['RETRAIN_OUTPUT_DIR'], f"run-{now:%Y%m%d-%H%M%S}-{log_id}")
+        os.makedirs(out_dir, exist_ok=True)
+        env = dict(os.environ, RETRAIN_DATABASE_URI=_db_engine().url.render_as_string(hide_password=False))
+        with open(os.path.join(out_dir, 'train.log'), 'ab') as log_file:
+            proc = subprocess.Popen(
+                [sys.executable, _RETRAIN_SCRIPT, '--log-id', str(log_id), '--out-dir', out_dir,
+                 '--epochs', str(app.config['RETRAIN_EPOCHS']),
+                 '--threads', str(app.config['RETRAIN_THREADS']), '--nice', str(app.config['RETRAIN_NICE']),
+                 '--registry-dir', _V3_SLOT.registry.root]
+                + (['--activate'] if app.config['RETRAIN_AUTO_ACTIVATE'] else [])
+                # Without descriptor passing (Windows) this worker holds the lock until the run exits
+                + (['--lock', _RETRAIN_LOCK_FILE, '--lock-fd', str(lock.fd)] if LOCK_INHERITABLE else []),
+                cwd=os.path.dirname(_RETRAIN_SCRIPT), env=env, stdin=subprocess.DEVNULL,
+                stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True,
+                pass_fds=(lock.fd,) if LOCK_INHERITABLE else (),
+            )
+        if LOCK_INHERITABLE:
+            lock.release()  # the child holds it from here on
+    except Exception as e:
+        db.session.rollback()
+        lock.release()
+        if log_id is not None:
+            _mark_run_failed(log_id, f"Could not start training: {e}")
+        raise
+    threading.Thread(target=_watch_retrain, args=(proc, log_id, lock), name='retrain-watch', daemon=True).start()
+    return row
 
 
 @app.route('/admin/retrain', methods=['POST'])
@@ -343,40 +714,11 @@ def admin_retrain_model():
     if not current_user.is_admin:
         return jsonify({'error': 'Forbidden'}), 403
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        # log into modeltraininglog (training_date, training_time, status, created_at)
-        cur.execute(
-            "INSERT INTO modeltraininglog (training_date, training_time, status, created_at) VALUES (CURDATE(), CURTIME(), %s, NOW())",
-            ("Success",)
-        )
-        conn.commit()
-        cur.execute("SELECT LAST_INSERT_ID()")
-        new_id = cur.fetchone()[0]
-        # Fetch the inserted row details
-        cur.execute(
-            "SELECT training_date, training_time, status, created_at FROM modeltraininglog WHERE id=%s",
-            (new_id,)
-        )
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        date_val = row[0] if row else None
-        time_val = row[1] if row else None
-        created_val = row[3] if row else None
-        def to_str(v, fmt=None):
-            try:
-                return v.strftime(fmt) if fmt and hasattr(v, 'strftime') else (str(v) if v is not None else '')
-            except Exception:
-                return str(v) if v is not None else ''
-        payload = {
-            'id': int(new_id),
-            'date': to_str(date_val, '%Y-%m-%d'),
-            'time': to_str(time_val, '%H:%M'),
-            'status': row[2] if row else 'Triggered',
-            'created_at': to_str(created_val, '%Y-%m-%d %H:%M')
-        }
-        return jsonify({'message': 'Training triggered and logged', 'row': payload})
+        row = start_retraining()
+        if row is None:
+            return jsonify({'error': 'A retraining run is already in progress'}), 409
+        _DASHBOARD_CACHE.clear()
+        return jsonify({'message': 'Training started', 'row': _training_row(row)}), 202
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -387,33 +729,88 @@ def admin_training_history():
     if not current_user.is_admin:
         return jsonify({'error': 'Forbidden'}), 403
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, training_date, training_time, status, created_at FROM modeltraininglog ORDER BY created_at DESC LIMIT 100"
-        )
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        def to_str(v, fmt=None):
-            try:
-                return v.strftime(fmt) if fmt and hasattr(v, 'strftime') else (str(v) if v is not None else '')
-            except Exception:
-                return str(v) if v is not None else ''
-        data = [
-            {
-                'id': int(r[0]),
-                'date': to_str(r[1], '%Y-%m-%d'),
-                'time': to_str(r[2], '%H:%M'),
-                'status': r[3],
-                'created_at': to_str(r[4], '%Y-%m-%d %H:%M')
-            }
-            for r in rows
-        ]
-        return jsonify({'rows': data})
+        return jsonify({'rows': _load_training_history(100)})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _model_slots() -> dict:
+    slots = {'polish': _V3_SLOT}
+    if nail_shape_model_slot is not None:
+        slots['nail_shape'] = nail_shape_model_slot()
+    return slots
+
+
+@app.route('/admin/models', methods=['GET'])
+@login_required
+def admin_models():
+    """Published versions of each model, the active one and the one this worker serves."""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({
+        name: dict(slot.stats(), versions=slot.registry.versions())
+        for name, slot in _model_slots().items()
+    })
+
+
+@app.route('/admin/models/<name>/activate', methods=['POST'])
+@login_required
+def admin_activate_model(name):
+    """Make a published version active (also used to roll back)."""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    slot = _model_slots().get(name)
+    if slot is None:
+        return jsonify({'error': f'Unknown model: {name}'}), 404
+    data = request.get_json(silent=True) or {}
+    version = data.get('version') or request.form.get('version')
+    if not version:
+        return jsonify({'error': 'version is required'}), 400
+    try:
+        pointer = slot.registry.activate(version)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    # Load it off the request path; other workers swap on their next poll
+    slot.refresh_async()
+    return jsonify(dict(pointer, model=name, serving_version=slot.peek_version())), 202
+
+
+@app.route('/admin/uploads/maintenance', methods=['GET'])
+@login_required
+def admin_upload_maintenance():
+    """Last upload maintenance report (and last dry run) with this worker's counters."""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({
+        'stats': UPLOAD_MAINTENANCE.stats(),
+        'last_report': UPLOAD_MAINTENANCE.last_report(),
+        'last_dry_run': UPLOAD_MAINTENANCE.last_report(dry_run=True),
+    })
+
+
+@app.route('/admin/uploads/maintenance', methods=['POST'])
+@login_required
+def admin_run_upload_maintenance():
+    """Start a maintenance pass now; a dry run unless dry_run=0 is sent."""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    data = request.get_json(silent=True) or {}
+    flag = data.get('dry_run', request.form.get('dry_run', request.args.get('dry_run', '1')))
+    dry_run = str(flag).lower() not in ('0', 'false', 'no')
+
+    def run_pass():
+        try:
+            if UPLOAD_MAINTENANCE.run(dry_run=dry_run) is None:
+                print('Upload maintenance: another pass is already running')
+        except Exception as e:
+            print(f"Upload maintenance pass failed: {e}")
+
+    threading.Thread(target=run_pass, name='upload-maintenance-manual', daemon=True).start()
+    return jsonify({'message': 'Maintenance pass started', 'dry_run': dry_run,
+                    'report_url': url_for('admin_upload_maintenance')}), 202
+
+
 @app.route('/admin/manage-product')
 @app.route('/manage_product.html')
 @login_required
@@ -459,49 +856,58 @@ def admin_add_product():
         flash(f'Failed to add product: {str(e)}', 'error')
     return redirect(url_for('manage_product_page'))
 
-@app.route('/admin/customer-history')
-@app.route('/customer_history.html')
-@login_required
-def customer_history_page():
-    if current_user.is_anonymous:
-        return redirect(url_for('login_page'))
+def _first_shades(payload: str, recs: list, limit: int = 3) -> None:
+    """Append up to ``limit`` {'hex', 'brand'} entries from a recommended_shades payload."""
+    try:
+        shades = json.loads(payload or "[]")
+    except (TypeError, json.JSONDecodeError):
+        shades = []
+    for shade in shades:
+        if isinstance(shade, dict):
+            hex_code = shade.get('hex')
+            brand_label = shade.get('brand')
+        else:
+            hex_code = shade
+            brand_label = None
+        if hex_code:
+            recs.append({
+                'hex': hex_code,
+                'brand': brand_label or 'Recommended'
+            })
+        if len(recs) >= limit:
+            break
+
 
-    target_user_id = current_user.id
+def build_customer_history(user_id: int) -> list:
+    """Quiz history, newest first, each quiz with the shades recommended after it.
 
-    quizzes = QuizResult.query.filter_by(user_id=target_user_id)\
+    A recommendation belongs to the latest quiz taken at or before it (and
+    before the next quiz). Loads all of the user's recommendations in one
+    query and assigns them to quizzes by binary search on created_at.
+    """
+    quizzes = QuizResult.query.filter_by(user_id=user_id)\
         .order_by(QuizResult.created_at.asc()).all()
+    if not quizzes:
+        return []
+
+    lowest = min((q.created_at for q in quizzes if q.created_at), default=None)
+    rec_query = db.session.query(Recommendation.created_at, Recommendation.recommended_shades)\
+        .filter(Recommendation.user_id == user_id)
+    if lowest is not None and all(q.created_at for q in quizzes):
+        rec_query = rec_query.filter(Recommendation.created_at >= lowest)
+    rec_rows = [r for r in rec_query.order_by(Recommendation.created_at.asc()).all() if r[0] is not None]
+    rec_times = [r[0] for r in rec_rows]
 
     history_data = []
     for idx, quiz in enumerate(quizzes):
         lower_bound = quiz.created_at or datetime.min
         upper_bound = quizzes[idx + 1].created_at if idx + 1 < len(quizzes) else None
+        start = bisect_left(rec_times, lower_bound)
+        stop = bisect_left(rec_times, upper_bound) if upper_bound else len(rec_rows)
 
-        rec_query = Recommendation.query.filter(Recommendation.user_id == target_user_id)
-        rec_query = rec_query.filter(Recommendation.created_at >= lower_bound)
-        if upper_bound:
-            rec_query = rec_query.filter(Recommendation.created_at < upper_bound)
-
-        rec_rows = rec_query.order_by(Recommendation.created_at.asc()).all()
         recs = []
-        for rec in rec_rows:
-            try:
-                shades = json.loads(rec.recommended_shades or "[]")
-            except (TypeError, json.JSONDecodeError):
-                shades = []
-            for shade in shades:
-                if isinstance(shade, dict):
-                    hex_code = shade.get('hex')
-                    brand_label = shade.get('brand')
-                else:
-                    hex_code = shade
-                    brand_label = None
-                if hex_code:
-                    recs.append({
-                        'hex': hex_code,
-                        'brand': brand_label or 'Recommended'
-                    })
-                if len(recs) >= 3:
-                    break
+        for _created_at, payload in rec_rows[start:stop]:
+            _first_shades(payload, recs)
             if len(recs) >= 3:
                 break
 
@@ -515,7 +921,201 @@ def customer_history_page():
             'recommendations': recs
         })
 
-    history_data = list(reversed(history_data))
+    return list(reversed(history_data))
+
+
+_HISTORY_CACHE = TTLCache(
+    maxsize=max(1, app.config['HISTORY_CACHE_SIZE']),
+    ttl=app.config['HISTORY_CACHE_TTL'],
+)
+# Bumped on every invalidation, so a build that raced with a write is not cached
+_HISTORY_GENERATIONS = {}
+_HISTORY_LOCK = threading.Lock()
+
+
+def get_customer_history(user_id: int) -> list:
+    if app.config['HISTORY_CACHE_SIZE'] <= 0:
+        return build_customer_history(user_id)
+    cached = _HISTORY_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+    with _HISTORY_LOCK:
+        generation = _HISTORY_GENERATIONS.get(user_id, 0)
+    history_data = build_customer_history(user_id)
+    with _HISTORY_LOCK:
+        if _HISTORY_GENERATIONS.get(user_id, 0) == generation:
+            _HISTORY_CACHE.set(user_id, history_data)
+    return history_data
+
+
+def invalidate_customer_history(user_id) -> None:
+    with _HISTORY_LOCK:
+        _HISTORY_GENERATIONS[user_id] = _HISTORY_GENERATIONS.get(user_id, 0) + 1
+        _HISTORY_CACHE.pop(user_id)
+
+
+STATS = CounterBuffer(lambda: _db_engine(), StatCounter.__table__,
+                      flush_seconds=app.config['STATS_FLUSH_SECONDS'])
+atexit.register(STATS.close)
+
+
+def row_counter_deltas(table: str, row: dict) -> dict:
+    """Counter increments for one inserted row of ``table``."""
+    if table == 'users':
+        return {'users': 1}
+    if table == 'quiz_results':
+        deltas = {'quizzes': 1}
+        if row.get('skin_tone'):
+            deltas[f"skin_tone:{row['skin_tone']}"] = 1
+        return deltas
+    if table == 'recommendations':
+        return {'recommendations': 1}
+    if table == 'nailshapeimages':
+        deltas = {'uploads': 1}
+        shape_key = _shape_counter(row.get('predicted_shape'))
+        if shape_key:
+            deltas[shape_key] = 1
+        return deltas
+    return {}
+
+
+def _track_counter_insert(_mapper, _connection, target):
+    sess = object_session(target)
+    if sess is None:
+        return
+    row = {c.key: getattr(target, c.key, None) for c in _mapper.column_attrs}
+    sess.info.setdefault('counter_deltas', Counter()).update(row_counter_deltas(target.__tablename__, row))
+
+
+def _track_shape_update(_mapper, _connection, target):
+    # Uploads are often inserted first and classified afterwards
+    history = sa_inspect(target).attrs.predicted_shape.history
+    if not history.has_changes():
+        return
+    old = history.deleted[0] if history.deleted else None
+    new_key, old_key = _shape_counter(target.predicted_shape), _shape_counter(old)
+    if new_key == old_key:
+        return
+    sess = object_session(target)
+    if sess is not None:
+        deltas = sess.info.setdefault('counter_deltas', Counter())
+        if new_key:
+            deltas[new_key] += 1
+        if old_key:
+            deltas[old_key] -= 1
+
+
+for _model in (User, QuizResult, Recommendation, NailShapeImage):
+    event.listen(_model, 'after_insert', _track_counter_insert)
+event.listen(NailShapeImage, 'after_update', _track_shape_update)
+
+
+# Quiz and recommendation writes invalidate the owner's history once they commit
+def _track_history_write(_mapper, _connection, target):
+    sess = object_session(target)
+    if sess is not None and target.user_id is not None:
+        sess.info.setdefault('history_users', set()).add(target.user_id)
+
+
+for _model in (QuizResult, Recommendation):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event_name, _track_history_write)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_history_after_commit(sess):
+    for user_id in sess.info.pop('history_users', ()):
+        invalidate_customer_history(user_id)
+    product_ids = sess.info.pop('product_ids', None)
+    if product_ids:
+        with _PRODUCT_IDS_LOCK:
+            _PRODUCT_IDS.update(product_ids)
+    counter_deltas = sess.info.pop('counter_deltas', None)
+    if counter_deltas:
+        STATS.add(counter_deltas)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_history_writes(sess):
+    sess.info.pop('history_users', None)
+    sess.info.pop('product_ids', None)
+    sess.info.pop('counter_deltas', None)
+
+
+def _on_rows_flushed(unit) -> None:
+    deltas = Counter()
+    for table, row in unit:
+        if table in ('quiz_results', 'recommendations'):
+            invalidate_customer_history(row['user_id'])
+        deltas.update(row_counter_deltas(table, row))
+    STATS.add(deltas)
+
+
+def _on_rows_rejected(unit) -> None:
+    # A vanished guest user makes every queued guest row fail its foreign key
+    for user_id in {row.get('user_id') for _table, row in unit}:
+        forget_guest_user_if_missing(user_id)
+
+
+_WRITE_TABLES = {
+    model.__tablename__: model.__table__ for model in (QuizResult, Recommendation, NailShapeImage)
+}
+WRITE_BEHIND = None
+if app.config['WRITE_BEHIND_ENABLED']:
+    WRITE_BEHIND = WriteBehindQueue(
+        lambda: _db_engine(),
+        _WRITE_TABLES,
+        flush_ms=app.config['WRITE_BEHIND_FLUSH_MS'],
+        batch_rows=app.config['WRITE_BEHIND_BATCH_ROWS'],
+        max_rows=app.config['WRITE_BEHIND_MAX_ROWS'],
+        spill_dir=app.config['WRITE_BEHIND_SPILL_DIR'],
+        spill_max_bytes=app.config['WRITE_BEHIND_SPILL_MAX_MB'] * 1024 * 1024,
+        on_flushed=_on_rows_flushed,
+        on_rejected=_on_rows_rejected,
+    )
+    atexit.register(WRITE_BEHIND.close)
+
+
+UPLOAD_MAINTENANCE = UploadMaintenance(
+    lambda: _db_engine(),
+    app.config['UPLOAD_FOLDER'],
+    originals_folder=app.config['UPLOAD_ORIGINALS_FOLDER'] if app.config['UPLOAD_KEEP_ORIGINALS'] else None,
+    budget_bytes=app.config['UPLOAD_BUDGET_MB'] * 1024 * 1024,
+    ttl_days=app.config['UPLOAD_TTL_DAYS'],
+    user_quota_bytes=app.config['UPLOAD_USER_QUOTA_MB'] * 1024 * 1024,
+    orphan_grace_seconds=app.config['UPLOAD_ORPHAN_GRACE_SECONDS'],
+    shard_flat=app.config['UPLOAD_SHARD_FLAT'],
+    state_dir=app.config['UPLOAD_MAINTENANCE_DIR'],
+    interval_seconds=app.config['UPLOAD_MAINTENANCE_INTERVAL'],
+    pending_paths=(lambda: WRITE_BEHIND.pending_paths('nailshapeimages', 'image_path'))
+    if WRITE_BEHIND is not None else None,
+)
+UPLOAD_MAINTENANCE.start()
+atexit.register(UPLOAD_MAINTENANCE.close)
+
+
+def persist_rows(unit) -> None:
+    """Insert rows the response does not depend on: queued when write-behind is on, else now.
+
+    ``unit`` is a list of (table name, column dict) written in one transaction.
+    """
+    if WRITE_BEHIND is not None:
+        WRITE_BEHIND.submit(unit)
+        return
+    with _db_engine().begin() as conn:
+        for table, row in unit:
+            conn.execute(_WRITE_TABLES[table].insert(), [row])
+    _on_rows_flushed(unit)
+
+
+@app.route('/admin/customer-history')
+@app.route('/customer_history.html')
+@login_required
+def customer_history_page():
+    if current_user.is_anonymous:
+        return redirect(url_for('login_page'))
+
+    history_data = get_customer_history(current_user.id)
 
     return render_template('customer_history.html', history=history_data, profile=current_user)
 
@@ -666,26 +1266,6 @@ def quiz_submission():
             'occasion': occasion
         }
         
-        # Persist quiz result to database (quiz_results table)
-        try:
-            if hasattr(current_user, 'is_authenticated') and current_user.is_authenticated:
-                user_id_val = int(current_user.id)
-            else:
-                user_id_val = get_or_create_guest_user_id()
-            quiz_row = QuizResult(
-                user_id=user_id_val,
-                age=int(age),
-                skin_tone=skin_tone,
-                finish_type=finish_type,
-                outfit_color=outfit_color,
-                occasion=occasion
-            )
-            db.session.add(quiz_row)
-            db.session.commit()
-        except Exception as e:
-            # Do not block UX if DB save fails; log to console
-            print(f"Quiz save failed: {e}")
-        
         # Dataset-based recommendations
         user_input = {
             'age': int(age),
@@ -699,47 +1279,42 @@ def quiz_submission():
         session['dataset_hex'] = [r['hex'] for r in dataset_recs]
         session['dataset_brands'] = [r['brand'] for r in dataset_recs]
 
-        # Persist recommendations to database (recommendations table)
+        # Persist the quiz result and its recommendations in one transaction: off the
+        # request path, unless new products must be inserted first (then all of it now)
+        user_id_val = None
         try:
-            if hasattr(current_user, 'is_authenticated') and current_user.is_authenticated:
-                rec_user_id = int(current_user.id)
-            else:
-                rec_user_id = get_or_create_guest_user_id()
-
+            user_id_val = _current_or_guest_user_id()
+            now = datetime.utcnow()
+            unit = [('quiz_results', {
+                'user_id': user_id_val,
+                'age': int(age),
+                'skin_tone': skin_tone,
+                'finish_type': finish_type,
+                'outfit_color': outfit_color,
+                'occasion': occasion,
+                'created_at': now,
+            })]
             if dataset_recs:
-                # Ensure we have at least one linked product id to satisfy schema constraints
-                first_product_id = None
-                for rec in dataset_recs:
-                    hex_code = rec.get('hex')
-                    brand_label = rec.get('brand') or 'Glossify'
-                    if not hex_code:
-                        continue
-                    product = Product.query.filter_by(hex_color=hex_code, brand_name=brand_label).first()
-                    if not product:
-                        product = Product(
-                            name=f"{brand_label} {hex_code}",
-                            brand_name=brand_label,
-                            hex_color=hex_code,
-                            finish_type=finish_type or 'Unknown'
-                        )
-                        db.session.add(product)
-                        db.session.flush()
-                    if first_product_id is None:
-                        first_product_id = product.id
-
-                recommended_payload = json.dumps(dataset_recs)
-                rec_row = Recommendation(
-                    user_id=rec_user_id,
-                    product_id=first_product_id,
-                    recommendation_score=0.90,
-                    recommended_shades=recommended_payload
-                )
-                db.session.add(rec_row)
-
-            db.session.commit()
+                product_ids = product_ids_for(dataset_recs, finish_type)
+                unit.append(('recommendations', {
+                    'user_id': user_id_val,
+                    'product_id': _first_product_id(dataset_recs, product_ids),
+                    'recommendation_score': 0.90,
+                    'recommended_shades': json.dumps(dataset_recs),
+                    'created_at': now,
+                }))
+            if db.session.info.get('product_ids'):
+                for table, row in unit:
+                    db.session.execute(_WRITE_TABLES[table].insert(), [row])
+                db.session.commit()
+                _on_rows_flushed(unit)
+            else:
+                persist_rows(unit)
         except Exception as e:
+            # Do not block UX if DB save fails; log to console
             db.session.rollback()
-            print(f"Recommendation save failed: {e}")
+            print(f"Quiz save failed: {e}")
+            forget_guest_user_if_missing(user_id_val)
         
         return redirect(url_for('results_page'))
         
@@ -751,26 +1326,28 @@ def quiz_submission():
 def upload_nail_image():
     """Handle nail image upload, predict shape, store in MySQL, and redirect to results."""
     try:
-        if 'file' not in request.files:
-            flash('No file provided', 'error')
+        # Hashed and validated while it streams to its content-addressed file
+        try:
+            filename, content_hash, file_path = _receive_upload()
+        except upload_store.UploadRejected as e:
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
+                return jsonify({'error': str(e)}), e.status
+            flash(str(e), 'error')
             return redirect(url_for('upload_page'))
-        
-        file = request.files['file']
-        if file.filename == '':
-            flash('No file selected', 'error')
-            return answer(url_for('upload_page'))
 
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        if _wants_async_upload():
+            user_id_val = _current_or_guest_user_id()
+            image_path = f"uploads/{filename}"
+            image_id = _insert_pending_nail_image(user_id_val, image_path, content_hash)
+            job_id = UPLOAD_JOBS.submit(_classify_upload_job, image_id, file_path, image_path, content_hash,
+                                        job_id=_upload_job_id(image_id))
+            return jsonify(_job_links(job_id, image_path=image_path, thumbnail_path=_thumbnail_path(filename))), 202
 
         # Predict nail shape using the trained model
         prediction_error = None
+        model_version = None
         try:
-            analyzer = NailShapeAnalyzer()
-            shape, _confidence = analyzer.predict_shape(file_path)
+            shape, _confidence, model_version = predict_upload(file_path, content_hash)
             predicted_shape = (shape or 'Unknown').title()
         except Exception as e:
             prediction_error = str(e)
@@ -778,22 +1355,19 @@ def upload_nail_image():
             print(f"Shape prediction failed: {e}")
 
         # Store record in MySQL table nailshapeimages (matching your schema)
+        user_id_val = None
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            if hasattr(current_user, 'is_authenticated') and current_user.is_authenticated:
-                user_id_val = int(current_user.id)
-            else:
-                user_id_val = get_or_create_guest_user_id()
-            cur.execute(
-                "INSERT INTO nailshapeimages (user_id, image_path, predicted_shape, uploaded_at) VALUES (%s, %s, %s, NOW())",
-                (user_id_val, f"uploads/{filename}", predicted_shape)
-            )
-            conn.commit()
-            cur.close()
-            conn.close()
+            user_id_val = _current_or_guest_user_id()
+            persist_rows([('nailshapeimages', {
+                'user_id': user_id_val,
+                'image_path': f"uploads/{filename}",
+                'predicted_shape': predicted_shape,
+                'content_hash': content_hash,
+                'uploaded_at': datetime.utcnow(),
+            })])
         except Exception as e:
             print(f"MySQL insert failed: {e}")
+            forget_guest_user_if_missing(user_id_val)
 
         # If this is an AJAX request, return JSON for inline display
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
@@ -803,12 +1377,16 @@ def upload_nail_image():
                 return jsonify({
                     'predicted_shape': 'Not a human hand',
                     'recommendations': [],
-                    'image_path': f"uploads/{filename}"
+                    'image_path': f"uploads/{filename}",
+                    'thumbnail_path': _thumbnail_path(filename),
+                    'model_version': model_version
                 })
             return jsonify({
                 'predicted_shape': predicted_shape,
                 'recommendations': generate_nail_shape_recommendations(predicted_shape),
-                'image_path': f"uploads/{filename}"
+                'image_path': f"uploads/{filename}",
+                'thumbnail_path': _thumbnail_path(filename),
+                'model_version': model_version
             })
 
         return redirect(url_for('results_page', shape=predicted_shape))
@@ -818,6 +1396,236 @@ def upload_nail_image():
         flash(f'Upload error: {str(e)}', 'error')
         return redirect(url_for('upload_page'))
 
+def _wants_async_upload() -> bool:
+    """Async mode is requested with ?async=1, an 'async' form field or X-Upload-Mode: async."""
+    flag = request.args.get('async') or request.form.get('async') or request.headers.get('X-Upload-Mode')
+    return str(flag or '').lower() in ('1', 'true', 'yes', 'async')
+
+
+def _insert_pending_nail_image(user_id: int, image_path: str, content_hash: str = None):
+    """Insert the nailshapeimages row up front so the job can fill in the prediction."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "INSERT INTO nailshapeimages (user_id, image_path, predicted_shape, content_hash, uploaded_at) VALUES (%s, %s, %s, %s, NOW())",
+            (user_id, image_path, 'Pending', content_hash)
+        )
+        conn.commit()
+        STATS.add({'uploads': 1})
+        return cur.lastrowid
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _update_nail_image_prediction(image_id, predicted_shape, confidence) -> None:
+    with app.app_context():
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "UPDATE nailshapeimages SET predicted_shape=%s, confidence_score=%s WHERE id=%s",
+                (predicted_shape, confidence, image_id)
+            )
+            conn.commit()
+            # Rows from _insert_pending_nail_image start as 'Pending' and were not tallied
+            shape_key = _shape_counter(predicted_shape)
+            if shape_key and cur.rowcount:
+                STATS.add({shape_key: 1})
+        finally:
+            cur.close()
+            conn.close()
+
+
+def _lookup_prediction(content_hash: str, model_version: str):
+    """Return a cached (shape, confidence) for this image content and model, or None."""
+    key = (content_hash, model_version)
+    cached = _PREDICTION_CACHE.get(key)
+    if cached is not None:
+        return cached
+    try:
+        row = db.session.get(ImagePrediction, content_hash)
+    except Exception as e:
+        print(f"Prediction cache lookup failed: {e}")
+        return None
+    if row is None or row.model_version != model_version:
+        return None
+    cached = (row.predicted_shape, row.confidence_score)
+    _PREDICTION_CACHE.set(key, cached)
+    return cached
+
+
+def _store_prediction(content_hash: str, shape, confidence, model_version: str) -> None:
+    _PREDICTION_CACHE.set((content_hash, model_version), (shape, confidence))
+    try:
+        db.session.merge(ImagePrediction(
+            content_hash=content_hash,
+            predicted_shape=shape,
+            confidence_score=confidence,
+            model_version=model_version
+        ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Prediction cache store failed: {e}")
+
+
+def predict_upload(file_path: str, content_hash: str):
+    """Predict the nail shape of a stored upload, skipping inference for content seen before.
+
+    Returns (shape, confidence, model version that produced the prediction).
+    """
+    if NailShapeAnalyzer is None:
+        raise RuntimeError('ML analysis not available')
+    version = nail_shape_model_version()
+    cached = _lookup_prediction(content_hash, version)
+    if cached is not None:
+        return cached[0], cached[1], version
+    analyzer = NailShapeAnalyzer()
+    shape, confidence = analyzer.predict_shape(file_path)
+    _store_prediction(content_hash, shape, confidence, analyzer.model_version)
+    return shape, confidence, analyzer.model_version
+
+
+def _classify_upload_job(image_id, file_path: str, image_path: str, content_hash: str,
+                         title_case: bool = True) -> dict:
+    """Background job: predict the shape of an uploaded image and update its row."""
+    try:
+        with app.app_context():
+            shape, confidence, model_version = predict_upload(file_path, content_hash)
+    except Exception:
+        if image_id is not None:
+            _update_nail_image_prediction(image_id, 'Unknown', None)
+        raise
+    predicted_shape = (shape or 'Unknown').title() if title_case else shape
+    if image_id is not None:
+        _update_nail_image_prediction(image_id, predicted_shape, confidence)
+
+    is_hand = (predicted_shape or '').lower() != 'not a human hand'
+    return {
+        'image_id': image_id,
+        'image_path': image_path,
+        'predicted_shape': predicted_shape,
+        'confidence_score': confidence,
+        'model_version': model_version,
+        'recommendations': generate_nail_shape_recommendations(predicted_shape) if is_hand else [],
+    }
+
+
+def _upload_job_id(image_id) -> str:
+    """Job id '<image id>-<signature>', so any worker can map it back to its row."""
+    signature = hmac.new(app.config['SECRET_KEY'].encode(), f"upload-job:{image_id}".encode(), hashlib.sha256)
+    return f"{image_id}-{signature.hexdigest()[:32]}"
+
+
+def _upload_job_image_id(job_id: str):
+    image_id, _, _signature = job_id.partition('-')
+    if not image_id.isdigit() or not hmac.compare_digest(_upload_job_id(int(image_id)), job_id):
+        return None
+    return int(image_id)
+
+
+def _job_from_row(job_id: str):
+    """Job status rebuilt from the nailshapeimages row, for jobs this process does not know.
+
+    Used after a restart or when the status request lands on another worker.
+    """
+    image_id = _upload_job_image_id(job_id)
+    if image_id is None:
+        return None
+    image = db.session.get(NailShapeImage, image_id)
+    if image is None:
+        return None
+    created = image.uploaded_at.timestamp() if image.uploaded_at else time.time()
+    job = {'id': job_id, 'status': RUNNING, 'result': None, 'error': None,
+           'created_at': created, 'updated_at': created, 'version': 0}
+    if image.predicted_shape and image.predicted_shape.lower() != 'pending':
+        is_hand = image.predicted_shape.lower() != 'not a human hand'
+        job.update(status=DONE, result={
+            'image_id': image.id,
+            'image_path': image.image_path,
+            'predicted_shape': image.predicted_shape,
+            'confidence_score': image.confidence_score,
+            'model_version': None,  # not stored on the row
+            'recommendations': generate_nail_shape_recommendations(image.predicted_shape) if is_hand else [],
+        })
+    return job
+
+
+def _find_upload_job(job_id: str):
+    return UPLOAD_JOBS.get(job_id) or _job_from_row(job_id)
+
+
+def _job_links(job_id: str, **extra) -> dict:
+    payload = {
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('api_upload_job_status', job_id=job_id),
+    }
+    if app.config['UPLOAD_JOB_SSE_ENABLED']:
+        payload['events_url'] = url_for('api_upload_job_events', job_id=job_id)
+    payload.update(extra)
+    return payload
+
+
+def _job_payload(job: dict) -> dict:
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'result': job['result'],
+        'error': job['error'],
+        'created_at': datetime.fromtimestamp(job['created_at']).isoformat(),
+        'updated_at': datetime.fromtimestamp(job['updated_at']).isoformat(),
+    }
+
+
+@app.route('/api/nails/jobs/<job_id>', methods=['GET'])
+def api_upload_job_status(job_id):
+    """Poll the status of an async upload classification."""
+    job = _find_upload_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_job_payload(job))
+
+
+@app.route('/api/nails/jobs/<job_id>/events', methods=['GET'])
+def api_upload_job_events(job_id):
+    """Server-sent events stream that pushes each status change until the job finishes.
+
+    Optional (UPLOAD_JOB_SSE_ENABLED); the status URL works without it. A job
+    this process did not run gets one event from its row, then polling takes over.
+    """
+    if not app.config['UPLOAD_JOB_SSE_ENABLED']:
+        return jsonify({'error': 'Event stream disabled; poll the status URL'}), 404
+    if UPLOAD_JOBS.get(job_id) is None:
+        job = _job_from_row(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return Response(f"event: status\ndata: {json.dumps(_job_payload(job))}\n\n",
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    stream_timeout = app.config['UPLOAD_JOB_SSE_TIMEOUT']
+
+    def stream():
+        seen = -1
+        deadline = time.monotonic() + stream_timeout
+        while time.monotonic() < deadline:
+            job = UPLOAD_JOBS.wait(job_id, seen, timeout=15)
+            if job is None:
+                yield 'event: error\ndata: {"error": "Job not found"}\n\n'
+                return
+            if job['version'] == seen:
+                yield ': keepalive\n\n'
+                continue
+            seen = job['version']
+            yield f"event: status\ndata: {json.dumps(_job_payload(job))}\n\n"
+            if job['status'] in FINISHED_STATES:
+                return
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 def generate_nail_shape_recommendations(shape):
     """Generate recommendations based on nail shape"""
     recommendations = {
@@ -861,22 +1669,60 @@ def generate_nail_shape_recommendations(shape):
 
 
 # --- MySQL Integration ---
-DB_CONFIG = {
-    "host": "localhost",
-    "user": "root",
-    "password": "",
-    "database": "glossify",
-}
+def _db_engine():
+    if has_app_context():
+        return db.engine
+    with app.app_context():
+        return db.engine
 
 
 def get_db_connection():
-    """Return a new MySQL connection using mysql.connector."""
-    return mysql.connector.connect(**DB_CONFIG)
+    """Borrow a DB-API connection from the SQLAlchemy pool.
+
+    Same cursor()/commit() interface as before; close() hands the connection
+    back to the pool (rolling back anything uncommitted) instead of closing it.
+    """
+    return _db_engine().raw_connection()
+
+
+def db_pool_stats() -> dict:
+    pool = _db_engine().pool
+    if not hasattr(pool, 'checkedout'):
+        return {'class': type(pool).__name__}
+    size = pool.size()
+    max_overflow = app.config['SQLALCHEMY_ENGINE_OPTIONS']['max_overflow']
+    checked_out = pool.checkedout()
+    capacity = size + max(0, max_overflow)
+    return {
+        'class': type(pool).__name__,
+        'size': size,
+        'max_overflow': max_overflow,
+        'checked_in': pool.checkedin(),
+        'checked_out': checked_out,
+        'overflow': pool.overflow(),
+        'utilization': round(checked_out / capacity, 3) if capacity else None,
+    }
+
+
+# The guest row never changes once created, so each process resolves it once
+_GUEST_USER_ID = None
+_GUEST_USER_LOCK = threading.Lock()
 
 
 def get_or_create_guest_user_id() -> int:
     """Return a valid user_id for uploads when no user is logged in.
-    Creates a 'guest' user if it does not exist."""
+    Creates a 'guest' user if it does not exist; the id is cached per process."""
+    global _GUEST_USER_ID
+    guest_id = _GUEST_USER_ID
+    if guest_id is not None:
+        return guest_id
+    with _GUEST_USER_LOCK:
+        if _GUEST_USER_ID is None:
+            _GUEST_USER_ID = _select_or_create_guest_user()
+        return _GUEST_USER_ID
+
+
+def _select_or_create_guest_user() -> int:
     conn = get_db_connection()
     cur = conn.cursor()
     try:
@@ -887,11 +1733,22 @@ def get_or_create_guest_user_id() -> int:
         # create guest
         from datetime import datetime as _dt
         email = f"guest+{_dt.utcnow().strftime('%Y%m%d%H%M%S')}@example.com"
-        cur.execute(
-            "INSERT INTO users (username, email, password_hash, is_admin, created_at, updated_at) VALUES (%s,%s,%s,%s,NOW(),NOW())",
-            ("guest", email, "", 0),
-        )
-        conn.commit()
+        try:
+            cur.execute(
+                "INSERT INTO users (username, email, password_hash, is_admin, created_at, updated_at) VALUES (%s,%s,%s,%s,NOW(),NOW())",
+                ("guest", email, "", 0),
+            )
+            conn.commit()
+            # Raw inserts bypass the ORM counter listeners
+            STATS.add({'users': 1})
+        except Exception:
+            # Another process created it first (username is unique); use theirs
+            conn.rollback()
+            cur.execute("SELECT id FROM users WHERE username=%s LIMIT 1", ("guest",))
+            row = cur.fetchone()
+            if not row:
+                raise
+            return int(row[0])
         cur.execute("SELECT LAST_INSERT_ID()")
         new_id = cur.fetchone()[0]
         return int(new_id)
@@ -899,19 +1756,129 @@ def get_or_create_guest_user_id() -> int:
         cur.close()
         conn.close()
 
-# --- ML Helpers for Polish Recommendation ---
-# V3 artifact cache (loaded once)
-_V3_MODEL = None
-_V3_SCALER = None
-_V3_KMEANS = None
-_V3_LABEL_ENCODER = None
-_V3_PREPROCESSOR = None
-_DATASET_DF = None
 
+def forget_guest_user_if_missing(user_id) -> None:
+    """After a failed write, drop the cached guest id if its row no longer exists."""
+    global _GUEST_USER_ID
+    if user_id is None or user_id != _GUEST_USER_ID:
+        return
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT 1 FROM users WHERE id=%s", (user_id,))
+            missing = cur.fetchone() is None
+        finally:
+            cur.close()
+            conn.close()
+    except Exception as e:
+        print(f"Guest user check failed: {e}")
+        return
+    if missing:
+        with _GUEST_USER_LOCK:
+            if _GUEST_USER_ID == user_id:
+                _GUEST_USER_ID = None
+
+
+def _current_or_guest_user_id() -> int:
+    if hasattr(current_user, 'is_authenticated') and current_user.is_authenticated:
+        return int(current_user.id)
+    return get_or_create_guest_user_id()
+
+# (hex_color, brand_name) -> products.id; filled only from committed transactions
+_PRODUCT_IDS = {}
+_PRODUCT_IDS_LOCK = threading.Lock()
+
+
+def _insert_products(keys: list, finish_type: str) -> None:
+    """Insert (hex, brand) keys not found in products, in one statement.
+
+    The conflict clause only covers a concurrent request inserting the same
+    key between our SELECT and this INSERT.
+    """
+    rows = [
+        {'name': f"{brand} {hex_code}", 'brand_name': brand, 'hex_color': hex_code,
+         'finish_type': finish_type or 'Unknown', 'created_at': datetime.utcnow()}
+        for hex_code, brand in keys
+    ]
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        stmt = dialect_insert(Product.__table__).values(rows)
+        stmt = stmt.on_duplicate_key_update(id=Product.__table__.c.id)
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(Product.__table__).values(rows).on_conflict_do_nothing()
+    else:
+        stmt = Product.__table__.insert().values(rows)
+    db.session.execute(stmt)
+
+
+def _select_product_ids(keys: list) -> dict:
+    from sqlalchemy import tuple_
+    rows = db.session.query(Product.hex_color, Product.brand_name, Product.id)\
+        .filter(tuple_(Product.hex_color, Product.brand_name).in_(keys)).all()
+    return {(r[0], r[1]): int(r[2]) for r in rows}
 
-def _v3_paths():
+
+def product_ids_for(recs: list, finish_type: str) -> dict:
+    """Map each recommended (hex, brand) to a products.id within the current session.
+
+    Known keys come from memory; the rest are looked up with one SELECT and
+    only keys still missing are inserted (then read back). Ids of products
+    inserted here reach the shared map only after the session commits.
+    """
+    keys = []
+    for rec in recs:
+        if rec.get('hex'):
+            key = (rec['hex'], rec.get('brand') or 'Glossify')
+            if key not in keys:
+                keys.append(key)
+    with _PRODUCT_IDS_LOCK:
+        ids = {key: _PRODUCT_IDS[key] for key in keys if key in _PRODUCT_IDS}
+    unknown = [key for key in keys if key not in ids]
+    if not unknown:
+        return ids
+    found = _select_product_ids(unknown)
+    if found:
+        with _PRODUCT_IDS_LOCK:
+            _PRODUCT_IDS.update(found)  # already committed rows
+        ids.update(found)
+    missing = [key for key in unknown if key not in found]
+    if missing:
+        _insert_products(missing, finish_type)
+        inserted = _select_product_ids(missing)
+        db.session.info.setdefault('product_ids', {}).update(inserted)
+        ids.update(inserted)
+    return ids
+
+
+def _first_product_id(recs: list, ids: dict):
+    """Product of the first usable shade; recommendations need at least one linked product."""
+    for rec in recs:
+        if rec.get('hex'):
+            return ids.get((rec['hex'], rec.get('brand') or 'Glossify'))
+    return None
+
+
+# --- ML Helpers for Polish Recommendation ---
+_DATASET_DF = None
+_DATASET_INDEX = None
+# Guard one-time dataset loads against concurrent first requests
+_DATASET_LOCK = threading.Lock()
+_RECOMMEND_CACHE = TTLCache(
+    maxsize=app.config['RECOMMEND_CACHE_SIZE'],
+    ttl=app.config['RECOMMEND_CACHE_TTL'],
+)
+# Bumped on every dataset (re)load, so a lookup that raced with a reload is not cached
+_DATASET_GENERATION = 0
+_RECOMMEND_LOCK = threading.Lock()
+
+
+def _v3_paths(model_dir: str = None):
     """Resolve v3 artifact paths, tolerating singular/plural folder names and case differences.
-    Also detect a SavedModel export directory if present.
+    Also detect a SavedModel export directory if present. ``model_dir`` pins the
+    folder (a registry version) instead of searching for the flat one.
     """
     base_dir = os.path.dirname(os.path.abspath(__file__))
     override_dir = os.environ.get('NAILPOLISH_MODEL_DIR')
@@ -929,7 +1896,7 @@ def _v3_paths():
                 return d
         return candidate_dirs[0]
 
-    model_dir = find_dir()
+    model_dir = model_dir or find_dir()
 
     def find_file_ci(directory: str, names: list) -> str:
         try:
@@ -955,6 +1922,7 @@ def _v3_paths():
 
     return {
         'model': find_file_ci(model_dir, ['nail_polish_model_v3.h5']),
+        'numpy_model': find_file_ci(model_dir, ['nail_polish_model_v3.npz']),
         'scaler': find_file_ci(model_dir, ['scaler_v3.pkl']),
         'kmeans': find_file_ci(model_dir, ['Kmeans_v3.pkl', 'kmeans_v3.pkl']),
         'label_encoder': find_file_ci(model_dir, ['label_encoder_v3.pkl']),
@@ -964,61 +1932,127 @@ def _v3_paths():
     }
 
 
+class _V3Bundle:
+    """The network and preprocessors of one v3 version, swapped as a unit."""
+
+    def __init__(self, model, preprocessor, scaler, kmeans, label_encoder) -> None:
+        self.model = model
+        self.preprocessor = preprocessor
+        self.scaler = scaler
+        self.kmeans = kmeans
+        self.label_encoder = label_encoder
+
+
 def load_v3_artifacts():
-    global _V3_MODEL, _V3_SCALER, _V3_KMEANS, _V3_LABEL_ENCODER, _V3_PREPROCESSOR
-    if _V3_MODEL is not None:
-        return
-    paths = _v3_paths()
+    """Load the serving v3 version (first call only) and return it."""
+    return _V3_SLOT.get().model
+
+
+def polish_model_version() -> str:
+    """Version of the v3 model that serves (or would serve) the next prediction."""
+    return _V3_SLOT.peek_version()
+
+
+def _v3_keras_loaders():
+    """Ordered Keras loaders for the v3 h5, most tolerant of version differences first."""
+    if not app.config['ML_ENABLED']:
+        raise RuntimeError('ML_ENABLED=0: the v3 model needs its NumPy export (polish_numpy_model.py)')
+    import tensorflow as tf
+    return [
+        ('tf_compile_safe', lambda p: tf.keras.models.load_model(p, compile=False, safe_mode=False)),
+        ('tf_compile_only', lambda p: tf.keras.models.load_model(p, compile=False)),
+        ('tf_custom_input', lambda p: tf.keras.models.load_model(
+            p, compile=False, custom_objects={'InputLayer': tf.keras.layers.InputLayer})),
+        ('tf_plain', lambda p: tf.keras.models.load_model(p)),
+        ('tf_compat_v1', lambda p: tf.compat.v1.keras.models.load_model(p, compile=False)),
+    ]
+
+
+def _load_v3_bundle(model_dir: str, version: str) -> _V3Bundle:
+    import joblib
+    from polish_numpy_model import NumpyDenseModel
+    paths = _v3_paths(model_dir)
+    # The NumPy export (polish_numpy_model.py) runs without TensorFlow; prefer it
+    # unless NAILPOLISH_BACKEND=keras asks for the original model. Its manifest
+    # ties the .npz to the checksum of the h5 it came from, so a retrained h5
+    # makes a stale export fall back to Keras instead of serving old weights.
+    use_numpy = (
+        os.environ.get('NAILPOLISH_BACKEND', 'numpy').lower() != 'keras'
+        and os.path.exists(paths['numpy_model'])
+    )
+    model = None
+    if use_numpy and os.path.exists(manifest_path(paths['model'])):
+        model = load_from_manifest(paths['model'], {'numpy': NumpyDenseModel})
+        if model is None:
+            print(f"Stale or unreadable manifest for {paths['model']}; loading with Keras")
+            use_numpy = False
     missing = []
-    for key in ['model', 'preprocessor', 'scaler', 'label_encoder']:
+    for key in ['preprocessor', 'scaler', 'label_encoder'] + ([] if use_numpy else ['model']):
         if not os.path.exists(paths[key]):
             missing.append((key, paths[key]))
     if missing:
         details = '; '.join([f"{k}:{p}" for (k, p) in missing])
         raise FileNotFoundError(f"Missing required v3 artifacts in {paths.get('dir')}: {details}")
 
-    # Prefer SavedModel if present (more tolerant across TF versions)
-    if paths.get('saved_model_dir') and os.path.isdir(paths['saved_model_dir']):
-        _V3_MODEL = tf.keras.models.load_model(paths['saved_model_dir'])
-    else:
-        # Tolerant model loading to handle Keras version differences
-        def _load_model_tolerant(model_path: str):
-            last_err = None
-            for attempt in (
-                ('tf_compile_safe', dict(compile=False, safe_mode=False)),
-                ('tf_compile_only', dict(compile=False)),
-                ('tf_custom_input', dict(compile=False, custom_objects={'InputLayer': tf.keras.layers.InputLayer})),
-                ('tf_plain', dict()),
-            ):
+    if model is None and use_numpy:
+        model = NumpyDenseModel(paths['numpy_model'])
+    if model is None:
+        # Prefer SavedModel if present (more tolerant across TF versions)
+        if paths.get('saved_model_dir') and os.path.isdir(paths['saved_model_dir']) \
+                and app.config['ML_ENABLED']:
+            import tensorflow as tf
+            model = tf.keras.models.load_model(paths['saved_model_dir'])
+        else:
+            # Tolerant model loading to handle Keras version differences. The loader
+            # that worked is recorded in a keras manifest tied to the h5 checksum,
+            # so later startups skip the cascade until the h5 changes.
+            keras_loaders = _v3_keras_loaders()
+            model = load_from_manifest(paths['model'], dict(keras_loaders), variant='keras')
+            if model is None:
                 try:
-                    return tf.keras.models.load_model(model_path, **attempt[1])
-                except Exception as e:  # try next
-                    last_err = e
-                    continue
-            # Try compat.v1
-            try:
-                return tf.compat.v1.keras.models.load_model(model_path, compile=False)
-            except Exception as e:
-                raise RuntimeError(f"Failed to load v3 model: {last_err or ''} / {e}")
-
-        _V3_MODEL = _load_model_tolerant(paths['model'])
-    _V3_PREPROCESSOR = joblib.load(paths['preprocessor'])
+                    loader_name, model, _errors = resolve_loader(paths['model'], keras_loaders)
+                except RuntimeError as e:
+                    raise RuntimeError(f"Failed to load v3 model: {e}")
+                print(f"Loaded v3 model with {loader_name}")
+                try:
+                    write_manifest(paths['model'], paths['model'], loader_name, 'h5', variant='keras')
+                except OSError as e:
+                    print(f"Could not write the v3 keras manifest: {e}")
+    preprocessor = joblib.load(paths['preprocessor'])
     try:
-        _V3_SCALER = joblib.load(paths['scaler'])
+        scaler = joblib.load(paths['scaler'])
     except Exception:
-        _V3_SCALER = None
+        scaler = None
     try:
-        _V3_KMEANS = joblib.load(paths['kmeans']) if os.path.exists(paths['kmeans']) else None
+        kmeans = joblib.load(paths['kmeans']) if os.path.exists(paths['kmeans']) else None
     except Exception:
-        _V3_KMEANS = None
-    _V3_LABEL_ENCODER = joblib.load(paths['label_encoder'])
+        kmeans = None
+    label_encoder = joblib.load(paths['label_encoder'])
+    return _V3Bundle(model, preprocessor, scaler, kmeans, label_encoder)
+
+
+# Serving v3 version; swapped when the registry's active.json moves
+_V3_SLOT = ModelSlot(
+    ModelRegistry(_v3_paths()['dir']),
+    _load_v3_bundle,
+    lambda: file_version(_v3_paths()['model']),
+    poll_seconds=app.config['MODEL_REGISTRY_POLL_SECONDS'],
+    name='polish-model',
+)
 
 
 def predict_hex_codes_v3(user_input: dict) -> list:
     """Preprocess and predict top 3 HEX codes using v3 model + preprocessors."""
-    load_v3_artifacts()
+    return predict_hex_codes_v3_batch([user_input])[0]
+
+
+def predict_hex_codes_v3_batch(user_inputs: list, top_k: int = 3) -> list:
+    """Top-k v3 labels for many inputs with one preprocessing pass and one forward pass."""
+    # Take the bundle once: a swap mid-call must not mix two versions
+    bundle = load_v3_artifacts()
+    if not user_inputs:
+        return []
     # Expected keys: skin_tone, age, finish_type, dress_color, occasion, brand_name
-    # Build a single-row input for preprocessor
     import pandas as pd
     df = pd.DataFrame([{
         'skin_tone': user_input.get('skin_tone', ''),
@@ -1027,19 +2061,22 @@ def predict_hex_codes_v3(user_input: dict) -> list:
         'dress_color': user_input.get('dress_color', ''),
         'occasion': user_input.get('occasion', ''),
         'brand_name': user_input.get('brand_name', ''),
-    }])
+    } for user_input in user_inputs])
 
     # Apply preprocessing pipeline
-    X_processed = _V3_PREPROCESSOR.transform(df)
+    X_processed = bundle.preprocessor.transform(df)
     # Optional scaling
     try:
-        X_scaled = _V3_SCALER.transform(X_processed)
+        X_scaled = bundle.scaler.transform(X_processed)
     except Exception:
         X_scaled = X_processed
+    # The one-hot preprocessor emits a sparse matrix; densify so the cluster id can be appended
+    if hasattr(X_scaled, 'toarray'):
+        X_scaled = X_scaled.toarray()
 
     # Optional kmeans (e.g., cluster id as additional feature)
     try:
-        cluster = _V3_KMEANS.predict(X_scaled)
+        cluster = bundle.kmeans.predict(X_scaled)
         # Concatenate cluster as a feature if model expects it
         import numpy as np
         X_final = np.hstack([X_scaled, cluster.reshape(-1, 1)])
@@ -1047,73 +2084,98 @@ def predict_hex_codes_v3(user_input: dict) -> list:
         X_final = X_scaled
 
     # Predict probabilities over HEX labels (assuming label-encoded hex classes)
-    probs = _V3_MODEL.predict(X_final, verbose=0)[0]
-    # Pick top-3 class indices
+    probs = bundle.model.predict(X_final, verbose=0)
+    # Pick top-k class indices per row
     import numpy as np
-    top_indices = np.argsort(probs)[-3:][::-1]
+    top_indices = np.argsort(probs, axis=1)[:, ::-1][:, :top_k]
     # Map back to HEX codes via label encoder
-    hex_codes = _V3_LABEL_ENCODER.inverse_transform(top_indices)
-    return list(hex_codes)
+    return [list(bundle.label_encoder.inverse_transform(row)) for row in top_indices]
 
 
 # --- Dataset-based recommendation (CSV) ---
 def _load_dataset():
-    global _DATASET_DF
     if _DATASET_DF is not None:
         return _DATASET_DF
+    with _DATASET_LOCK:
+        if _DATASET_DF is not None:
+            return _DATASET_DF
+        return _load_dataset_locked()
+
+
+def _load_dataset_locked():
+    global _DATASET_DF, _DATASET_INDEX, _DATASET_GENERATION
+    import pandas as pd
+    from recommendation_index import DatasetIndex
     base_dir = os.path.dirname(os.path.abspath(__file__))
     csv_path = os.path.join(base_dir, 'data', 'trained_models', 'NailPolish_Model', 'nail_polish_datasets.csv')
-    _DATASET_DF = pd.read_csv(csv_path)
+    df = pd.read_csv(csv_path)
     # Normalize string columns
     for col in ['skin_tone', 'finish_type', 'dress_color', 'occasion', 'brand_name', 'recommended_hex_code']:
-        if col in _DATASET_DF.columns:
-            _DATASET_DF[col] = _DATASET_DF[col].astype(str)
-    if 'age' in _DATASET_DF.columns:
-        _DATASET_DF['age'] = pd.to_numeric(_DATASET_DF['age'], errors='coerce').fillna(0)
+        if col in df.columns:
+            df[col] = df[col].astype(str)
+    if 'age' in df.columns:
+        df['age'] = pd.to_numeric(df['age'], errors='coerce').fillna(0)
+    # Build the lookup index once per load so queries never rescan the frame
+    index = DatasetIndex(df)
+    # Cached answers were computed against the previous dataset
+    with _RECOMMEND_LOCK:
+        _DATASET_INDEX = index
+        _DATASET_DF = df
+        _DATASET_GENERATION += 1
+        _RECOMMEND_CACHE.clear()
     return _DATASET_DF
 
 
-def recommend_from_dataset(user_input: dict, top_n: int = 3) -> list:
-    df = _load_dataset().copy()
-    if df.empty:
-        return []
+def reload_dataset():
+    """Read the CSV again and rebuild the index; readers keep the old one until the swap."""
+    with _DATASET_LOCK:
+        return _load_dataset_locked()
 
+
+def _recommend_cache_key(user_input: dict, top_n: int) -> tuple:
     def norm(val):
         return (val or '').strip().lower()
 
-    filters = [
-        ('skin_tone', 'skin_tone'),
-        ('finish_type', 'finish_type'),
-        ('dress_color', 'dress_color'),
-        ('occasion', 'occasion')
-    ]
-
-    candidates = df
-    for col, key in filters:
-        desired = norm(user_input.get(key))
-        if not desired or col not in candidates.columns:
-            continue
-        filtered = candidates[candidates[col].str.lower() == desired]
-        if not filtered.empty:
-            candidates = filtered
+    return (
+        norm(user_input.get('skin_tone')),
+        norm(user_input.get('finish_type')),
+        norm(user_input.get('dress_color')),
+        norm(user_input.get('occasion')),
+        int(user_input.get('age', 0) or 0),
+        int(top_n),
+    )
 
-    if candidates.empty:
-        candidates = df
 
-    user_age = int(user_input.get('age', 0) or 0)
-    if 'age' in candidates.columns:
-        candidates = candidates.assign(age_diff=(candidates['age'] - user_age).abs())
-        candidates = candidates.sort_values(by='age_diff')
-    else:
-        candidates = candidates.head(top_n)
+def recommend_from_dataset(user_input: dict, top_n: int = 3) -> list:
+    """Top-N dataset rows for the quiz answers via the precomputed index.
 
-    recs = []
-    for _, row in candidates.head(top_n).iterrows():
-        recs.append({
-            'hex': row.get('recommended_hex_code', '#FF69B4'),
-            'brand': row.get('brand_name', 'Unknown')
-        })
-    return recs
+    Filters cascade over skin_tone, finish_type, dress_color and occasion
+    (a filter is skipped when it would leave no rows), then rows are ranked
+    by distance to the user's age.
+    """
+    _load_dataset()
+    with _RECOMMEND_LOCK:
+        index, generation = _DATASET_INDEX, _DATASET_GENERATION
+    key = (generation,) + _recommend_cache_key(user_input, top_n)
+    recs = _RECOMMEND_CACHE.get(key)
+    if recs is None:
+        recs = index.query(user_input, top_n=top_n)
+        # Skip the store if a reload swapped the index mid-query
+        with _RECOMMEND_LOCK:
+            if _DATASET_GENERATION == generation:
+                _RECOMMEND_CACHE.set(key, recs)
+    # Hand out copies so callers cannot mutate the cached entry
+    return [dict(r) for r in recs]
+
+
+def recommend_from_dataset_batch(inputs: list, top_n: int = 3) -> list:
+    """Vectorized recommend_from_dataset over many quiz profiles.
+
+    Returns one recommendation list per input, in the same order, identical
+    to what recommend_from_dataset would return for each profile.
+    """
+    _load_dataset()
+    return _DATASET_INDEX.query_batch(inputs, top_n=top_n)
 
 
 def _get_brand_names_for_hexes(hex_list: list) -> list:
@@ -1166,6 +2228,101 @@ def api_recommend_live():
     except Exception as e:
         return jsonify({'error': str(e)}), 200
 
+
+# String fields of a batch profile; 'outfit_color' is accepted as 'dress_color'
+_BATCH_PROFILE_FIELDS = ('skin_tone', 'finish_type', 'outfit_color', 'dress_color', 'occasion')
+
+
+def _batch_profile(p) -> dict:
+    """Validate one /api/recommend/batch profile; raises ValueError naming the bad field."""
+    if not isinstance(p, dict):
+        raise ValueError('expected an object')
+    for field in _BATCH_PROFILE_FIELDS:
+        if field in p and not isinstance(p[field], str):
+            raise ValueError(f'{field} must be a string')
+    age = p.get('age', 0)
+    if isinstance(age, bool) or not isinstance(age, (int, float, str)):
+        raise ValueError('age must be an integer')
+    try:
+        age = int(age or 0)
+    except ValueError:
+        raise ValueError('age must be an integer') from None
+    return {
+        'skin_tone': p.get('skin_tone', ''),
+        'age': age,
+        'finish_type': p.get('finish_type', ''),
+        'dress_color': p.get('outfit_color') or p.get('dress_color', ''),
+        'occasion': p.get('occasion', ''),
+    }
+
+
+
+@app.route('/api/recommend/batch', methods=['POST'])
+def api_recommend_batch():
+    """Score many quiz profiles in one call.
+
+    Body: {"profiles": [{skin_tone, age, finish_type, outfit_color|dress_color, occasion}, ...], "top_n": 3}
+    """
+    data = request.get_json(silent=True) or {}
+    profiles = data.get('profiles') if isinstance(data, dict) else data
+    if not isinstance(profiles, list):
+        return jsonify({'error': 'Expected a "profiles" list'}), 400
+    try:
+        top_n = int(data.get('top_n', 3)) if isinstance(data, dict) else 3
+    except (TypeError, ValueError):
+        return jsonify({'error': 'top_n must be an integer'}), 400
+    top_n = max(1, min(top_n, app.config['RECOMMEND_BATCH_MAX_TOP_N']))
+    max_profiles = max(1, app.config['RECOMMEND_BATCH_MAX_PROFILES'] * 3 // max(top_n, 3))
+    if len(profiles) > max_profiles:
+        return jsonify({'error': f'Too many profiles (max {max_profiles} at top_n={top_n})'}), 413
+
+    user_inputs = []
+    for i, p in enumerate(profiles):
+        try:
+            user_inputs.append(_batch_profile(p))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid profile at index {i}: {e}'}), 400
+    try:
+        batch = recommend_from_dataset_batch(user_inputs, top_n=top_n)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({
+        'count': len(batch),
+        'results': [
+            {'hex': [r['hex'] for r in recs], 'brands': [r['brand'] for r in recs]}
+            for recs in batch
+        ]
+    })
+
+def _metrics_token_ok() -> bool:
+    expected = app.config['METRICS_TOKEN']
+    given = request.headers.get('X-Metrics-Token', '')
+    return bool(expected) and hmac.compare_digest(given.encode(), expected.encode())
+
+
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    """Runtime counters for caches and background workers (admins or METRICS_TOKEN)."""
+    if not _metrics_token_ok():
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'Authentication required'}), 401
+        if not current_user.is_admin:
+            return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({
+        'recommend_cache': _RECOMMEND_CACHE.stats(),
+        'nail_shape_batcher': nail_shape_batcher_stats() if nail_shape_batcher_stats else None,
+        'hands_pool': hands_pool_stats() if hands_pool_stats else None,
+        'history_cache': _HISTORY_CACHE.stats(),
+        'stats_counters': STATS.stats(),
+        'write_behind': WRITE_BEHIND.stats() if WRITE_BEHIND is not None else {'enabled': False},
+        'db_pool': db_pool_stats(),
+        'ml_modules': {'enabled': app.config['ML_ENABLED'], 'imported': loaded_ml_modules()},
+        'upload_jobs': UPLOAD_JOBS.stats(),
+        'upload_maintenance': UPLOAD_MAINTENANCE.stats(),
+        'models': {name: slot.stats() for name, slot in _model_slots().items()},
+    })
+
 def generate_simple_recommendations(skin_tone, finish_type, occasion):
     """Generate simple recommendations based on quiz data"""
     recommendations = []
@@ -1304,36 +2461,41 @@ def api_submit_quiz(user):
 @app.route('/api/nails/upload', methods=['POST'])
 @token_required
 def api_upload_nail_image(user):
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    try:
+        filename, content_hash, file_path = _receive_upload()
+    except upload_store.UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status
     
-    if file:
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+    if filename:
         
         # Save to database
         nail_image = NailShapeImage(
             user_id=user.id,
             image_path=f"uploads/{filename}",
             predicted_shape=None,
-            confidence_score=None
+            confidence_score=None,
+            content_hash=content_hash
         )
         
         db.session.add(nail_image)
         db.session.commit()
+
+        if _wants_async_upload():
+            job_id = UPLOAD_JOBS.submit(_classify_upload_job, nail_image.id, file_path, nail_image.image_path,
+                                        content_hash, title_case=False, job_id=_upload_job_id(nail_image.id))
+            return jsonify(_job_links(job_id, image={
+                'id': nail_image.id,
+                'image_path': nail_image.image_path,
+                'thumbnail_path': _thumbnail_path(filename),
+                'predicted_shape': None,
+                'confidence_score': None,
+                'uploaded_at': nail_image.uploaded_at.isoformat()
+            })), 202
         
         # Try ML prediction if available
         try:
             if NailShapeAnalyzer:
-                analyzer = NailShapeAnalyzer()
-                shape, confidence = analyzer.predict_shape(file_path)
+                shape, confidence, model_version = predict_upload(file_path, content_hash)
                 
                 # Update database with prediction
                 nail_image.predicted_shape = shape
@@ -1342,9 +2504,11 @@ def api_upload_nail_image(user):
                 
                 return jsonify({
                     'message': 'Image uploaded and analyzed successfully',
+                    'model_version': model_version,
                     'image': {
                         'id': nail_image.id,
                         'image_path': nail_image.image_path,
+                        'thumbnail_path': _thumbnail_path(filename),
                         'predicted_shape': nail_image.predicted_shape,
                         'confidence_score': nail_image.confidence_score,
                         'uploaded_at': nail_image.uploaded_at.isoformat()
@@ -1356,6 +2520,7 @@ def api_upload_nail_image(user):
                     'image': {
                         'id': nail_image.id,
                         'image_path': nail_image.image_path,
+                        'thumbnail_path': _thumbnail_path(filename),
                         'predicted_shape': None,
                         'confidence_score': None,
                         'uploaded_at': nail_image.uploaded_at.isoformat()
@@ -1369,6 +2534,7 @@ def api_upload_nail_image(user):
                 'image': {
                     'id': nail_image.id,
                     'image_path': nail_image.image_path,
+                    'thumbnail_path': _thumbnail_path(filename),
                     'predicted_shape': None,
                     'confidence_score': None,
                     'uploaded_at': nail_image.uploaded_at.isoformat()
@@ -1395,38 +2561,17 @@ def api_generate_recommendations(user):
     
     try:
         dataset_recs = recommend_from_dataset(user_input, top_n=3)
-        first_product_id = None
-        if dataset_recs:
-            for rec in dataset_recs:
-                hex_code = rec.get('hex')
-                brand_label = rec.get('brand') or 'Glossify'
-                if not hex_code:
-                    continue
-                product = Product.query.filter_by(hex_color=hex_code, brand_name=brand_label).first()
-                if not product:
-                    product = Product(
-                        name=f"{brand_label} {hex_code}",
-                        brand_name=brand_label,
-                        hex_color=hex_code,
-                        finish_type=quiz_result.finish_type
-                    )
-                    db.session.add(product)
-                    db.session.flush()
-                if first_product_id is None:
-                    first_product_id = product.id
-
         recommendation_entry = None
         if dataset_recs:
+            product_ids = product_ids_for(dataset_recs, quiz_result.finish_type)
             recommendation_entry = Recommendation(
                 user_id=user.id,
-                product_id=first_product_id,
+                product_id=_first_product_id(dataset_recs, product_ids),
                 recommendation_score=0.90,
                 recommended_shades=json.dumps(dataset_recs)
             )
             db.session.add(recommendation_entry)
             db.session.commit()
-        else:
-            db.session.commit()
 
         return jsonify({
             'message': 'Recommendations generated successfully',
@@ -1441,74 +2586,341 @@ def api_generate_recommendations(user):
         }), 201
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': f'Error generating recommendations: {str(e)}'}), 500
 
+def _encode_cursor(created_at, row_id) -> str:
+    raw = f"{created_at.isoformat() if created_at else ''}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        stamp, row_id = raw.rsplit('|', 1)
+        return (datetime.fromisoformat(stamp) if stamp else None), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+
+def _page_params(allowed_fields: tuple):
+    """Parse ?limit=, ?cursor= and ?fields= for a history API; raises ValueError on bad input."""
+    limit_arg = request.args.get('limit')
+    if limit_arg is None:
+        limit = app.config['HISTORY_API_DEFAULT_LIMIT']
+    else:
+        try:
+            limit = int(limit_arg)
+        except ValueError:
+            raise ValueError('limit must be an integer') from None
+        if limit < 1:
+            raise ValueError('limit must be at least 1')
+    limit = min(limit, app.config['HISTORY_API_MAX_LIMIT'])
+    cursor = request.args.get('cursor')
+    after = _decode_cursor(cursor) if cursor else None
+    fields_arg = request.args.get('fields')
+    if fields_arg:
+        fields = [f.strip() for f in fields_arg.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in allowed_fields]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}; allowed: {', '.join(allowed_fields)}")
+    else:
+        fields = list(allowed_fields)
+    return limit, after, fields
+
+
+def user_rows_page(model, time_column: str, user_id: int, allowed_fields: tuple, decoders: dict = None):
+    """One newest-first page of a user's rows, loading only the requested columns.
+
+    Keyset pagination on (time_column, id): the cursor names the last row of
+    the previous page, so every page is an index range scan no matter how deep.
+    Returns (rows as dicts, next cursor or None).
+    """
+    limit, after, fields = _page_params(allowed_fields)
+    time_col = getattr(model, time_column)
+    columns = [model.id, time_col] + [getattr(model, f) for f in fields if f not in ('id', time_column)]
+    query = db.session.query(*columns).filter(model.user_id == user_id)
+    if after is not None:
+        after_time, after_id = after
+        if after_time is None:
+            query = query.filter(time_col.is_(None), model.id < after_id)
+        else:
+            query = query.filter(db.or_(
+                time_col < after_time,
+                db.and_(time_col == after_time, model.id < after_id),
+                time_col.is_(None),
+            ))
+    rows = query.order_by(time_col.desc(), model.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    decoders = decoders or {}
+    names = ['id', time_column] + [f for f in fields if f not in ('id', time_column)]
+    items = []
+    for row in rows:
+        values = dict(zip(names, row))
+        item = {}
+        for f in fields:
+            value = values[f]
+            if f in decoders:
+                value = decoders[f](value)
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            item[f] = value
+        items.append(item)
+    next_cursor = _encode_cursor(rows[-1][1], rows[-1][0]) if has_more and rows else None
+    return items, next_cursor
+
+
+def _paged_response(key: str, model, time_column: str, user, allowed_fields: tuple, decoders: dict = None):
+    try:
+        items, next_cursor = user_rows_page(model, time_column, user.id, allowed_fields, decoders)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({key: items, 'next_cursor': next_cursor, 'has_more': next_cursor is not None})
+
+
 @app.route('/api/recommend/my-recommendations', methods=['GET'])
 @token_required
 def api_get_user_recommendations(user):
-    recommendations = Recommendation.query.filter_by(user_id=user.id).order_by(Recommendation.created_at.desc()).all()
-    
-    return jsonify({
-        'recommendations': [
-            {
-                'id': rec.id,
-                'recommended_shades': json.loads(rec.recommended_shades or "[]"),
-                'recommendation_score': rec.recommendation_score,
-                'created_at': rec.created_at.isoformat()
-            }
-            for rec in recommendations
-        ]
-    })
+    return _paged_response(
+        'recommendations', Recommendation, 'created_at', user,
+        ('id', 'recommended_shades', 'recommendation_score', 'created_at'),
+        decoders={'recommended_shades': lambda v: json.loads(v or "[]")},
+    )
 
 @app.route('/api/nails/my-images', methods=['GET'])
 @token_required
 def api_get_user_images(user):
-    images = NailShapeImage.query.filter_by(user_id=user.id).order_by(NailShapeImage.uploaded_at.desc()).all()
-    
-    return jsonify({
-        'images': [
-            {
-                'id': img.id,
-                'image_path': img.image_path,
-                'predicted_shape': img.predicted_shape,
-                'confidence_score': img.confidence_score,
-                'uploaded_at': img.uploaded_at.isoformat()
-            }
-            for img in images
-        ]
-    })
+    return _paged_response(
+        'images', NailShapeImage, 'uploaded_at', user,
+        ('id', 'image_path', 'predicted_shape', 'confidence_score', 'uploaded_at'),
+    )
 
 @app.route('/api/quiz/my-results', methods=['GET'])
 @token_required
 def api_get_user_quiz_results(user):
-    results = QuizResult.query.filter_by(user_id=user.id).order_by(QuizResult.created_at.desc()).all()
-    
-    return jsonify({
-        'quiz_results': [
-            {
-                'id': result.id,
-                'age': result.age,
-                'skin_tone': result.skin_tone,
-                'finish_type': result.finish_type,
-                'outfit_color': result.outfit_color,
-                'occasion': result.occasion,
-                'created_at': result.created_at.isoformat()
-            }
-            for result in results
-        ]
-    })
+    return _paged_response(
+        'quiz_results', QuizResult, 'created_at', user,
+        ('id', 'age', 'skin_tone', 'finish_type', 'outfit_color', 'occasion', 'created_at'),
+    )
+
+# --- Startup warm-up and health checks ---
+_READINESS = {
+    'ready': False,
+    'state': 'pending',
+    'started_at': None,
+    'finished_at': None,
+    'components': {},
+}
+_WARMUP_LOCK = threading.Lock()
+_WARMUP_THREAD = None
+
+_WARMUP_PROFILE = {
+    'skin_tone': 'Fair', 'age': 25, 'finish_type': 'Glossy',
+    'dress_color': 'Red', 'occasion': 'Party', 'brand_name': '',
+}
+
+
+def _warm_dataset():
+    _load_dataset()
+    _DATASET_INDEX.query(_WARMUP_PROFILE, top_n=3)
+
+
+def _warm_polish_model():
+    predict_hex_codes_v3(_WARMUP_PROFILE)
+
+
+def _warm_nail_shape_model():
+    if not app.config['ML_ENABLED']:
+        raise RuntimeError('disabled by ML_ENABLED=0')
+    if nail_shape_warmup is None:
+        raise RuntimeError('ML modules not available')
+    nail_shape_warmup()
+
+
+def warm_up_models():
+    """Load every model and preprocessor and run one dummy inference through each.
+
+    Records per-component status in _READINESS; the instance reports ready
+    once warm-up has finished and every WARMUP_REQUIRED component succeeded.
+    """
+    _READINESS.update(state='warming', started_at=datetime.utcnow().isoformat())
+    for name, step in (
+        ('dataset', _warm_dataset),
+        ('polish_model', _warm_polish_model),
+        ('nail_shape_model', _warm_nail_shape_model),
+    ):
+        started = time.perf_counter()
+        try:
+            step()
+            status = {'status': 'ok'}
+        except Exception as e:
+            status = {'status': 'error', 'error': str(e)}
+            print(f"Warm-up of {name} failed: {e}")
+        status['seconds'] = round(time.perf_counter() - started, 3)
+        _READINESS['components'][name] = status
+
+    failed = [
+        name for name in app.config['WARMUP_REQUIRED']
+        if _READINESS['components'].get(name, {}).get('status') != 'ok'
+    ]
+    _READINESS.update(
+        ready=not failed,
+        state='ready' if not failed else 'failed',
+        finished_at=datetime.utcnow().isoformat(),
+    )
+
+
+def start_warmup():
+    """Run warm_up_models once in a background thread (no-op if already started)."""
+    global _WARMUP_THREAD
+    with _WARMUP_LOCK:
+        if _WARMUP_THREAD is not None:
+            return _WARMUP_THREAD
+        if not app.config['EAGER_WARMUP']:
+            _READINESS.update(ready=True, state='skipped')
+            _WARMUP_THREAD = threading.current_thread()
+            return _WARMUP_THREAD
+        _WARMUP_THREAD = threading.Thread(target=warm_up_models, name='model-warmup', daemon=True)
+        _WARMUP_THREAD.start()
+        return _WARMUP_THREAD
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving requests."""
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: 200 only after model warm-up finished successfully, 503 before."""
+    payload = dict(_READINESS, components=dict(_READINESS['components']))
+    return jsonify(payload), (200 if _READINESS['ready'] else 503)
 
 # Serve images from static/images
 @app.route('/images/<path:filename>')
 def serve_images(filename):
     return send_from_directory('static/images', filename)
 
+# Columns added after the first release; create_all() does not alter existing tables
+_ADDED_COLUMNS = [
+    ('nailshapeimages', 'content_hash', 'VARCHAR(64) NULL'),
+    ('modeltraininglog', 'progress', 'INT NULL'),
+    ('modeltraininglog', 'duration_seconds', 'FLOAT NULL'),
+    ('modeltraininglog', 'metrics', 'TEXT NULL'),
+    ('modeltraininglog', 'message', 'TEXT NULL'),
+    ('modeltraininglog', 'finished_at', 'DATETIME NULL'),
+]
+
+
+def _ensure_columns():
+    """Add any missing columns from _ADDED_COLUMNS to tables created by older versions."""
+    from sqlalchemy import inspect, text
+    inspector = inspect(db.engine)
+    for table, column, ddl in _ADDED_COLUMNS:
+        try:
+            existing = {c['name'] for c in inspector.get_columns(table)}
+        except Exception:
+            continue
+        if column not in existing:
+            with db.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                if column.endswith('_hash'):
+                    conn.execute(text(f"CREATE INDEX ix_{table}_{column} ON {table} ({column})"))
+            print(f"Added column {table}.{column}")
+
+
+# Indexes added after the first release: (table, index name, columns, unique)
+_ADDED_INDEXES = [
+    ('products', 'uq_products_hex_brand', ('hex_color', 'brand_name'), True),
+    ('quiz_results', 'ix_quiz_results_user_time', ('user_id', 'created_at', 'id'), False),
+    ('recommendations', 'ix_recommendations_user_time', ('user_id', 'created_at', 'id'), False),
+    ('nailshapeimages', 'ix_nailshapeimages_user_time', ('user_id', 'uploaded_at', 'id'), False),
+    ('nailshapeimages', 'ix_nailshapeimages_image_path', ('image_path',), False),
+]
+
+
+def _dedupe_products(conn):
+    """Merge products rows sharing (hex_color, brand_name) into the lowest id.
+
+    Recommendations pointing at a duplicate are moved to the kept row first.
+    """
+    from sqlalchemy import text
+    dupes = conn.execute(text(
+        "SELECT p.id, k.keep_id FROM products p JOIN ("
+        " SELECT hex_color, brand_name, MIN(id) AS keep_id FROM products"
+        " GROUP BY hex_color, brand_name HAVING COUNT(*) > 1"
+        ") k ON p.hex_color = k.hex_color AND p.brand_name = k.brand_name AND p.id <> k.keep_id"
+    )).fetchall()
+    for dupe_id, keep_id in dupes:
+        conn.execute(text("UPDATE recommendations SET product_id = :keep WHERE product_id = :dupe"),
+                     {'keep': keep_id, 'dupe': dupe_id})
+        conn.execute(text("DELETE FROM products WHERE id = :dupe"), {'dupe': dupe_id})
+    if dupes:
+        print(f"Merged {len(dupes)} duplicate products rows")
+
+
+# Run before creating the unique index they would otherwise block
+_INDEX_DEDUPERS = {'uq_products_hex_brand': _dedupe_products}
+
+
+def _ensure_indexes():
+    """Create missing indexes, merging duplicate rows that would block a unique one.
+
+    A unique index that still cannot be created stops startup: the product
+    upserts rely on it to stay de-duplicated.
+    """
+    from sqlalchemy import inspect, text
+    inspector = inspect(db.engine)
+    for table, name, columns, unique in _ADDED_INDEXES:
+        try:
+            existing = {c['name'] for c in inspector.get_unique_constraints(table)}
+            existing |= {i['name'] for i in inspector.get_indexes(table)}
+        except Exception:
+            continue
+        if name in existing:
+            continue
+        try:
+            with db.engine.begin() as conn:
+                if name in _INDEX_DEDUPERS:
+                    _INDEX_DEDUPERS[name](conn)
+                conn.execute(text(f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} ({', '.join(columns)})"))
+            print(f"Added index {table}.{name}")
+        except Exception as e:
+            if unique:
+                raise RuntimeError(f"Could not add unique index {table}.{name}: {e}") from e
+            print(f"Could not add index {table}.{name}: {e}")
+
+def _seed_stats_counters():
+    """Build stats_counters from the existing rows unless that was already done (one-time COUNT(*) scan)."""
+    # Flushed increments belong to committed rows, which the counts below include
+    STATS.flush()
+    seeded = seed_counters(db.engine, StatCounter.__table__)
+    if seeded is not None:
+        print(f"Seeded {seeded} stats counters")
+
+
+def _seed_stats_counters_in_background():
+    # Runs under WSGI too, where init_database() is never called
+    def run():
+        with app.app_context():
+            try:
+                _seed_stats_counters()
+            except Exception as e:
+                print(f"Could not seed stats counters: {e}")
+    threading.Thread(target=run, name='stats-seed', daemon=True).start()
+
 def init_database():
     """Initialize database with sample data"""
     with app.app_context():
         try:
             # Create tables
             db.create_all()
+            _ensure_columns()
+            _ensure_indexes()
+            _seed_stats_counters()
             
             # Check if admin user exists
             admin_user = User.query.filter_by(username="admin").first()
@@ -1526,10 +2938,15 @@ def init_database():
             else:
                 print("Database already initialized")
                 
+        except RuntimeError:
+            raise  # a schema problem the app must not run with (see _ensure_indexes)
         except Exception as e:
             print(f"Error initializing database: {e}")
             print("Make sure MySQL is running and the 'glossify' database exists in phpMyAdmin")
 
+start_warmup()
+_seed_stats_counters_in_background()
+
 if __name__ == '__main__':
     init_database()
     app.run(debug=True, host='0.0.0.0', port=5000)
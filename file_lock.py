@@ -0,0 +1,66 @@
+"""Advisory file locks held on an open descriptor.
+
+The lock belongs to the open file, not to a pid written into it: the
+kernel drops it when the last descriptor closes, including when the
+process is killed, so a crash or container restart never leaves a stale
+lock behind. A child process started with the descriptor in ``pass_fds``
+shares the lock and keeps holding it after the parent closes its copy.
+
+Uses ``fcntl.flock`` on POSIX and ``msvcrt.locking`` on Windows (where
+descriptors cannot be handed to a child).
+"""
+import os
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Descriptors can be handed to a child through Popen(pass_fds=...)
+INHERITABLE = fcntl is not None
+
+
+class FileLock:
+    """Non-blocking exclusive lock on ``path``; also exclusive between threads of one process."""
+
+    def __init__(self, path: str, fd: Optional[int] = None) -> None:
+        self.path = path
+        self.fd = fd  # an inherited, already locked descriptor
+
+    @property
+    def held(self) -> bool:
+        return self.fd is not None
+
+    def acquire(self) -> bool:
+        """Take the lock; False if another open file (any process) holds it."""
+        if self.fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+        # The pid is only informational; the lock is the descriptor
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode('ascii'))
+        self.fd = fd
+        return True
+
+    def release(self) -> None:
+        """Close this descriptor. A child that inherited the lock keeps holding it."""
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *exc) -> None:
+        self.release()
@@ -0,0 +1,98 @@
+"""Import-time report for the web app.
+
+Runs ``python -X importtime -c "import app"`` in a fresh interpreter and
+summarizes where startup time goes. With ``--web-only`` the child runs with
+``ML_ENABLED=0`` and the report fails (exit code 1) if any module from
+``ML_MODULES`` was imported, which is the check for front-end web workers::
+
+    python import_report.py --web-only
+"""
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# Top-level packages a web-only process must never import
+ML_MODULES = ('tensorflow', 'keras', 'tf_keras', 'mediapipe', 'tflite_runtime', 'jax', 'torch')
+
+
+def loaded_ml_modules(modules=None) -> List[str]:
+    """Which of ML_MODULES are imported in this process (or in ``modules``)."""
+    names = sys.modules if modules is None else modules
+    return sorted(m for m in ML_MODULES if m in names)
+
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """Map module name -> (self us, cumulative us) from -X importtime output."""
+    timings: Dict[str, Tuple[int, int]] = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue  # header line
+        timings[parts[2].strip()] = (self_us, cumulative_us)
+    return timings
+
+
+def run_report(web_only: bool = False, module: str = 'app', top: int = 15) -> dict:
+    """Import ``module`` in a child interpreter and return the timing report."""
+    env = dict(os.environ)
+    # Keep the measurement to the import itself: no background warm-up
+    env.setdefault('EAGER_WARMUP', '0')
+    if web_only:
+        env['ML_ENABLED'] = '0'
+    probe = (
+        "import json, sys, time\n"
+        "t = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(json.dumps({'seconds': time.perf_counter() - t, 'modules': sorted(sys.modules)}))\n"
+    )
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', probe],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+    import json  # local import
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    timings = parse_importtime(proc.stderr)
+    # Only top-level packages: nested entries are already in their parent's cumulative time
+    top_level = {name: t for name, t in timings.items() if '.' not in name and name != module}
+    slowest = sorted(top_level.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    return {
+        'module': module,
+        'web_only': web_only,
+        'import_seconds': round(result['seconds'], 3),
+        'modules_loaded': len(result['modules']),
+        'ml_modules_loaded': loaded_ml_modules(result['modules']),
+        'slowest': [
+            {'module': name, 'cumulative_ms': round(cum / 1000.0, 1), 'self_ms': round(own / 1000.0, 1)}
+            for name, (own, cum) in slowest
+        ],
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Report import time of the web app')
+    parser.add_argument('--web-only', action='store_true',
+                        help='Import with ML_ENABLED=0 and fail if any ML framework gets imported')
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    report = run_report(web_only=args.web_only, module=args.module, top=args.top)
+    print(f"import {report['module']}: {report['import_seconds']:.3f}s, "
+          f"{report['modules_loaded']} modules (ML_ENABLED={'0' if report['web_only'] else '1'})")
+    for row in report['slowest']:
+        print(f"  {row['cumulative_ms']:>9.1f} ms  {row['module']}")
+    print(f"ML modules imported: {', '.join(report['ml_modules_loaded']) or 'none'}")
+    if args.web_only and report['ml_modules_loaded']:
+        sys.exit(1)
@@ -0,0 +1,122 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Collects concurrent single-sample predictions into one batched forward pass.
+
+    Callers block in ``predict`` while a worker thread drains the queue: it
+    waits for the first request, then keeps collecting until it has
+    ``max_batch_size`` samples or ``max_wait_ms`` has passed, runs
+    ``predict_fn`` once on the stacked batch and hands each row back.
+    """
+
+    def __init__(self, predict_fn: Callable[[np.ndarray], np.ndarray],
+                 max_batch_size: int = 8, max_wait_ms: float = 5.0,
+                 name: str = 'micro-batcher') -> None:
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue: "queue.Queue[Tuple[np.ndarray, Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._batch_sizes: Dict[int, int] = {}
+        self._requests = 0
+        self._batches = 0
+        self._samples = 0
+        self._errors = 0
+        self._max_queue_depth = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def predict(self, sample: np.ndarray, timeout: float = None) -> np.ndarray:
+        """Queue one sample (without batch axis) and wait for its prediction row."""
+        fut: Future = Future()
+        with self._lock:
+            # Under the lock close() takes, so nothing is queued behind its shutdown marker
+            if self._closed:
+                raise RuntimeError('MicroBatcher is closed')
+            self._queue.put((sample, fut))
+            depth = self._queue.qsize()
+            self._requests += 1
+            if depth > self._max_queue_depth:
+                self._max_queue_depth = depth
+        return fut.result(timeout=timeout)
+
+    def _collect(self) -> List[Tuple[np.ndarray, Future]]:
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Re-post the shutdown marker so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if not batch:
+                self._fail_leftovers()
+                return
+            futures = [fut for _sample, fut in batch]
+            try:
+                preds = self.predict_fn(np.stack([sample for sample, _fut in batch]))
+                preds = preds[0] if isinstance(preds, (list, tuple)) else preds
+                for i, fut in enumerate(futures):
+                    fut.set_result(preds[i])
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                for fut in futures:
+                    if not fut.done():
+                        fut.set_exception(e)
+            with self._lock:
+                self._batches += 1
+                self._samples += len(batch)
+                self._batch_sizes[len(batch)] = self._batch_sizes.get(len(batch), 0) + 1
+
+    def _fail_leftovers(self) -> None:
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and not item[1].done():
+                item[1].set_exception(RuntimeError('MicroBatcher is closed'))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self._max_queue_depth,
+                'requests': self._requests,
+                'batches': self._batches,
+                'errors': self._errors,
+                'mean_batch_size': round(self._samples / self._batches, 3) if self._batches else 0.0,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self._batch_sizes.items())},
+            }
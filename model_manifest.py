@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# A loader takes an artifact path and returns a model (or raises)
+Loader = Callable[[str], object]
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path(source_path: str, variant: str = '') -> str:
+    """Manifest sits next to the source artifact: model.h5 -> model.manifest.json.
+
+    A ``variant`` keeps a second manifest for the same source apart,
+    e.g. model.keras.manifest.json.
+    """
+    root, _ext = os.path.splitext(source_path)
+    return root + (f'.{variant}' if variant else '') + '.manifest.json'
+
+
+def write_manifest(source_path: str, artifact_path: str, loader: str, fmt: str, variant: str = '',
+                   **extra) -> dict:
+    """Record how to load ``source_path`` fast: which artifact, which loader, which checksums."""
+    manifest = {
+        'source': os.path.basename(source_path),
+        'source_sha256': file_sha256(source_path),
+        'artifact': os.path.relpath(artifact_path, os.path.dirname(source_path)),
+        'artifact_sha256': file_sha256(artifact_path) if os.path.isfile(artifact_path) else None,
+        'loader': loader,
+        'format': fmt,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    manifest.update(extra)
+    path = manifest_path(source_path, variant)
+    # Unique per writer: two threads resolving the same model may both write it
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def read_manifest(source_path: str, variant: str = '') -> Optional[dict]:
+    """Return the manifest if it still matches the source and artifact on disk, else None."""
+    path = manifest_path(source_path, variant)
+    if not os.path.exists(path) or not os.path.exists(source_path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    artifact = os.path.join(os.path.dirname(source_path), manifest.get('artifact', ''))
+    if not os.path.exists(artifact):
+        return None
+    # A retrained or replaced source makes the compiled artifact stale
+    if manifest.get('source_sha256') != file_sha256(source_path):
+        return None
+    if manifest.get('artifact_sha256') and os.path.isfile(artifact) \
+            and manifest['artifact_sha256'] != file_sha256(artifact):
+        return None
+    manifest['artifact_path'] = artifact
+    return manifest
+
+
+def resolve_loader(path: str, loaders: Sequence[Tuple[str, Loader]]) -> Tuple[str, object, List[str]]:
+    """Try loaders in order; return (name, model, errors of the failed attempts)."""
+    errors: List[str] = []
+    for name, loader in loaders:
+        try:
+            return name, loader(path), errors
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+    raise RuntimeError('No loader could open %s: %s' % (path, ' / '.join(errors)))
+
+
+def load_from_manifest(source_path: str, loaders: Dict[str, Loader], variant: str = '') -> Optional[object]:
+    """Load straight from a valid manifest with its recorded loader; None if not possible."""
+    manifest = read_manifest(source_path, variant)
+    if manifest is None or manifest.get('loader') not in loaders:
+        return None
+    try:
+        return loaders[manifest['loader']](manifest['artifact_path'])
+    except Exception as e:
+        print(f"Manifest load of {manifest['artifact_path']} failed, falling back: {e}")
+        return None
@@ -0,0 +1,324 @@
+"""Versioned model artifacts with atomic publish and in-process hot swap.
+
+Each model folder under ``data/trained_models`` (e.g. ``NailPolish_Model``)
+can hold published versions next to its original flat artifacts::
+
+    versions/<version>/...            one immutable artifact set per publish
+    versions/<version>/version.json   checksums and metadata of that set
+    active.json                       {"version": ...}, replaced atomically
+
+``ModelRegistry`` publishes and activates versions. ``ModelSlot`` serves one
+of them inside a process: it notices when ``active.json`` points at another
+version, loads that version on a background thread and then swaps a single
+reference. Callers read the reference once per request, so requests already
+running finish on the version they started with. Without an ``active.json``
+the flat artifacts in the model folder are served, as before.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+from model_manifest import file_sha256
+
+_VERSION_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$')
+_FILE_VERSIONS: Dict[tuple, str] = {}
+
+
+def file_version(path: str) -> str:
+    """Short checksum of a file, memoized on (path, size, mtime); 'unknown' if missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 'unknown'
+    key = (path, stat.st_size, stat.st_mtime)
+    version = _FILE_VERSIONS.get(key)
+    if version is None:
+        version = file_sha256(path)[:12]
+        for stale in [k for k in _FILE_VERSIONS if k[0] == path]:
+            _FILE_VERSIONS.pop(stale, None)
+        _FILE_VERSIONS[key] = version
+    return version
+
+
+def _digest(parts) -> str:
+    import hashlib  # local import
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def _write_json_atomic(path: str, payload: dict) -> None:
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ModelRegistry:
+    """Published versions of one model and the pointer to the active one."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.versions_dir = os.path.join(root, 'versions')
+        self.active_path = os.path.join(root, 'active.json')
+
+    def version_dir(self, version: str) -> str:
+        if not _VERSION_RE.match(version or ''):
+            raise ValueError(f"Invalid model version: {version!r}")
+        return os.path.join(self.versions_dir, version)
+
+    def read_version(self, version: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.version_dir(version), 'version.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def versions(self) -> List[dict]:
+        """Published versions, oldest first."""
+        try:
+            names = os.listdir(self.versions_dir)
+        except OSError:
+            return []
+        found = []
+        for name in names:
+            if name.startswith('.'):
+                continue  # staging directories of publishes in progress
+            info = self.read_version(name)
+            if info is not None:
+                found.append(info)
+        return sorted(found, key=lambda v: (v.get('created_at', ''), v.get('version', '')))
+
+    def active_version(self) -> Optional[str]:
+        try:
+            with open(self.active_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('version') or None
+        except (OSError, ValueError):
+            return None
+
+    def publish(self, source_dir: str, files: Optional[Sequence[str]] = None, version: Optional[str] = None,
+                metadata: Optional[dict] = None, activate: bool = False) -> dict:
+        """Copy artifacts from ``source_dir`` into a new version directory.
+
+        Files are staged in a hidden directory and renamed into place in one
+        step, so readers never see a half-written version.
+        """
+        if files is None:
+            files = sorted(n for n in os.listdir(source_dir) if os.path.isfile(os.path.join(source_dir, n)))
+        checksums = {name: file_sha256(os.path.join(source_dir, name)) for name in files}
+        if version is None:
+            combined = _digest(f"{n}:{checksums[n]}" for n in sorted(checksums))
+            version = f"v{time.strftime('%Y%m%d-%H%M%S')}-{combined[:8]}"
+        final_dir = self.version_dir(version)
+        if os.path.exists(final_dir):
+            raise FileExistsError(f"Model version {version} already exists")
+        os.makedirs(self.versions_dir, exist_ok=True)
+        staging = os.path.join(self.versions_dir, f".staging-{version}-{os.getpid()}")
+        os.makedirs(staging)
+        try:
+            for name in files:
+                shutil.copy2(os.path.join(source_dir, name), os.path.join(staging, name))
+            info = {
+                'version': version,
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'files': checksums,
+            }
+            info.update(metadata or {})
+            _write_json_atomic(os.path.join(staging, 'version.json'), info)
+            os.rename(staging, final_dir)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if activate:
+            self.activate(version)
+        return info
+
+    def verify(self, version: str) -> None:
+        """Raise if a file of ``version`` is missing or no longer matches its checksum."""
+        info = self.read_version(version)
+        if info is None:
+            raise FileNotFoundError(f"Model version {version} is not published")
+        directory = self.version_dir(version)
+        for name, checksum in info.get('files', {}).items():
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path) or file_sha256(path) != checksum:
+                raise ValueError(f"Model version {version}: {name} is missing or corrupted")
+
+    def activate(self, version: str) -> dict:
+        """Point active.json at a published version (a rollback is activating an older one)."""
+        self.version_dir(version)  # ValueError for a malformed name
+        if self.read_version(version) is None:
+            raise FileNotFoundError(f"Model version {version} is not published")
+        pointer = {'version': version, 'activated_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        _write_json_atomic(self.active_path, pointer)
+        return pointer
+
+
+class ServingVersion:
+    """A loaded model together with the version it was loaded from."""
+
+    __slots__ = ('version', 'model', 'loaded_at')
+
+    def __init__(self, version: str, model: object) -> None:
+        self.version = version
+        self.model = model
+        self.loaded_at = time.time()
+
+
+class ModelSlot:
+    """Serves the active version of one model and hot-swaps it when the pointer moves.
+
+    ``loader(directory, version)`` builds the in-memory model from a version
+    directory (or from the flat model folder when nothing is active, with
+    ``base_version()`` as its version). The first ``get()`` loads
+    synchronously; after that a poller checks ``active.json`` every
+    ``poll_seconds`` and loads changes off the request path. A version that
+    fails to load is reported in ``stats()`` and the old one keeps serving.
+    """
+
+    def __init__(self, registry: ModelRegistry, loader: Callable[[str, str], object],
+                 base_version: Callable[[], str], poll_seconds: float = 5.0,
+                 name: str = 'model-slot') -> None:
+        self.registry = registry
+        self.loader = loader
+        self.base_version = base_version
+        self.poll_seconds = float(poll_seconds)
+        self.name = name
+        self._current: Optional[ServingVersion] = None
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._poller: Optional[threading.Thread] = None
+        self._failed_target: Optional[str] = None
+        self.swaps = 0
+        self.last_error: Optional[str] = None
+        self.last_swap_at: Optional[float] = None
+
+    def target(self) -> tuple:
+        """(version, directory) the slot should be serving right now."""
+        active = self.registry.active_version()
+        if active:
+            return active, self.registry.version_dir(active)
+        return self.base_version(), self.registry.root
+
+    def peek_version(self) -> str:
+        """Version being served, or the one the first load would serve; never loads."""
+        current = self._current
+        return current.version if current is not None else self.target()[0]
+
+    def current(self) -> Optional[ServingVersion]:
+        """The serving version, or None before the first load."""
+        return self._current
+
+    def get(self) -> ServingVersion:
+        current = self._current
+        if current is not None:
+            return current
+        with self._load_lock:
+            if self._current is None:
+                version, directory = self.target()
+                self._current = self._load(version, directory)
+                self._start_poller()
+            return self._current
+
+    def _load(self, version: str, directory: str) -> ServingVersion:
+        if directory != self.registry.root:
+            self.registry.verify(version)
+        return ServingVersion(version, self.loader(directory, version))
+
+    def refresh(self) -> bool:
+        """Load and swap in the active version if it changed; True when a swap happened."""
+        if self._current is None:
+            return False  # nothing served yet; the first get() loads the active version
+        with self._load_lock:
+            version, directory = self.target()
+            current = self._current
+            if version == current.version or version == self._failed_target:
+                return False
+            started = time.perf_counter()
+            try:
+                fresh = self._load(version, directory)
+            except Exception as e:
+                self._failed_target = version
+                self.last_error = f"{version}: {e}"
+                print(f"{self.name}: loading version {version} failed, keeping {current.version}: {e}")
+                return False
+            # One reference assignment: new requests see the new version,
+            # requests holding the old ServingVersion finish on it
+            self._current = fresh
+            self._failed_target = None
+            self.last_error = None
+            self.swaps += 1
+            self.last_swap_at = time.time()
+            print(f"{self.name}: swapped {current.version} -> {version} "
+                  f"(loaded in {time.perf_counter() - started:.2f}s)")
+            return True
+
+    def refresh_async(self) -> threading.Thread:
+        thread = threading.Thread(target=self.refresh, name=f"{self.name}-refresh", daemon=True)
+        thread.start()
+        return thread
+
+    def _start_poller(self) -> None:
+        if self.poll_seconds <= 0 or self._poller is not None:
+            return
+        self._poller = threading.Thread(target=self._poll, name=f"{self.name}-poller", daemon=True)
+        self._poller.start()
+
+    def _poll(self) -> None:
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"{self.name}: refresh failed: {e}")
+
+    def close(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> dict:
+        current = self._current
+        return {
+            'serving_version': current.version if current is not None else None,
+            'loaded_at': current.loaded_at if current is not None else None,
+            'active_version': self.registry.active_version(),
+            'swaps': self.swaps,
+            'last_swap_at': self.last_swap_at,
+            'last_error': self.last_error,
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Publish, activate and list model versions')
+    parser.add_argument('model_dir', help='Model folder, e.g. data/trained_models/NailPolish_Model')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='Show published versions and the active one')
+    publish_cmd = sub.add_parser('publish', help='Publish the artifacts of a directory as a new version')
+    publish_cmd.add_argument('source_dir')
+    publish_cmd.add_argument('--version', default=None)
+    publish_cmd.add_argument('--activate', action='store_true')
+    activate_cmd = sub.add_parser('activate', help='Make a published version the active one')
+    activate_cmd.add_argument('version')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.model_dir)
+    if args.command == 'list':
+        active = registry.active_version()
+        for info in registry.versions():
+            marker = '*' if info['version'] == active else ' '
+            print(f"{marker} {info['version']}  {info.get('created_at', '')}")
+        if active is None:
+            print('No active version: the flat artifacts are served')
+    elif args.command == 'publish':
+        info = registry.publish(args.source_dir, version=args.version, activate=args.activate)
+        print(f"Published {info['version']}{' (active)' if args.activate else ''}")
+    else:
+        print(json.dumps(registry.activate(args.version)))
@@ -1,68 +1,339 @@
+import atexit
 import os
-from typing import Tuple
+import queue
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Optional, Tuple
 
 import numpy as np
-mp = None  # MediaPipe is optional; we won't gate predictions on it
 
-try:
-    # Prefer tensorflow.keras if available
-    from tensorflow.keras.models import load_model  # type: ignore
-    from tensorflow.keras.preprocessing.image import load_img, img_to_array  # type: ignore
-    from tensorflow.keras.applications import MobileNetV2  # type: ignore
-    from tensorflow.keras.layers import Dense, GlobalAveragePooling2D  # type: ignore
-    from tensorflow.keras.models import Model as TFModel  # type: ignore
-except Exception:  # pragma: no cover
-    # Fallback to keras package if TF import path differs
-    try:
-        from keras.models import load_model  # type: ignore
-        from keras.preprocessing.image import load_img, img_to_array  # type: ignore
-        from keras.applications import MobileNetV2  # type: ignore
-        from keras.layers import Dense, GlobalAveragePooling2D  # type: ignore
-        from keras.models import Model as TFModel  # type: ignore
-    except Exception as e:  # pragma: no cover
-        load_model = None  # type: ignore
-        load_img = None  # type: ignore
-        img_to_array = None  # type: ignore
-
-# Optional CV helpers (for hand/no-hand check)
+from inference_batcher import MicroBatcher
+from model_manifest import load_from_manifest, write_manifest
+from model_registry import ModelRegistry, ModelSlot, file_version
+
+# Optional CV helper (for hand/no-hand check); OpenCV is cheap to import
 try:
     import cv2  # type: ignore
 except Exception:  # pragma: no cover
     cv2 = None  # type: ignore
-try:
-    import mediapipe as mp  # type: ignore
-except Exception:  # pragma: no cover
-    mp = None  # type: ignore
 
+# TensorFlow/Keras and MediaPipe are imported on first use only, so that
+# importing this module (e.g. from the web app) does not pay for them.
+_UNSET = object()
+_KERAS = _UNSET
+_MEDIAPIPE = _UNSET
+_IMPORT_LOCK = threading.Lock()
 
-_MODEL_INSTANCE = None
 
+def _keras():
+    """The Keras symbols used here, imported on first call; None without Keras."""
+    global _KERAS
+    if _KERAS is _UNSET:
+        with _IMPORT_LOCK:
+            if _KERAS is _UNSET:
+                _KERAS = _import_keras()
+    return _KERAS
+
+
+def _import_keras():
+    from types import SimpleNamespace
+    try:
+        # Prefer tensorflow.keras if available
+        from tensorflow.keras.models import load_model  # type: ignore
+        from tensorflow.keras.applications import MobileNetV2  # type: ignore
+        from tensorflow.keras.layers import Dense, GlobalAveragePooling2D  # type: ignore
+        from tensorflow.keras.models import Model  # type: ignore
+    except Exception:  # pragma: no cover
+        # Fallback to keras package if TF import path differs
+        try:
+            from keras.models import load_model  # type: ignore
+            from keras.applications import MobileNetV2  # type: ignore
+            from keras.layers import Dense, GlobalAveragePooling2D  # type: ignore
+            from keras.models import Model  # type: ignore
+        except Exception as e:  # pragma: no cover
+            print(f"Warning: Keras is not available: {e}")
+            return None
+    return SimpleNamespace(load_model=load_model, MobileNetV2=MobileNetV2, Dense=Dense,
+                           GlobalAveragePooling2D=GlobalAveragePooling2D, Model=Model)
+
+
+def _mediapipe():
+    """The mediapipe module, imported on first call; None when not installed."""
+    global _MEDIAPIPE
+    if _MEDIAPIPE is _UNSET:
+        with _IMPORT_LOCK:
+            if _MEDIAPIPE is _UNSET:
+                try:
+                    import mediapipe as mp  # type: ignore
+                except Exception:  # pragma: no cover
+                    mp = None
+                _MEDIAPIPE = mp
+    return _MEDIAPIPE
+
+
+def _load_model(path: str, **kwargs):
+    keras = _keras()
+    if keras is None:
+        raise RuntimeError("Keras/TensorFlow is not available to load the model.")
+    return keras.load_model(path, **kwargs)
+
+
+def _batch_settings() -> Tuple[int, float]:
+    """Micro-batching limits; NAILSHAPE_BATCH_MAX_SIZE=1 disables batching."""
+    max_size = int(os.environ.get('NAILSHAPE_BATCH_MAX_SIZE', 8))
+    max_wait_ms = float(os.environ.get('NAILSHAPE_BATCH_MAX_WAIT_MS', 5))
+    return max_size, max_wait_ms
+
+
+class _ShapeModel:
+    """One loaded version of the shape model with its labels and batcher.
+
+    The batcher coalesces concurrent predict_shape calls into one forward
+    pass. It belongs to this version only and is closed once the last
+    request holding the version lets go of it after a swap.
+    """
+
+    def __init__(self, model, labels, version: str) -> None:
+        self.model = model
+        self.labels = list(labels)
+        self.version = version
+        self._batcher: Optional[MicroBatcher] = None
+        self._lock = threading.Lock()
+
+    def batcher(self) -> Optional[MicroBatcher]:
+        max_size, max_wait_ms = _batch_settings()
+        if max_size <= 1:
+            return None
+        if self._batcher is None:
+            with self._lock:
+                if self._batcher is None:
+                    model = self.model  # the worker thread must not keep this object alive
+                    batcher = MicroBatcher(
+                        lambda batch: model.predict(batch, verbose=0),
+                        max_batch_size=max_size,
+                        max_wait_ms=max_wait_ms,
+                        name=f'nail-shape-batcher-{self.version}',
+                    )
+                    weakref.finalize(self, batcher.close)
+                    self._batcher = batcher
+        return self._batcher
+
+
+class _HandsPool:
+    """Bounded pool of long-lived MediaPipe Hands detectors.
+
+    Building a Hands graph costs more than running it, so detectors are
+    created lazily (up to ``size``), reused across requests and closed on
+    shutdown. Callers block while every detector is busy.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = max(1, int(size))
+        self._idle: "queue.LifoQueue" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+    def _create(self):
+        return _mediapipe().solutions.hands.Hands(static_image_mode=True, max_num_hands=2, min_detection_confidence=0.5)
+
+    @contextmanager
+    def acquire(self):
+        hands = None
+        try:
+            hands = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError('Hands pool is closed')
+                grow = self._created < self.size
+                if grow:
+                    self._created += 1
+            if grow:
+                try:
+                    hands = self._create()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                hands = self._idle.get()
+        broken = False
+        try:
+            yield hands
+        except Exception:
+            broken = True
+            raise
+        finally:
+            if broken or self._closed:
+                # A failed graph may be in a bad state; let it be rebuilt
+                self._discard(hands)
+            else:
+                self._idle.put(hands)
+
+    def _discard(self, hands) -> None:
+        with self._lock:
+            self._created -= 1
+        try:
+            hands.close()
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def stats(self) -> dict:
+        return {'size': self.size, 'created': self._created, 'idle': self._idle.qsize()}
 
-def _get_model_path() -> str:
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(
-        base_dir,
-        "data",
-        "trained_models",
-        "NailShape_Model",
-        "nail_shape_model.h5",
-    )
 
-def _get_saved_model_dir() -> str:
+_HANDS_POOL: Optional[_HandsPool] = None
+_HANDS_POOL_LOCK = threading.Lock()
+
+
+def _get_hands_pool() -> _HandsPool:
+    global _HANDS_POOL
+    if _HANDS_POOL is None:
+        with _HANDS_POOL_LOCK:
+            if _HANDS_POOL is None:
+                _HANDS_POOL = _HandsPool(int(os.environ.get('NAILSHAPE_HANDS_POOL_SIZE', 4)))
+    return _HANDS_POOL
+
+
+def hands_pool_stats() -> dict:
+    """How many pooled hand detectors exist and how many are idle."""
+    if _HANDS_POOL is None:
+        return {'started': False}
+    return dict(_HANDS_POOL.stats(), started=True)
+
+
+def batcher_stats() -> dict:
+    """Queue depth and batch-size histogram of the serving version's batcher."""
+    serving = _SLOT.current()
+    batcher = serving.model._batcher if serving is not None else None
+    if batcher is None:
+        max_size, max_wait_ms = _batch_settings()
+        return {'enabled': max_size > 1, 'started': False,
+                'max_batch_size': max_size, 'max_wait_ms': max_wait_ms}
+    return dict(batcher.stats(), enabled=True, started=True, model_version=serving.version)
+
+
+@atexit.register
+def shutdown() -> None:
+    """Stop background inference helpers; safe to call more than once."""
+    global _HANDS_POOL
+    _SLOT.close()
+    serving = _SLOT.current()
+    if serving is not None and serving.model._batcher is not None:
+        serving.model._batcher.close()
+    with _HANDS_POOL_LOCK:
+        if _HANDS_POOL is not None:
+            _HANDS_POOL.close()
+            _HANDS_POOL = None
+
+
+def _get_model_dir() -> str:
+    """The flat model folder; published versions live under its versions/ subfolder."""
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(
-        base_dir,
-        "data",
-        "trained_models",
-        "NailShape_Model",
-        "nail_shape_model_saved",
-    )
+    return os.path.join(base_dir, "data", "trained_models", "NailShape_Model")
+
+
+def _get_model_path(model_dir: Optional[str] = None) -> str:
+    return os.path.join(model_dir or _get_model_dir(), "nail_shape_model.h5")
+
+def _get_saved_model_dir(model_dir: Optional[str] = None) -> str:
+    return os.path.join(model_dir or _get_model_dir(), "nail_shape_model_saved")
+
+
+# Inference backends: the Keras model, or TFLite conversions of it
+BACKENDS = ("keras", "tflite_fp16", "tflite_int8")
+TFLITE_BACKENDS = BACKENDS[1:]
+_DEFAULT_LABELS = ("almond", "oval", "squoval", "square", "stiletto")
+
+
+def get_backend() -> str:
+    """Inference backend selected by NAILSHAPE_BACKEND (keras, tflite_fp16 or tflite_int8)."""
+    backend = os.environ.get("NAILSHAPE_BACKEND", "keras").strip().lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown NAILSHAPE_BACKEND '{backend}'; expected one of {', '.join(BACKENDS)}")
+    return backend
+
+
+def _get_tflite_path(backend: str, model_dir: Optional[str] = None) -> str:
+    """TFLite artifact written next to nail_shape_model.h5, e.g. nail_shape_model_fp16.tflite."""
+    root, _ext = os.path.splitext(_get_model_path(model_dir))
+    return f"{root}_{backend.split('_', 1)[1]}.tflite"
+
 
+class _TFLiteModel:
+    """TFLite interpreter behind the same ``predict(batch, verbose=0)`` call as Keras.
 
-def _get_labels_sidecar() -> Tuple[Tuple[str, ...], bool]:
+    Uses the small ``tflite_runtime`` package when installed and falls back to
+    ``tf.lite``. Both quantized variants keep float32 inputs and outputs.
+    """
+
+    def __init__(self, path: str) -> None:
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"TFLite model not found at: {path}. "
+                f"Create it with: python nail_shape_analyzer.py convert"
+            )
+        try:
+            from tflite_runtime.interpreter import Interpreter  # type: ignore
+        except ImportError:
+            import tensorflow as _tf  # type: ignore
+            Interpreter = _tf.lite.Interpreter
+        threads = int(os.environ.get("NAILSHAPE_TFLITE_THREADS", os.cpu_count() or 1))
+        self.path = path
+        self._interpreter = Interpreter(model_path=path, num_threads=threads)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = int(self._input["shape"][0])
+        # An interpreter must not be invoked from two threads at once
+        self._lock = threading.Lock()
+
+    def predict(self, batch: np.ndarray, verbose: int = 0) -> np.ndarray:
+        batch = np.ascontiguousarray(batch, dtype=self._input["dtype"])
+        with self._lock:
+            if batch.shape[0] != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input["index"], list(batch.shape))
+                self._interpreter.allocate_tensors()
+                self._batch_size = batch.shape[0]
+            self._interpreter.set_tensor(self._input["index"], batch)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output["index"]).copy()
+
+
+def current_model_version() -> str:
+    """Version of the shape model serving requests, used to key cached predictions.
+
+    The registry version when one is active, else a checksum of the flat
+    model file; available without loading the model.
+    """
+    return _SLOT.peek_version()
+
+
+def _base_model_version() -> str:
+    """Short checksum of the flat model artifact the configured backend loads.
+
+    Memoized on path, size and mtime, so polling it is cheap.
+    """
+    backend = get_backend()
+    path = _get_model_path() if backend == "keras" else _get_tflite_path(backend)
+    if not os.path.exists(path):
+        return "saved_model" if os.path.isdir(_get_saved_model_dir()) else "unknown"
+    return file_version(path)
+
+
+def _get_labels_sidecar(model_dir: Optional[str] = None) -> Tuple[Tuple[str, ...], bool]:
     """Try to load labels from sidecar files. Returns (labels, found)."""
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    model_dir = os.path.join(base_dir, "data", "trained_models", "NailShape_Model")
+    model_dir = model_dir or _get_model_dir()
     # Try class_indices.json created during training
     class_indices_path = os.path.join(model_dir, "class_indices.json")
     labels_path = os.path.join(model_dir, "labels.txt")
@@ -86,6 +357,37 @@ def _get_labels_sidecar() -> Tuple[Tuple[str, ...], bool]:
     return tuple(), False
 
 
+def decode_image(data: bytes) -> Optional[np.ndarray]:
+    """Decode encoded image bytes once into an RGB uint8 array, or None if unreadable.
+
+    EXIF orientation is ignored, as Keras load_img (used in training) ignores it.
+    """
+    if cv2 is not None:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if img is not None:
+            return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    # Formats OpenCV cannot read (or no OpenCV at all): let PIL try
+    try:
+        import io  # local import
+        from PIL import Image  # type: ignore
+        return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"), dtype=np.uint8)
+    except Exception:
+        return None
+
+
+def preprocess_image(img_rgb: np.ndarray, target_size: Tuple[int, int] = (224, 224)) -> np.ndarray:
+    """Resize to the model input size and scale to [0, 1] (no batch axis)."""
+    width, height = target_size[1], target_size[0]
+    # Keras load_img (used in training) resizes with PIL's NEAREST, which samples
+    # pixel centres; OpenCV's INTER_NEAREST does not, INTER_NEAREST_EXACT does
+    if cv2 is not None:
+        resized = cv2.resize(img_rgb, (width, height), interpolation=cv2.INTER_NEAREST_EXACT)
+    else:
+        from PIL import Image  # type: ignore
+        resized = np.asarray(Image.fromarray(img_rgb).resize((width, height), Image.NEAREST))
+    return resized.astype(np.float32) / 255.0
+
+
 def _softmax(logits: np.ndarray) -> np.ndarray:
     logits = logits.astype(np.float64)
     logits -= np.max(logits)
@@ -93,109 +395,189 @@ def _softmax(logits: np.ndarray) -> np.ndarray:
     return exp / np.sum(exp)
 
 
+def _tf_keras_h5_custom(path: str):
+    import tensorflow as _tf  # type: ignore
+    return _tf.keras.models.load_model(
+        path,
+        compile=False,
+        custom_objects={
+            'InputLayer': _tf.keras.layers.InputLayer,
+        }
+    )
+
+
+def _tf_compat_v1_h5(path: str):
+    import tensorflow as _tf  # type: ignore
+    return _tf.compat.v1.keras.models.load_model(path, compile=False)
+
+
+def _keras_h5_custom(path: str):
+    import tensorflow as _tf  # type: ignore
+    from keras.models import load_model as _kload  # type: ignore
+    return _kload(
+        path,
+        compile=False,
+        custom_objects={
+            'InputLayer': _tf.keras.layers.InputLayer,
+        }
+    )
+
+
+# Named loaders; the manifest written by `compile` records which one to use
+_KERAS_LOADERS = {
+    "tf_keras_h5_custom": _tf_keras_h5_custom,
+    "tf_keras_h5_safe": lambda path: _load_model(path, compile=False, safe_mode=False),
+    "tf_keras_h5": lambda path: _load_model(path, compile=False),
+    "tf_keras_saved": lambda path: _load_model(path, compile=False),
+    "tf_compat_v1_h5": _tf_compat_v1_h5,
+    "keras_h5_custom": _keras_h5_custom,
+    "keras_h5": lambda path: _load_model(path),  # last resort
+    "keras_native": lambda path: _load_model(path, compile=False),
+}
+_CASCADE = ("tf_keras_h5_custom", "tf_keras_h5_safe", "tf_keras_h5", "tf_keras_saved", "tf_compat_v1_h5", "keras_h5_custom", "keras_h5")
+
+
+def _rebuild_mobilenet(h5_path: str, target_size: Tuple[int, int], labels):
+    """Rebuild the MobileNetV2 head and load weights by name (skipping mismatches)."""
+    keras = _keras()
+    num_classes = max(2, len(labels))
+    base = keras.MobileNetV2(weights=None, include_top=False, input_shape=(target_size[0], target_size[1], 3))
+    x = base.output
+    x = keras.GlobalAveragePooling2D()(x)
+    x = keras.Dense(128, activation='relu')(x)
+    preds = keras.Dense(num_classes, activation='softmax')(x)
+    rebuilt = keras.Model(inputs=base.input, outputs=preds)
+    rebuilt.load_weights(h5_path, by_name=True, skip_mismatch=True)
+    return rebuilt
+
+
+def _resolve_keras_model(target_size: Tuple[int, int], labels,
+                         model_dir: Optional[str] = None) -> Tuple[object, str]:
+    """Run the loader cascade; returns (model, name of the loader that worked)."""
+    if _keras() is None:
+        raise RuntimeError("Keras/TensorFlow is not available to load the model.")
+    h5_path = _get_model_path(model_dir)
+    saved_dir = _get_saved_model_dir(model_dir)
+    if not os.path.exists(h5_path) and not os.path.isdir(saved_dir):
+        raise FileNotFoundError(f"Nail shape model not found at: {h5_path} or {saved_dir}")
+    # Try multiple loaders/fmts to avoid version mismatches
+    last_err: Exception | None = None
+    for attempt in _CASCADE:
+        path = saved_dir if attempt == "tf_keras_saved" else h5_path
+        if not os.path.exists(path):
+            continue
+        try:
+            return _KERAS_LOADERS[attempt](path), attempt
+        except Exception as e:  # pragma: no cover
+            last_err = e
+    # Final fallback: rebuild MobileNetV2 head and load weights by name
+    if os.path.exists(h5_path):
+        try:
+            return _rebuild_mobilenet(h5_path, target_size, labels), "mobilenet_rebuild"
+        except Exception as e:  # pragma: no cover
+            last_err = e
+    raise RuntimeError(f"Failed to load nail shape model: {last_err}")
+
+
+def _load_keras_model(target_size: Tuple[int, int], labels, model_dir: Optional[str] = None) -> object:
+    """Load the Keras model, trying several loaders to tolerate version mismatches.
+
+    When a manifest from `python nail_shape_analyzer.py compile` matches the
+    model on disk, the compiled artifact is loaded directly with its recorded
+    loader and the cascade is skipped.
+    """
+    model = load_from_manifest(_get_model_path(model_dir), _KERAS_LOADERS)
+    if model is not None:
+        return model
+    model, _loader = _resolve_keras_model(target_size, labels, model_dir)
+    return model
+
+
+def _load_shape_model(model_dir: str, version: str, target_size: Tuple[int, int] = (224, 224)) -> _ShapeModel:
+    """Load the configured backend from a model folder (the flat one or a registry version)."""
+    sidecar_labels, found = _get_labels_sidecar(model_dir)
+    # Prefer sidecar-provided labels; fallback to common defaults
+    labels = list(sidecar_labels) if found else list(_DEFAULT_LABELS)
+    backend = get_backend()
+    if backend == "keras":
+        model = _load_keras_model(target_size, labels, model_dir)
+    else:
+        model = _TFLiteModel(_get_tflite_path(backend, model_dir))
+    return _ShapeModel(model, labels, version)
+
+
+# Serving version of the shape model; swapped when the registry's active.json moves
+_SLOT = ModelSlot(
+    ModelRegistry(_get_model_dir()),
+    _load_shape_model,
+    _base_model_version,
+    poll_seconds=float(os.environ.get('MODEL_REGISTRY_POLL_SECONDS', 5)),
+    name='nail-shape-model',
+)
+
+
+def model_slot() -> ModelSlot:
+    """The registry-backed slot serving the shape model (publish, activate, stats)."""
+    return _SLOT
+
+
+def compile_model() -> dict:
+    """One-time step: find the working loader, re-export to the native .keras format
+    and write nail_shape_model.manifest.json so later startups load it directly."""
+    h5_path = _get_model_path()
+    if not os.path.exists(h5_path):
+        raise FileNotFoundError(f"Nail shape model not found at: {h5_path}")
+    labels, found = _get_labels_sidecar()
+    model, loader = _resolve_keras_model((224, 224), list(labels) if found else list(_DEFAULT_LABELS))
+    canonical = os.path.splitext(h5_path)[0] + ".keras"
+    try:
+        model.save(canonical)
+        _KERAS_LOADERS["keras_native"](canonical)  # make sure it loads back
+        return write_manifest(h5_path, canonical, "keras_native", "keras_v3", resolved_loader=loader)
+    except Exception as e:
+        if loader == "mobilenet_rebuild" or loader not in _KERAS_LOADERS:
+            raise RuntimeError(f"Could not export a loadable artifact: {e}")
+        # Export not supported here; still record the loader that worked
+        path = _get_saved_model_dir() if loader == "tf_keras_saved" else h5_path
+        return write_manifest(h5_path, path, loader, "h5" if path == h5_path else "saved_model",
+                              export_error=str(e))
+
+
 class NailShapeAnalyzer:
     """Wraps the trained nail shape model for image-based prediction."""
 
     def __init__(self, target_size: Tuple[int, int] = (224, 224)) -> None:
-        global _MODEL_INSTANCE
         self.target_size = target_size
-        # Prefer sidecar-provided labels; fallback to common defaults
-        sidecar_labels, found = _get_labels_sidecar()
-        if found:
-            self.labels = list(sidecar_labels)
-        else:
-            
-            self.labels = ["almond", "oval", "squoval", "square", "stiletto"]
-
-        if _MODEL_INSTANCE is None:
-            if load_model is None:
-                raise RuntimeError("Keras/TensorFlow is not available to load the model.")
-            h5_path = _get_model_path()
-            saved_dir = _get_saved_model_dir()
-            if not os.path.exists(h5_path) and not os.path.isdir(saved_dir):
-                raise FileNotFoundError(f"Nail shape model not found at: {h5_path} or {saved_dir}")
-            # Try multiple loaders/fmts to avoid version mismatches
-            last_err: Exception | None = None
-            for attempt in ("tf_keras_h5_custom", "tf_keras_h5_safe", "tf_keras_h5", "tf_keras_saved", "tf_compat_v1_h5", "keras_h5_custom", "keras_h5"):
-                try:
-                    if attempt == "tf_keras_h5_custom" and os.path.exists(h5_path):
-                        import tensorflow as _tf  # type: ignore
-                        _MODEL_INSTANCE = _tf.keras.models.load_model(
-                            h5_path,
-                            compile=False,
-                            custom_objects={
-                                'InputLayer': _tf.keras.layers.InputLayer,
-                            }
-                        )
-                        break
-                    if attempt == "tf_keras_h5_safe" and os.path.exists(h5_path):
-                        _MODEL_INSTANCE = load_model(h5_path, compile=False, safe_mode=False)  # type: ignore[arg-type]
-                        break
-                    if attempt == "tf_keras_h5" and os.path.exists(h5_path):
-                        _MODEL_INSTANCE = load_model(h5_path, compile=False)  # type: ignore[arg-type]
-                        break
-                    if attempt == "tf_keras_saved" and os.path.isdir(saved_dir):
-                        _MODEL_INSTANCE = load_model(saved_dir, compile=False)  # type: ignore[arg-type]
-                        break
-                    if attempt == "tf_compat_v1_h5" and os.path.exists(h5_path):
-                        import tensorflow as _tf  # type: ignore
-                        _MODEL_INSTANCE = _tf.compat.v1.keras.models.load_model(h5_path, compile=False)
-                        break
-                    if attempt == "keras_h5_custom" and os.path.exists(h5_path):
-                        import tensorflow as _tf  # type: ignore
-                        from keras.models import load_model as _kload  # type: ignore
-                        _MODEL_INSTANCE = _kload(
-                            h5_path,
-                            compile=False,
-                            custom_objects={
-                                'InputLayer': _tf.keras.layers.InputLayer,
-                            }
-                        )
-                        break
-                    if attempt == "keras_h5" and os.path.exists(h5_path):
-                        _MODEL_INSTANCE = load_model(h5_path)  # last resort
-                        break
-                except Exception as e:  # pragma: no cover
-                    last_err = e
-                    continue
-            # Final fallback: rebuild MobileNetV2 head and load weights by name
-            if _MODEL_INSTANCE is None and os.path.exists(h5_path) and TFModel is not None:
-                try:
-                    num_classes = max(2, len(self.labels))
-                    base = MobileNetV2(weights=None, include_top=False, input_shape=(self.target_size[0], self.target_size[1], 3))
-                    x = base.output
-                    x = GlobalAveragePooling2D()(x)
-                    x = Dense(128, activation='relu')(x)
-                    preds = Dense(num_classes, activation='softmax')(x)
-                    rebuilt = TFModel(inputs=base.input, outputs=preds)
-                    # Load weights best-effort; skip mismatches between heads
-                    rebuilt.load_weights(h5_path, by_name=True, skip_mismatch=True)
-                    _MODEL_INSTANCE = rebuilt
-                except Exception as e:  # pragma: no cover
-                    last_err = e
-            if _MODEL_INSTANCE is None:
-                raise RuntimeError(f"Failed to load nail shape model: {last_err}")
-            if _MODEL_INSTANCE is None:
-                raise RuntimeError(f"Failed to load nail shape model: {last_err}")
-
-        self.model = _MODEL_INSTANCE
+        # Pin the serving version: a swap during this request does not affect it
+        serving = _SLOT.get()
+        self._shape_model = serving.model
+        self.model = serving.model.model
+        self.labels = serving.model.labels
+        self.model_version = serving.version
 
     def predict_shape(self, image_path: str) -> Tuple[str, float]:
+        with open(image_path, "rb") as f:
+            return self.predict_shape_from_bytes(f.read())
+
+    def predict_shape_from_bytes(self, data: bytes) -> Tuple[str, float]:
+        """Predict from encoded image bytes (e.g. an upload) without touching disk."""
+        img = decode_image(data)
+        if img is None:
+            raise ValueError("Could not decode image data.")
+        return self.predict_shape_from_array(img)
+
+    def predict_shape_from_array(self, img_rgb: np.ndarray) -> Tuple[str, float]:
+        """Predict from an already decoded RGB uint8 image.
+
+        The same array feeds the hand check and the model input, so an
+        upload is decoded exactly once.
+        """
         # Reject non-hand images first if possible
-        if not self._looks_like_human_hand(image_path):
+        if not self._looks_like_human_hand(img_rgb):
             return "Not a human hand", 0.0
 
-        # Predict directly
-        if load_img is None or img_to_array is None:
-            raise RuntimeError("Image preprocessing utilities are not available.")
-
-        img = load_img(image_path, target_size=self.target_size)
-        arr = img_to_array(img)
-        arr = arr / 255.0
-        arr = np.expand_dims(arr, axis=0)
-
-        preds = self.model.predict(arr, verbose=0)
-        preds = preds[0] if isinstance(preds, (list, tuple)) else preds
+        arr = self._preprocess(img_rgb)
+        preds = self._predict_one(arr)
 
         # Ensure 1D vector
         preds = np.squeeze(preds)
@@ -221,44 +603,221 @@ class NailShapeAnalyzer:
             label = self.labels[safe_idx]
         return label, confidence
 
-    def _looks_like_human_hand(self, image_path: str) -> bool:
-       
-        if mp is not None and cv2 is not None:
+    def _predict_one(self, arr: np.ndarray) -> np.ndarray:
+        """Run the model on one preprocessed image (no batch axis)."""
+        batcher = self._shape_model.batcher()
+        if batcher is not None:
+            return batcher.predict(arr)
+        preds = self.model.predict(np.expand_dims(arr, axis=0), verbose=0)
+        return preds[0] if isinstance(preds, (list, tuple)) else preds
+
+    def _preprocess(self, img_rgb: np.ndarray) -> np.ndarray:
+        return preprocess_image(img_rgb, self.target_size)
+
+    def _looks_like_human_hand(self, img_rgb: np.ndarray) -> bool:
+        # If we cannot check, allow prediction
+        if cv2 is None:
+            return True
+
+        img = img_rgb
+        max_w = 800
+        if img.shape[1] > max_w:
+            scale = max_w / img.shape[1]
+            img = cv2.resize(img, (0, 0), fx=scale, fy=scale)
+
+        if _mediapipe() is not None:
             try:
-                img = cv2.imread(image_path)
-                if img is None:
-                    return True  
-                max_w = 800
-                if img.shape[1] > max_w:
-                    scale = max_w / img.shape[1]
-                    img = cv2.resize(img, (0, 0), fx=scale, fy=scale)
-                img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                with mp.solutions.hands.Hands(static_image_mode=True, max_num_hands=2, min_detection_confidence=0.5) as hands:
-                    res = hands.process(img_rgb)
+                with _get_hands_pool().acquire() as hands:
+                    res = hands.process(img)
                     return bool(getattr(res, 'multi_hand_landmarks', None))
             except Exception:
                 pass
 
         # Fallback: simple skin-like detection heuristic using HSV
-        if cv2 is not None:
-            try:
-                img = cv2.imread(image_path)
-                if img is None:
-                    return True
-                hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-               
-                lower = np.array([0, 20, 50], dtype=np.uint8)
-                upper = np.array([25, 255, 255], dtype=np.uint8)
-                mask = cv2.inRange(hsv, lower, upper)
-                skin_ratio = float(np.count_nonzero(mask)) / float(mask.size)
-                return skin_ratio > 0.01
-            except Exception:
-                return True
+        try:
+            hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
+            lower = np.array([0, 20, 50], dtype=np.uint8)
+            upper = np.array([25, 255, 255], dtype=np.uint8)
+            mask = cv2.inRange(hsv, lower, upper)
+            skin_ratio = float(np.count_nonzero(mask)) / float(mask.size)
+            return skin_ratio > 0.01
+        except Exception:
+            return True
+
+
+def warmup() -> None:
+    """Load the model and run one dummy inference so graph tracing happens before traffic."""
+    analyzer = NailShapeAnalyzer()
+    dummy = np.zeros((1, analyzer.target_size[0], analyzer.target_size[1], 3), dtype=np.float32)
+    analyzer.model.predict(dummy, verbose=0)
+    # Build one hand detector too, so the first upload does not pay for it
+    if _mediapipe() is not None:
+        with _get_hands_pool().acquire() as hands:
+            hands.process(np.zeros((64, 64, 3), dtype=np.uint8))
+
+
+def convert_to_tflite(backend: str, output_path: Optional[str] = None) -> str:
+    """One-time conversion of the Keras model to a TFLite artifact.
+
+    ``tflite_fp16`` stores float16 weights; ``tflite_int8`` applies dynamic-range
+    (int8 weight) quantization. Returns the path written.
+    """
+    if backend not in TFLITE_BACKENDS:
+        raise ValueError(f"Expected one of {', '.join(TFLITE_BACKENDS)}")
+    import tensorflow as _tf  # type: ignore
+    labels, found = _get_labels_sidecar()
+    model = _load_keras_model((224, 224), list(labels) if found else list(_DEFAULT_LABELS))
+    converter = _tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [_tf.lite.Optimize.DEFAULT]
+    if backend == "tflite_fp16":
+        converter.target_spec.supported_types = [_tf.float16]
+    tflite_bytes = converter.convert()
+    output_path = output_path or _get_tflite_path(backend)
+    tmp_path = output_path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.write(tflite_bytes)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def _rss_mb() -> float:
+    """Current resident set size in MB (Linux /proc, else peak RSS from resource)."""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource  # local import
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
 
-        # If we cannot check, allow prediction
-        return True
 
+def _get_benchmark_reference_path(model_dir: Optional[str] = None) -> str:
+    return os.path.join(model_dir or _get_model_dir(), "benchmark_reference.json")
 
 
+def _keras_file_version() -> Optional[str]:
+    path = _get_model_path()
+    return file_version(path) if os.path.exists(path) else None
 
 
+def _load_benchmark_reference(path: str) -> Optional[dict]:
+    """Keras top-1 per image name from an earlier run, or None if missing or for another model."""
+    import json  # local import
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            reference = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if reference.get("model_version") != _keras_file_version():
+        return None
+    return reference.get("top1") or None
+
+
+def _save_benchmark_reference(path: str, top1: dict) -> None:
+    import json  # local import
+    tmp_path = path + ".part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"model_version": _keras_file_version(), "top1": top1}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def benchmark(image_dir: str, backends=BACKENDS, limit: int = 50, repeats: int = 3,
+              reference_path: Optional[str] = None) -> dict:
+    """Compare backends on single-image latency, RSS growth and top-1 agreement with Keras.
+
+    RSS is measured as the growth while each backend loads; run one backend
+    per process (``--backends``) for numbers that are not skewed by earlier ones.
+    A Keras run saves its top-1 per image to ``reference_path`` so TFLite runs
+    in later processes can still report agreement against it.
+    """
+    import time  # local import
+
+    reference_path = reference_path or _get_benchmark_reference_path()
+    names, samples = [], []
+    for name in sorted(os.listdir(image_dir)):
+        if len(samples) >= limit:
+            break
+        path = os.path.join(image_dir, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            img = decode_image(f.read())
+        if img is not None:
+            names.append(name)
+            samples.append(preprocess_image(img))
+    if not samples:
+        raise ValueError(f"No readable images in {image_dir}")
+
+    labels, found = _get_labels_sidecar()
+    labels = list(labels) if found else list(_DEFAULT_LABELS)
+    report = {"images": len(samples), "backends": {}}
+    reference_top1 = None if "keras" in backends else _load_benchmark_reference(reference_path)
+    for backend in backends:
+        rss_before = _rss_mb()
+        started = time.perf_counter()
+        if backend == "keras":
+            model = _load_keras_model((224, 224), labels)
+        else:
+            model = _TFLiteModel(_get_tflite_path(backend))
+        load_seconds = time.perf_counter() - started
+        model.predict(np.expand_dims(samples[0], axis=0), verbose=0)  # warm-up
+
+        timings, top1 = [], []
+        for arr in samples:
+            batch = np.expand_dims(arr, axis=0)
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                preds = model.predict(batch, verbose=0)
+                timings.append((time.perf_counter() - t0) * 1000.0)
+            preds = preds[0] if isinstance(preds, (list, tuple)) else preds
+            top1.append(int(np.argmax(np.squeeze(preds))))
+        if backend == "keras":
+            reference_top1 = dict(zip(names, top1))
+            _save_benchmark_reference(reference_path, reference_top1)
+
+        timings_arr = np.asarray(timings)
+        entry = {
+            "load_seconds": round(load_seconds, 3),
+            "rss_growth_mb": round(_rss_mb() - rss_before, 1),
+            "latency_ms_mean": round(float(timings_arr.mean()), 3),
+            "latency_ms_p50": round(float(np.percentile(timings_arr, 50)), 3),
+            "latency_ms_p95": round(float(np.percentile(timings_arr, 95)), 3),
+        }
+        if reference_top1 is not None:
+            compared = [(reference_top1[name], pred) for name, pred in zip(names, top1) if name in reference_top1]
+            if compared:
+                entry["top1_agreement_with_keras"] = round(sum(a == b for a, b in compared) / len(compared), 4)
+                entry["top1_compared_images"] = len(compared)
+        report["backends"][backend] = entry
+        del model
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Nail shape model tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("compile", help="Resolve the working loader once and write a fast-load manifest")
+    convert_cmd = sub.add_parser("convert", help="Write TFLite artifacts next to nail_shape_model.h5")
+    convert_cmd.add_argument("--backend", choices=TFLITE_BACKENDS, action="append",
+                             help="Backend to build (repeatable; default: all)")
+    bench_cmd = sub.add_parser("benchmark", help="Compare latency, memory and top-1 agreement of backends")
+    bench_cmd.add_argument("--images", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "uploads"))
+    bench_cmd.add_argument("--limit", type=int, default=50)
+    bench_cmd.add_argument("--repeats", type=int, default=3)
+    bench_cmd.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    bench_cmd.add_argument("--reference", default=None,
+                           help="Keras top-1 file written by a keras run and read by TFLite-only runs")
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        print(json.dumps(compile_model(), indent=2))
+    elif args.command == "convert":
+        for name in args.backend or TFLITE_BACKENDS:
+            print(f"{name}: wrote {convert_to_tflite(name)}")
+    else:
+        print(json.dumps(benchmark(args.images, args.backends, args.limit, args.repeats, args.reference), indent=2))
@@ -4,7 +4,8 @@ from typing import Dict, List
 
 import numpy as np
 import pandas as pd
-from tensorflow.keras.models import load_model
+
+from polish_numpy_model import NumpyDenseModel
 
 _BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 _MODEL_DIR = os.path.join(_BASE_DIR, "data", "trained_models", "NailPolish_Model")
@@ -22,7 +23,15 @@ _scaler = _load_pickle("scaler_v3.pkl")
 _kmeans = _load_pickle("Kmeans_v3.pkl")         # only if using clustering
 _label_encoder = _load_pickle("label_encoder_v3.pkl")
 
-_model = load_model(os.path.join(_MODEL_DIR, "nail_polish_model_v3.h5"))
+def _load_polish_model():
+    # NumPy export first: same probabilities, no TensorFlow import
+    npz_path = os.path.join(_MODEL_DIR, "nail_polish_model_v3.npz")
+    if os.path.exists(npz_path):
+        return NumpyDenseModel(npz_path)
+    from tensorflow.keras.models import load_model
+    return load_model(os.path.join(_MODEL_DIR, "nail_polish_model_v3.h5"))
+
+_model = _load_polish_model()
 
 def _load_dataset() -> pd.DataFrame:
     csv_path = os.path.join(
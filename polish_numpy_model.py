@@ -0,0 +1,164 @@
+"""NumPy-only inference for the v3 nail polish model.
+
+``export_npz`` pulls the weights of the small dense network out of
+``nail_polish_model_v3.h5`` (with h5py, no TensorFlow) into an ``.npz``;
+``NumpyDenseModel`` runs the same forward pass with plain NumPy so the
+recommendation service can score without importing TensorFlow.
+"""
+import json
+import os
+from typing import Dict, List
+
+import numpy as np
+
+SUPPORTED_LAYERS = ('InputLayer', 'Dense', 'BatchNormalization', 'Dropout')
+
+
+def default_npz_path(h5_path: str) -> str:
+    root, _ext = os.path.splitext(h5_path)
+    return root + '.npz'
+
+
+def _layer_weights(group) -> Dict[str, np.ndarray]:
+    """Collect a layer's weight arrays by short name (kernel, bias, gamma, ...).
+
+    Handles both the Keras 2 ('dense/kernel:0') and Keras 3
+    ('sequential/dense/kernel') h5 layouts.
+    """
+    found: Dict[str, np.ndarray] = {}
+
+    def visit(name, obj):
+        if hasattr(obj, 'shape'):
+            short = name.rsplit('/', 1)[-1].split(':', 1)[0]
+            found[short] = np.asarray(obj[()])
+
+    group.visititems(visit)
+    return found
+
+
+def export_npz(h5_path: str, npz_path: str = None) -> str:
+    """Write the dense network in ``h5_path`` to an .npz (layer spec + weights)."""
+    import h5py  # local import; only needed for export
+
+    npz_path = npz_path or default_npz_path(h5_path)
+    with h5py.File(h5_path, 'r') as f:
+        config = f.attrs['model_config']
+        config = json.loads(config.decode('utf-8') if isinstance(config, bytes) else config)
+        weights_root = f['model_weights'] if 'model_weights' in f else f
+        layers = config['config']['layers'] if isinstance(config['config'], dict) else config['config']
+
+        spec: List[dict] = []
+        arrays: Dict[str, np.ndarray] = {}
+        for layer in layers:
+            kind = layer['class_name']
+            cfg = layer['config']
+            if kind not in SUPPORTED_LAYERS:
+                raise ValueError(f"Unsupported layer type for NumPy export: {kind}")
+            if kind in ('InputLayer', 'Dropout'):
+                continue  # no-ops at inference time
+            w = _layer_weights(weights_root[cfg['name']])
+            idx = len(spec)
+            if kind == 'Dense':
+                arrays[f'l{idx}_kernel'] = w['kernel'].astype(np.float32)
+                if cfg.get('use_bias', True):
+                    arrays[f'l{idx}_bias'] = w['bias'].astype(np.float32)
+                spec.append({'type': 'dense', 'activation': cfg.get('activation', 'linear'),
+                             'use_bias': bool(cfg.get('use_bias', True))})
+            else:
+                # Fold inference-mode batch norm into one scale and shift
+                eps = float(cfg.get('epsilon', 1e-3))
+                mean, var = w['moving_mean'], w['moving_variance']
+                gamma = w['gamma'] if cfg.get('scale', True) else np.ones_like(mean)
+                beta = w['beta'] if cfg.get('center', True) else np.zeros_like(mean)
+                scale = gamma / np.sqrt(var + eps)
+                arrays[f'l{idx}_scale'] = scale.astype(np.float32)
+                arrays[f'l{idx}_shift'] = (beta - mean * scale).astype(np.float32)
+                spec.append({'type': 'affine'})
+
+    arrays['spec'] = np.array(json.dumps(spec))
+    tmp_path = npz_path + '.part.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, npz_path)
+    return npz_path
+
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    x = x - np.max(x, axis=-1, keepdims=True)
+    e = np.exp(x)
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0.0),
+    'sigmoid': lambda x: 1.0 / (1.0 + np.exp(-x)),
+    'tanh': np.tanh,
+    'softmax': _softmax,
+}
+
+
+class NumpyDenseModel:
+    """Forward pass of an exported dense network; ``predict`` mirrors Keras."""
+
+    def __init__(self, npz_path: str) -> None:
+        self.path = npz_path
+        with np.load(npz_path, allow_pickle=False) as data:
+            spec = json.loads(str(data['spec']))
+            self._layers = []
+            for idx, layer in enumerate(spec):
+                if layer['type'] == 'dense':
+                    activation = layer.get('activation', 'linear')
+                    if activation not in _ACTIVATIONS:
+                        raise ValueError(f"Unsupported activation: {activation}")
+                    bias = data[f'l{idx}_bias'] if layer.get('use_bias', True) else None
+                    self._layers.append(('dense', data[f'l{idx}_kernel'], bias, _ACTIVATIONS[activation]))
+                else:
+                    self._layers.append(('affine', data[f'l{idx}_scale'], data[f'l{idx}_shift'], None))
+        self.input_dim = next(l[1].shape[0] for l in self._layers if l[0] == 'dense')
+
+    def predict(self, X, verbose: int = 0) -> np.ndarray:
+        """Class probabilities for a (batch, features) matrix; sparse input is densified."""
+        if hasattr(X, 'toarray'):
+            X = X.toarray()
+        x = np.asarray(X, dtype=np.float32)
+        if x.ndim == 1:
+            x = x[None, :]
+        if x.shape[1] != self.input_dim:
+            raise ValueError(f"Expected {self.input_dim} features, got {x.shape[1]}")
+        for kind, a, b, activation in self._layers:
+            if kind == 'dense':
+                x = x @ a
+                if b is not None:
+                    x = x + b
+                x = activation(x)
+            else:
+                x = x * a + b
+        return x
+
+
+if __name__ == '__main__':
+    import argparse
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    default_h5 = os.path.join(base_dir, 'data', 'trained_models', 'NailPolish_Model', 'nail_polish_model_v3.h5')
+    parser = argparse.ArgumentParser(description='Export the v3 polish model for NumPy-only inference')
+    parser.add_argument('--h5', default=default_h5)
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--verify', action='store_true',
+                        help='Compare against Keras on random inputs (needs TensorFlow)')
+    args = parser.parse_args()
+
+    out = export_npz(args.h5, args.out)
+    print(f"Wrote {out}")
+    # The manifest lets the app verify the .npz still matches this h5
+    from model_manifest import write_manifest
+    manifest = write_manifest(args.h5, out, loader='numpy', fmt='npz')
+    print(f"Wrote manifest for {manifest['source']} -> {manifest['artifact']}")
+    if args.verify:
+        import tensorflow as tf  # type: ignore
+
+        keras_model = tf.keras.models.load_model(args.h5, compile=False)
+        np_model = NumpyDenseModel(out)
+        X = np.random.default_rng(0).normal(size=(256, np_model.input_dim)).astype(np.float32)
+        diff = np.abs(keras_model.predict(X, verbose=0) - np_model.predict(X)).max()
+        print(f"Max abs probability difference vs Keras: {diff:.2e}")
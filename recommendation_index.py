@@ -0,0 +1,193 @@
+import math
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Columns used by the cascading quiz filters, in the order they are applied
+FILTER_COLUMNS = ('skin_tone', 'finish_type', 'dress_color', 'occasion')
+# Query ages scored per array pass in _AgeBucket.nearest_batch
+BATCH_CHUNK = 512
+
+
+def _norm(val) -> str:
+    return (val or '').strip().lower()
+
+
+class _AgeBucket:
+    """Rows sharing one filter key, grouped by distinct age for nearest-age lookup.
+
+    ``ages`` holds the sorted distinct ages, ``offsets`` the start of each age
+    group inside ``positions`` (dataset row positions, ascending within a group).
+    """
+
+    __slots__ = ('ages', 'offsets', 'positions')
+
+    def __init__(self, ages: np.ndarray, rows: np.ndarray) -> None:
+        row_ages = ages[rows]
+        order = np.lexsort((rows, row_ages))
+        self.positions = rows[order]
+        sorted_ages = row_ages[order]
+        self.ages, starts = np.unique(sorted_ages, return_index=True)
+        self.offsets = np.append(starts, len(sorted_ages))
+
+    def group(self, g: int, limit: int) -> np.ndarray:
+        start = self.offsets[g]
+        return self.positions[start:min(self.offsets[g + 1], start + limit)]
+
+    def nearest(self, age: float, top_n: int) -> List[int]:
+        """Row positions ordered by |age difference|, ties by dataset order."""
+        n = len(self.ages)
+        hi = int(np.searchsorted(self.ages, age))
+        lo = hi - 1
+        out: List[int] = []
+        while len(out) < top_n and (lo >= 0 or hi < n):
+            need = top_n - len(out)
+            d_lo = age - self.ages[lo] if lo >= 0 else math.inf
+            d_hi = self.ages[hi] - age if hi < n else math.inf
+            if d_lo < d_hi:
+                out.extend(self.group(lo, need).tolist())
+                lo -= 1
+            elif d_hi < d_lo:
+                out.extend(self.group(hi, need).tolist())
+                hi += 1
+            else:
+                # Equidistant ages on both sides: interleave by dataset order
+                merged = np.sort(np.concatenate([self.group(lo, need), self.group(hi, need)]))
+                out.extend(merged[:need].tolist())
+                lo -= 1
+                hi += 1
+        return out[:top_n]
+
+    def nearest_batch(self, ages: np.ndarray, top_n: int) -> np.ndarray:
+        """Vectorized ``nearest`` for many query ages at once.
+
+        Returns an (m, top_n) array of row positions padded with -1. Only the
+        top_n closest age groups on each side of every query can contribute,
+        and only the first top_n rows of each group, so each query has
+        2 * top_n * top_n candidates regardless of bucket size. Queries are
+        scored BATCH_CHUNK at a time to keep the candidate arrays bounded.
+        """
+        out = np.empty((len(ages), top_n), dtype=np.int64)
+        for start in range(0, len(ages), BATCH_CHUNK):
+            out[start:start + BATCH_CHUNK] = self._nearest_chunk(ages[start:start + BATCH_CHUNK], top_n)
+        return out
+
+    def _nearest_chunk(self, ages: np.ndarray, top_n: int) -> np.ndarray:
+        n_groups = len(self.ages)
+        hi = np.searchsorted(self.ages, ages)
+        g = hi[:, None] + np.arange(-top_n, top_n)[None, :]
+        valid_g = (g >= 0) & (g < n_groups)
+        g = np.clip(g, 0, n_groups - 1)
+
+        idx = self.offsets[g][:, :, None] + np.arange(top_n)[None, None, :]
+        valid = valid_g[:, :, None] & (idx < self.offsets[g + 1][:, :, None])
+        pos = self.positions[np.minimum(idx, len(self.positions) - 1)]
+        dist = np.broadcast_to(np.abs(self.ages[g] - ages[:, None])[:, :, None], idx.shape)
+
+        m = len(ages)
+        pos = np.where(valid, pos, np.iinfo(np.int64).max).reshape(m, -1)
+        dist = np.where(valid, dist, np.inf).reshape(m, -1)
+        order = np.lexsort((pos, dist), axis=-1)[:, :top_n]
+        best = np.take_along_axis(pos, order, axis=1)
+        best_valid = np.take_along_axis(dist, order, axis=1) < np.inf
+        return np.where(best_valid, best, -1)
+
+
+class DatasetIndex:
+    """Precomputed lookup structure over the recommendation dataset.
+
+    Every subset of FILTER_COLUMNS is indexed, so the cascading fallback of the
+    quiz filters (skip a filter when it would leave no rows) resolves to one
+    bucket with a handful of dict lookups. Each bucket answers nearest-age
+    queries with a binary search, so per-query cost does not grow with the CSV.
+    """
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        self.size = len(df)
+        self.columns = tuple(c for c in FILTER_COLUMNS if c in df.columns)
+        self._hex = self._column_values(df, 'recommended_hex_code', '#FF69B4')
+        self._brand = self._column_values(df, 'brand_name', 'Unknown')
+
+        if 'age' in df.columns:
+            ages = df['age'].to_numpy(dtype=np.float64)
+        else:
+            # Without ages every row ties, which keeps plain dataset order
+            ages = np.zeros(self.size, dtype=np.float64)
+
+        self._buckets: Dict[Tuple[Optional[str], ...], _AgeBucket] = {}
+        if not self.size:
+            return
+        lowered = {c: df[c].astype(str).str.lower() for c in self.columns}
+        all_rows = np.arange(self.size)
+        self._buckets[self._key({})] = _AgeBucket(ages, all_rows)
+        for r in range(1, len(self.columns) + 1):
+            for cols in combinations(self.columns, r):
+                grouped = pd.DataFrame({c: lowered[c] for c in cols}).groupby(list(cols), sort=False).indices
+                for values, rows in grouped.items():
+                    if not isinstance(values, tuple):
+                        values = (values,)
+                    key = self._key(dict(zip(cols, values)))
+                    self._buckets[key] = _AgeBucket(ages, np.asarray(rows))
+
+    @staticmethod
+    def _column_values(df: pd.DataFrame, col: str, default: str) -> list:
+        if col not in df.columns:
+            return [default] * len(df)
+        return df[col].tolist()
+
+    def _key(self, applied: dict) -> Tuple[Optional[str], ...]:
+        return tuple(applied.get(c) for c in self.columns)
+
+    def resolve_key(self, user_input: dict) -> Tuple[Optional[str], ...]:
+        """Apply the filters in order, keeping each one only if rows remain."""
+        applied: Dict[str, str] = {}
+        for col in self.columns:
+            desired = _norm(user_input.get(col))
+            if not desired:
+                continue
+            trial = dict(applied, **{col: desired})
+            if self._key(trial) in self._buckets:
+                applied = trial
+        return self._key(applied)
+
+    def bucket(self, key: Tuple[Optional[str], ...]) -> _AgeBucket:
+        return self._buckets[key]
+
+    def row(self, pos: int) -> dict:
+        return {'hex': self._hex[pos], 'brand': self._brand[pos]}
+
+    def query(self, user_input: dict, top_n: int = 3) -> list:
+        if not self.size:
+            return []
+        user_age = int(user_input.get('age', 0) or 0)
+        bucket = self._buckets[self.resolve_key(user_input)]
+        return [self.row(pos) for pos in bucket.nearest(user_age, top_n)]
+
+    def query_batch(self, user_inputs: List[dict], top_n: int = 3) -> List[list]:
+        """Answer many profiles at once; same results as calling ``query`` per profile.
+
+        Profiles are grouped by resolved filter bucket and each bucket scores
+        all of its query ages with one set of array operations.
+        """
+        if not self.size or not user_inputs:
+            return [[] for _ in user_inputs]
+
+        resolved: Dict[tuple, Tuple[Optional[str], ...]] = {}
+        groups: Dict[Tuple[Optional[str], ...], Tuple[list, list]] = {}
+        for i, user_input in enumerate(user_inputs):
+            norm_key = tuple(_norm(user_input.get(c)) for c in self.columns)
+            key = resolved.get(norm_key)
+            if key is None:
+                key = resolved[norm_key] = self.resolve_key(user_input)
+            slots, ages = groups.setdefault(key, ([], []))
+            slots.append(i)
+            ages.append(int(user_input.get('age', 0) or 0))
+
+        results: List[list] = [[] for _ in user_inputs]
+        for key, (slots, ages) in groups.items():
+            best = self._buckets[key].nearest_batch(np.asarray(ages, dtype=np.float64), top_n)
+            for slot, row_positions in zip(slots, best.tolist()):
+                results[slot] = [self.row(pos) for pos in row_positions if pos >= 0]
+        return results
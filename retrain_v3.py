@@ -0,0 +1,366 @@
+"""Background retraining of the v3 nail polish model.
+
+``/admin/retrain`` starts this module as its own low-priority process::
+
+    python retrain_v3.py --log-id 42 --out-dir data/trained_models/NailPolish_Model/candidates/run-42
+
+It rebuilds the preprocessor, scaler, KMeans, label encoder and network from
+``nail_polish_datasets.csv`` plus the quiz results stored so far, writes them
+(with the NumPy export and its manifest) to a candidate directory laid out
+like the live model folder, and streams status, progress, duration and
+validation metrics into the ``modeltraininglog`` row it was given. With
+``--registry-dir`` the run is then published as a new model version
+(see model_registry.py), activated only when ``--activate`` is given.
+
+The app holds a file lock (see file_lock.py) for the run and hands its
+descriptor to this process with ``--lock-fd``, so the lock lasts exactly as
+long as the training process. Everything heavy is imported inside ``main``
+after the process has lowered its priority.
+"""
+import colorsys
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Optional
+
+from file_lock import FileLock
+
+CATEGORICAL_FEATURES = ['skin_tone', 'finish_type', 'dress_color', 'occasion', 'brand_name']
+# Column order the app feeds the preprocessor (see predict_hex_codes_v3_batch)
+FEATURE_COLUMNS = ['skin_tone', 'age', 'finish_type', 'dress_color', 'occasion', 'brand_name']
+N_CLUSTERS = 8
+
+# Files a candidate directory holds; the names match the live model folder
+ARTIFACT_FILES = {
+    'model': 'nail_polish_model_v3.h5',
+    'numpy_model': 'nail_polish_model_v3.npz',
+    'scaler': 'scaler_v3.pkl',
+    'kmeans': 'Kmeans_v3.pkl',
+    'label_encoder': 'label_encoder_v3.pkl',
+    'preprocessor': 'preprocessor_v3.pkl',
+}
+
+
+def color_family(hex_code: str) -> str:
+    """Bucket a hex colour into the label set of the shipped v3 encoder."""
+    value = str(hex_code or '').strip().lstrip('#')
+    if len(value) != 6:
+        return 'Other'
+    try:
+        r, g, b = (int(value[i:i + 2], 16) / 255.0 for i in (0, 2, 4))
+    except ValueError:
+        return 'Other'
+    hue, lightness, saturation = colorsys.rgb_to_hls(r, g, b)
+    hue *= 360.0
+    if lightness >= 0.9:
+        return 'White'
+    if lightness <= 0.15 or max(r, g, b) < 0.2:
+        return 'Black'
+    if saturation < 0.12:
+        return 'Silver' if lightness >= 0.45 else 'Black'
+    if 35 <= hue < 62 and saturation >= 0.35 and lightness < 0.75:
+        return 'Gold'
+    if 15 <= hue < 50:
+        return 'Brown/Nude'
+    if hue < 15 or hue >= 345:
+        return 'Pink' if lightness >= 0.7 else 'Red'
+    if 290 <= hue < 345:
+        return 'Pink'
+    if 62 <= hue < 170:
+        return 'Green'
+    if 170 <= hue < 260:
+        return 'Blue'
+    return 'Other'
+
+
+# -- progress reporting ------------------------------------------------
+
+class TrainingLog:
+    """Writes status and progress of one run into its modeltraininglog row."""
+
+    def __init__(self, engine, log_id: Optional[int], min_interval: float = 1.0) -> None:
+        self.engine = engine
+        self.log_id = log_id
+        self.min_interval = min_interval
+        self.started = time.monotonic()
+        self._last_progress_at = 0.0
+
+    def update(self, **fields) -> None:
+        if self.engine is None or self.log_id is None:
+            print(f"[retrain] {fields}")
+            return
+        from sqlalchemy import text  # local import
+        fields['duration_seconds'] = round(time.monotonic() - self.started, 1)
+        assignments = ', '.join(f"{name} = :{name}" for name in fields)
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text(f"UPDATE modeltraininglog SET {assignments} WHERE id = :log_id"),
+                             dict(fields, log_id=self.log_id))
+        except Exception as e:
+            # Losing a progress tick must not kill the run
+            print(f"[retrain] could not update modeltraininglog: {e}")
+
+    def progress(self, percent: int, message: str, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_progress_at < self.min_interval:
+            return
+        self._last_progress_at = now
+        self.update(progress=int(percent), message=message)
+
+    def finish(self, status: str, message: str, metrics: Optional[dict] = None) -> None:
+        fields = dict(status=status, message=message[:1000], finished_at=datetime.now())
+        if status == 'Success':
+            fields['progress'] = 100
+        if metrics is not None:
+            fields['metrics'] = json.dumps(metrics)
+        self.update(**fields)
+
+
+# -- training ----------------------------------------------------------
+
+def load_quiz_rows(engine):
+    """Quiz answers paired with the first shade recommended for them.
+
+    A quiz and its recommendations are written together with the same user
+    and timestamp, which is what the join relies on.
+    """
+    import pandas as pd
+    from sqlalchemy import text  # local import
+
+    query = text(
+        "SELECT q.age, q.skin_tone, q.finish_type, q.outfit_color, q.occasion, r.recommended_shades "
+        "FROM quiz_results q JOIN recommendations r "
+        "ON r.user_id = q.user_id AND r.created_at = q.created_at"
+    )
+    rows = []
+    with engine.connect() as conn:
+        for age, skin_tone, finish_type, outfit_color, occasion, payload in conn.execute(query):
+            try:
+                shades = json.loads(payload or '[]')
+            except (TypeError, ValueError):
+                continue
+            first = shades[0] if shades else None
+            if isinstance(first, dict):
+                hex_code, brand = first.get('hex'), first.get('brand')
+            else:
+                hex_code, brand = first, None
+            if not hex_code:
+                continue
+            rows.append({
+                'skin_tone': skin_tone, 'age': age, 'finish_type': finish_type,
+                'dress_color': outfit_color, 'occasion': occasion,
+                'brand_name': brand or '', 'recommended_hex_code': hex_code,
+            })
+    return pd.DataFrame(rows, columns=FEATURE_COLUMNS + ['recommended_hex_code'])
+
+
+def build_network(input_dim: int, n_classes: int):
+    import tensorflow as tf
+
+    layers = tf.keras.layers
+    model = tf.keras.Sequential([
+        layers.Input(shape=(input_dim,)),
+        layers.Dense(512, activation='relu'),
+        layers.BatchNormalization(),
+        layers.Dropout(0.4),
+        layers.Dense(256, activation='relu'),
+        layers.BatchNormalization(),
+        layers.Dropout(0.3),
+        layers.Dense(128, activation='relu'),
+        layers.BatchNormalization(),
+        layers.Dropout(0.3),
+        layers.Dense(n_classes, activation='softmax'),
+    ])
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=1e-3),
+                  loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def train(csv_path: str, out_dir: str, log: TrainingLog, engine=None, epochs: int = 150,
+          validation_split: float = 0.2, seed: int = 42) -> dict:
+    """Fit every v3 artifact and write them to ``out_dir``; returns validation metrics."""
+    import joblib
+    import numpy as np
+    import pandas as pd
+    import tensorflow as tf
+    from sklearn.cluster import KMeans
+    from sklearn.compose import ColumnTransformer
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import LabelEncoder, OneHotEncoder, StandardScaler
+
+    from model_manifest import write_manifest
+    from polish_numpy_model import NumpyDenseModel, export_npz
+
+    log.progress(2, 'Loading training data', force=True)
+    dataset = pd.read_csv(csv_path)
+    dataset.columns = [c.strip() for c in dataset.columns]
+    quizzes = load_quiz_rows(engine) if engine is not None else pd.DataFrame()
+    frame = pd.concat([dataset, quizzes], ignore_index=True) if len(quizzes) else dataset
+    frame = frame.dropna(subset=['recommended_hex_code'])
+    for column in CATEGORICAL_FEATURES:
+        frame[column] = frame[column].fillna('').astype(str)
+    frame['age'] = pd.to_numeric(frame['age'], errors='coerce').fillna(0).astype(int)
+    labels = frame['recommended_hex_code'].map(color_family)
+
+    log.progress(8, f"Fitting preprocessing on {len(frame)} rows", force=True)
+    preprocessor = ColumnTransformer(
+        transformers=[('cat', OneHotEncoder(handle_unknown='ignore'), CATEGORICAL_FEATURES)],
+        remainder='passthrough',
+    )
+    label_encoder = LabelEncoder()
+    y = label_encoder.fit_transform(labels)
+    counts = np.bincount(y)
+    X_train_df, X_val_df, y_train, y_val = train_test_split(
+        frame[FEATURE_COLUMNS], y, test_size=validation_split, random_state=seed,
+        stratify=y if counts.min() >= 2 else None,
+    )
+    # Fit on the training split only so validation rows stay unseen
+    X_train = preprocessor.fit_transform(X_train_df)
+    scaler = StandardScaler(with_mean=False)
+    X_train = scaler.fit_transform(X_train)
+    X_val = scaler.transform(preprocessor.transform(X_val_df))
+    X_train = X_train.toarray() if hasattr(X_train, 'toarray') else np.asarray(X_train)
+    X_val = X_val.toarray() if hasattr(X_val, 'toarray') else np.asarray(X_val)
+    kmeans = KMeans(n_clusters=N_CLUSTERS, n_init=10, random_state=seed)
+    train_clusters = kmeans.fit_predict(X_train)
+    X_train = np.hstack([X_train, train_clusters.reshape(-1, 1)]).astype(np.float32)
+    X_val = np.hstack([X_val, kmeans.predict(X_val).reshape(-1, 1)]).astype(np.float32)
+
+    tf.keras.utils.set_random_seed(seed)
+    model = build_network(X_train.shape[1], len(label_encoder.classes_))
+
+    class Progress(tf.keras.callbacks.Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            logs = logs or {}
+            log.progress(10 + int(80 * (epoch + 1) / epochs),
+                         f"Epoch {epoch + 1}/{epochs}: val_accuracy {logs.get('val_accuracy', 0):.3f}")
+
+    history = model.fit(
+        X_train, y_train, validation_data=(X_val, y_val), epochs=epochs, batch_size=32, verbose=0,
+        callbacks=[
+            Progress(),
+            tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=15, restore_best_weights=True),
+            tf.keras.callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=5, min_lr=1e-5),
+        ],
+    )
+
+    log.progress(92, 'Saving artifacts', force=True)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {key: os.path.join(out_dir, name) for key, name in ARTIFACT_FILES.items()}
+    model.save(paths['model'])
+    joblib.dump(preprocessor, paths['preprocessor'])
+    joblib.dump(scaler, paths['scaler'])
+    joblib.dump(kmeans, paths['kmeans'])
+    joblib.dump(label_encoder, paths['label_encoder'])
+    export_npz(paths['model'], paths['numpy_model'])
+    write_manifest(paths['model'], paths['numpy_model'], loader='numpy', fmt='npz')
+
+    # Score the exported model: that is what the app will serve
+    probs = NumpyDenseModel(paths['numpy_model']).predict(X_val)
+    top3 = np.argsort(probs, axis=1)[:, ::-1][:, :3]
+    val_loss = float(-np.mean(np.log(np.clip(probs[np.arange(len(y_val)), y_val], 1e-7, 1.0))))
+    metrics = {
+        'val_accuracy': round(float(np.mean(top3[:, 0] == y_val)), 4),
+        'val_top3_accuracy': round(float(np.mean((top3 == y_val[:, None]).any(axis=1))), 4),
+        'val_loss': round(val_loss, 4),
+        'epochs': len(history.history.get('loss', [])),
+        'train_rows': int(len(y_train)),
+        'val_rows': int(len(y_val)),
+        'dataset_rows': int(len(dataset)),
+        'quiz_rows': int(len(quizzes)),
+        'classes': [str(c) for c in label_encoder.classes_],
+        'candidate_dir': os.path.abspath(out_dir),
+    }
+    with open(os.path.join(out_dir, 'metrics.json'), 'w', encoding='utf-8') as f:
+        json.dump(metrics, f, indent=2)
+    return metrics
+
+
+def publish_candidate(out_dir: str, registry_dir: str, metrics: dict, log_id: Optional[int] = None,
+                      activate: bool = False) -> dict:
+    """Publish a finished run's artifacts as a new registry version."""
+    from model_manifest import manifest_path
+    from model_registry import ModelRegistry
+
+    files = list(ARTIFACT_FILES.values()) + [
+        os.path.basename(manifest_path(ARTIFACT_FILES['model'])), 'metrics.json',
+    ]
+    metadata = {'source': 'retrain_v3', 'training_log_id': log_id, 'metrics': metrics}
+    return ModelRegistry(registry_dir).publish(out_dir, files=files, metadata=metadata, activate=activate)
+
+
+def lower_priority(threads: int, niceness: int) -> None:
+    """Keep the run off the CPUs serving requests; call before importing NumPy/TensorFlow."""
+    if niceness and hasattr(os, 'nice'):
+        try:
+            os.nice(niceness)
+        except OSError:
+            pass
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'):
+        os.environ[var] = str(threads)
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+
+def main(argv=None) -> int:
+    import argparse
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    model_dir = os.path.join(base_dir, 'data', 'trained_models', 'NailPolish_Model')
+    parser = argparse.ArgumentParser(description='Retrain the v3 nail polish model')
+    parser.add_argument('--log-id', type=int, default=None, help='modeltraininglog row to report into')
+    parser.add_argument('--out-dir', default=None)
+    parser.add_argument('--csv', default=os.path.join(model_dir, 'nail_polish_datasets.csv'))
+    parser.add_argument('--lock', default=None, help='Lock file to hold while the run lasts')
+    parser.add_argument('--lock-fd', type=int, default=None,
+                        help='Descriptor of --lock already locked by the parent process')
+    parser.add_argument('--registry-dir', default=None,
+                        help='Publish the result as a new version of this model folder (model_registry.py)')
+    parser.add_argument('--activate', action='store_true', help='Make the published version active')
+    parser.add_argument('--epochs', type=int, default=150)
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('RETRAIN_THREADS', '1')))
+    parser.add_argument('--nice', type=int, default=int(os.environ.get('RETRAIN_NICE', '10')))
+    args = parser.parse_args(argv)
+
+    lower_priority(args.threads, args.nice)
+    lock = None
+    if args.lock:
+        # An inherited descriptor is already locked; it is released when this process exits
+        lock = FileLock(args.lock, fd=args.lock_fd)
+        if not lock.acquire():
+            print(f"Another retrain holds {args.lock}")
+            return 2
+    engine = None
+    database_uri = os.environ.get('RETRAIN_DATABASE_URI')
+    if database_uri:
+        from sqlalchemy import create_engine
+        engine = create_engine(database_uri, pool_pre_ping=True)
+    log = TrainingLog(engine, args.log_id)
+    out_dir = args.out_dir or os.path.join(model_dir, 'candidates', time.strftime('run-%Y%m%d-%H%M%S'))
+    try:
+        log.update(status='Running', progress=0, message='Starting')
+        metrics = train(args.csv, out_dir, log, engine=engine, epochs=args.epochs)
+        summary = f"val_accuracy {metrics['val_accuracy']:.3f}, top-3 {metrics['val_top3_accuracy']:.3f}"
+        if args.registry_dir:
+            log.progress(97, 'Publishing version', force=True)
+            info = publish_candidate(out_dir, args.registry_dir, metrics, args.log_id, args.activate)
+            metrics['version'] = info['version']
+            summary += f"; published {info['version']}{' (active)' if args.activate else ''}"
+        log.finish('Success', summary, metrics)
+        print(json.dumps(metrics))
+        return 0
+    except Exception as e:
+        log.finish('Failed', f"{type(e).__name__}: {e}")
+        print(f"Retraining failed: {e}")
+        return 1
+    finally:
+        if lock is not None:
+            lock.release()
+        if engine is not None:
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,6 +7,8 @@ import pymysql
 from sqlalchemy import create_engine, text
 import os
 
+from stats_counters import seed_counters
+
 def create_database():
     """Create the glossify database if it doesn't exist"""
     try:
@@ -88,6 +90,7 @@ def create_tables():
 
         class Product(db.Model):
             __tablename__ = "products"
+            __table_args__ = (db.UniqueConstraint('hex_color', 'brand_name', name='uq_products_hex_brand'),)
             
             id = db.Column(db.Integer, primary_key=True, index=True)
             name = db.Column(db.String(100), nullable=False)
@@ -101,6 +104,7 @@ def create_tables():
 
         class QuizResult(db.Model):
             __tablename__ = "quiz_results"
+            __table_args__ = (db.Index('ix_quiz_results_user_time', 'user_id', 'created_at', 'id'),)
             
             id = db.Column(db.Integer, primary_key=True, index=True)
             user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -113,6 +117,10 @@ def create_tables():
 
         class NailShapeImage(db.Model):
             __tablename__ = "nailshapeimages"
+            __table_args__ = (
+                db.Index('ix_nailshapeimages_user_time', 'user_id', 'uploaded_at', 'id'),
+                db.Index('ix_nailshapeimages_image_path', 'image_path'),
+            )
             
             id = db.Column(db.Integer, primary_key=True, index=True)
             user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -120,9 +128,20 @@ def create_tables():
             predicted_shape = db.Column(db.String(50), nullable=True)
             confidence_score = db.Column(db.Float, nullable=True)
             uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+            content_hash = db.Column(db.String(64), nullable=True, index=True)
+
+        class ImagePrediction(db.Model):
+            __tablename__ = "image_predictions"
+            
+            content_hash = db.Column(db.String(64), primary_key=True)
+            predicted_shape = db.Column(db.String(50), nullable=True)
+            confidence_score = db.Column(db.Float, nullable=True)
+            model_version = db.Column(db.String(64), nullable=False)
+            created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
         class Recommendation(db.Model):
             __tablename__ = "recommendations"
+            __table_args__ = (db.Index('ix_recommendations_user_time', 'user_id', 'created_at', 'id'),)
             
             id = db.Column(db.Integer, primary_key=True, index=True)
             user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -131,6 +150,26 @@ def create_tables():
             recommendation_reason = db.Column(db.Text, nullable=True)
             created_at = db.Column(db.DateTime, default=datetime.utcnow)
         
+        class StatCounter(db.Model):
+            __tablename__ = "stats_counters"
+            
+            name = db.Column(db.String(120), primary_key=True)
+            value = db.Column(db.BigInteger, nullable=False, default=0)
+
+        class ModelTrainingLog(db.Model):
+            __tablename__ = "modeltraininglog"
+
+            id = db.Column(db.Integer, primary_key=True)
+            training_date = db.Column(db.Date)
+            training_time = db.Column(db.Time)
+            status = db.Column(db.String(20))
+            created_at = db.Column(db.DateTime, default=datetime.now)
+            progress = db.Column(db.Integer, nullable=True)
+            duration_seconds = db.Column(db.Float, nullable=True)
+            metrics = db.Column(db.Text, nullable=True)
+            message = db.Column(db.Text, nullable=True)
+            finished_at = db.Column(db.DateTime, nullable=True)
+
         with app.app_context():
             # Create all tables
             db.create_all()
@@ -159,6 +198,11 @@ def create_tables():
             else:
                 print("✅ Admin user already exists")
                 
+            # Dashboard totals are read from stats_counters, never from COUNT(*)
+            seeded = seed_counters(db.engine, StatCounter.__table__)
+            if seeded is not None:
+                print(f"✅ Seeded {seeded} stats counters")
+                
     except Exception as e:
         print(f"❌ Error creating tables: {e}")
 
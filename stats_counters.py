@@ -0,0 +1,146 @@
+import threading
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+# Row written when the table was rebuilt from the existing rows; never flushed to
+SEEDED_MARKER = '_seeded'
+
+
+class CounterBuffer:
+    """Accumulates counter increments in memory and folds them into a table.
+
+    Incrementing one hot counter row per insert would make every quiz and
+    upload transaction wait on the same row lock. Instead deltas are summed
+    here and written every ``flush_seconds`` with one multi-row upsert
+    (``value = value + delta``). A failed flush keeps the deltas for the
+    next attempt. ``pending()`` exposes what is not written yet so readers
+    can add it to the stored totals.
+    """
+
+    def __init__(self, engine_fn: Callable, table, flush_seconds: float = 2.0,
+                 name: str = 'stats-counters') -> None:
+        self.engine_fn = engine_fn
+        self.table = table
+        self.flush_seconds = max(0.05, float(flush_seconds))
+        self._deltas: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        self.flushes = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def add(self, deltas: Dict[str, int]) -> None:
+        with self._lock:
+            self._deltas.update(deltas)
+
+    def pending(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._deltas)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, Counter()
+            deltas = {k: v for k, v in deltas.items() if v}
+            if not deltas:
+                return
+            try:
+                with self.engine_fn().begin() as conn:
+                    conn.execute(self._upsert([{'name': k, 'value': v} for k, v in sorted(deltas.items())]))
+                self.flushes += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"Stats counter flush failed, will retry: {e}")
+                self.add(deltas)
+
+    def _upsert(self, rows):
+        dialect = self.engine_fn().dialect.name
+        if dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(self.table).values(rows)
+            return stmt.on_duplicate_key_update(value=self.table.c.value + stmt.inserted.value)
+        if dialect in ('sqlite', 'postgresql'):
+            if dialect == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(self.table).values(rows)
+            return stmt.on_conflict_do_update(
+                index_elements=[self.table.c.name],
+                set_={'value': self.table.c.value + stmt.excluded.value},
+            )
+        raise RuntimeError(f"No counter upsert for dialect {dialect}")
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._deltas)
+        return {'pending_counters': pending, 'flushes': self.flushes, 'errors': self.errors}
+
+
+def read_counters(conn, table, prefix: Optional[str] = None) -> Dict[str, int]:
+    from sqlalchemy import select  # local import
+    query = select(table.c.name, table.c.value)
+    if prefix:
+        query = query.where(table.c.name.like(prefix + '%'))
+    return {name: int(value) for name, value in conn.execute(query)}
+
+
+def shape_counter(shape) -> Optional[str]:
+    """Counter name for a predicted nail shape; None while it is still pending."""
+    if not shape or str(shape).lower() == 'pending':
+        return None
+    return f"shape:{str(shape).title()}"
+
+
+def count_existing_rows(conn) -> Counter:
+    """Counter totals computed with COUNT(*) over the tables they track."""
+    from sqlalchemy import text  # local import
+    totals = Counter()
+    for name, table in (('users', 'users'), ('quizzes', 'quiz_results'),
+                        ('recommendations', 'recommendations'), ('uploads', 'nailshapeimages')):
+        totals[name] = int(conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar() or 0)
+    for tone, count in conn.execute(text("SELECT skin_tone, COUNT(*) FROM quiz_results GROUP BY skin_tone")):
+        if tone:
+            totals[f"skin_tone:{tone}"] += int(count)
+    for shape, count in conn.execute(text("SELECT predicted_shape, COUNT(*) FROM nailshapeimages GROUP BY predicted_shape")):
+        shape_key = shape_counter(shape)
+        if shape_key:
+            totals[shape_key] += int(count)
+    return totals
+
+
+def seed_counters(engine, table) -> Optional[int]:
+    """Rebuild the counters from the existing rows once per database.
+
+    Guarded by the SEEDED_MARKER row rather than by the table being empty,
+    because a flush from a running process may create counter rows before
+    anyone seeds. Inserting the marker first makes concurrent seeders
+    collide on the primary key, so only one of them rebuilds. Returns the
+    number of counters written, or None when the table was already seeded.
+    """
+    from sqlalchemy import delete, insert, select  # local import
+    from sqlalchemy.exc import IntegrityError
+    try:
+        with engine.begin() as conn:
+            if conn.execute(select(table.c.name).where(table.c.name == SEEDED_MARKER)).first() is not None:
+                return None
+            conn.execute(insert(table).values(name=SEEDED_MARKER, value=1))
+            totals = count_existing_rows(conn)
+            conn.execute(delete(table).where(table.c.name != SEEDED_MARKER))
+            rows = [{'name': k, 'value': v} for k, v in sorted(totals.items()) if v]
+            if rows:
+                conn.execute(insert(table), rows)
+            return len(rows)
+    except IntegrityError:
+        return None
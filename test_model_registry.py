@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+from model_registry import ModelRegistry, ModelSlot
+
+
+def write(path, content):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    write(tmp_path / 'model.txt', 'flat')
+    return tmp_path
+
+
+def source(tmp_path, name, content):
+    directory = tmp_path / f'src-{name}'
+    directory.mkdir()
+    write(directory / 'model.txt', content)
+    return str(directory)
+
+
+def read_model(directory, version):
+    with open(os.path.join(directory, 'model.txt'), encoding='utf-8') as f:
+        content = f.read()
+    if content == 'broken':
+        raise ValueError('cannot load')
+    return content
+
+
+def slot_for(registry):
+    return ModelSlot(registry, read_model, lambda: 'base', poll_seconds=0)
+
+
+def test_publish_is_immutable_and_listed(model_dir, tmp_path):
+    registry = ModelRegistry(str(model_dir))
+    info = registry.publish(source(tmp_path, 'a', 'one'), version='v1')
+    assert set(info['files']) == {'model.txt'}
+    assert os.listdir(registry.versions_dir) == ['v1']  # no staging directory left behind
+    assert [v['version'] for v in registry.versions()] == ['v1']
+    assert registry.active_version() is None
+    with pytest.raises(FileExistsError):
+        registry.publish(source(tmp_path, 'b', 'two'), version='v1')
+
+
+def test_generated_versions_and_invalid_names(model_dir, tmp_path):
+    registry = ModelRegistry(str(model_dir))
+    info = registry.publish(source(tmp_path, 'a', 'one'), activate=True)
+    assert info['version'].startswith('v') and registry.active_version() == info['version']
+    for bad in ('../escape', '', '.hidden'):
+        with pytest.raises(ValueError):
+            registry.activate(bad)
+    with pytest.raises(FileNotFoundError):
+        registry.activate('v-missing')
+
+
+def test_verify_detects_changed_or_missing_files(model_dir, tmp_path):
+    registry = ModelRegistry(str(model_dir))
+    registry.publish(source(tmp_path, 'a', 'one'), version='v1')
+    registry.verify('v1')
+    write(os.path.join(registry.version_dir('v1'), 'model.txt'), 'tampered')
+    with pytest.raises(ValueError):
+        registry.verify('v1')
+    os.remove(os.path.join(registry.version_dir('v1'), 'model.txt'))
+    with pytest.raises(ValueError):
+        registry.verify('v1')
+
+
+def test_slot_serves_flat_artifacts_without_active_version(model_dir):
+    slot = slot_for(ModelRegistry(str(model_dir)))
+    assert slot.peek_version() == 'base'
+    serving = slot.get()
+    assert (serving.version, serving.model) == ('base', 'flat')
+
+
+def test_slot_swaps_on_activate_and_rolls_back(model_dir, tmp_path):
+    registry = ModelRegistry(str(model_dir))
+    registry.publish(source(tmp_path, 'a', 'one'), version='v1', activate=True)
+    registry.publish(source(tmp_path, 'b', 'two'), version='v2')
+    slot = slot_for(registry)
+    old = slot.get()
+    assert old.model == 'one'
+    assert slot.refresh() is False  # nothing changed
+
+    registry.activate('v2')
+    assert slot.refresh() is True
+    assert slot.get().model == 'two' and old.model == 'one'  # in-flight holders keep theirs
+
+    registry.activate('v1')
+    assert slot.refresh() is True and slot.get().version == 'v1'
+    assert slot.stats()['swaps'] == 2
+
+
+def test_failed_swap_keeps_serving_the_old_version(model_dir, tmp_path):
+    registry = ModelRegistry(str(model_dir))
+    registry.publish(source(tmp_path, 'a', 'one'), version='v1', activate=True)
+    registry.publish(source(tmp_path, 'b', 'broken'), version='v2')
+    registry.publish(source(tmp_path, 'c', 'three'), version='v3')
+    slot = slot_for(registry)
+    slot.get()
+
+    registry.activate('v2')
+    assert slot.refresh() is False
+    assert slot.get().version == 'v1' and 'v2' in slot.stats()['last_error']
+    assert slot.refresh() is False  # a failed target is not retried every poll
+
+    registry.activate('v3')
+    assert slot.refresh() is True and slot.get().model == 'three'
+    assert slot.stats()['last_error'] is None
+
+
+def test_corrupted_version_is_not_swapped_in(model_dir, tmp_path):
+    registry = ModelRegistry(str(model_dir))
+    registry.publish(source(tmp_path, 'a', 'one'), version='v1', activate=True)
+    registry.publish(source(tmp_path, 'b', 'two'), version='v2')
+    slot = slot_for(registry)
+    slot.get()
+    write(os.path.join(registry.version_dir('v2'), 'model.txt'), 'tampered')
+    registry.activate('v2')
+    assert slot.refresh() is False
+    assert slot.get().model == 'one'
@@ -0,0 +1,28 @@
+import io
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+Image = pytest.importorskip('PIL.Image')
+keras_utils = pytest.importorskip('keras.utils')
+
+import nail_shape_analyzer
+
+
+def test_matches_keras_load_img_for_rotated_jpeg(tmp_path):
+    rng = np.random.default_rng(0)
+    pixels = cv2.GaussianBlur((rng.random((301, 457, 3)) * 255).astype(np.uint8), (9, 9), 3)
+    image = Image.fromarray(pixels)
+    exif = image.getexif()
+    exif[0x0112] = 6  # Orientation: rotate 90 CW
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=90, exif=exif.tobytes())
+    path = tmp_path / 'hand.jpg'
+    path.write_bytes(buf.getvalue())
+
+    expected = keras_utils.img_to_array(keras_utils.load_img(str(path), target_size=(224, 224))) / 255.0
+    actual = nail_shape_analyzer.preprocess_image(nail_shape_analyzer.decode_image(buf.getvalue()))
+
+    assert actual.shape == expected.shape == (224, 224, 3)
+    np.testing.assert_array_equal(actual, expected.astype(np.float32))
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from recommendation_index import BATCH_CHUNK, DatasetIndex
+
+
+def scan(df, user_input, top_n):
+    """The per-request DataFrame scan the index replaced (ties kept in dataset order)."""
+    if df.empty:
+        return []
+    candidates = df
+    for col in ('skin_tone', 'finish_type', 'dress_color', 'occasion'):
+        desired = (user_input.get(col) or '').strip().lower()
+        if not desired or col not in candidates.columns:
+            continue
+        filtered = candidates[candidates[col].str.lower() == desired]
+        if not filtered.empty:
+            candidates = filtered
+    if 'age' in candidates.columns:
+        age = int(user_input.get('age', 0) or 0)
+        candidates = candidates.assign(age_diff=(candidates['age'] - age).abs())
+        candidates = candidates.sort_values(by='age_diff', kind='stable')
+    return [{'hex': row.get('recommended_hex_code', '#FF69B4'), 'brand': row.get('brand_name', 'Unknown')}
+            for _, row in candidates.head(top_n).iterrows()]
+
+
+def dataset(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'skin_tone': rng.choice(['Fair', 'Medium', 'Dark'], n),
+        'age': rng.integers(16, 60, n),
+        'finish_type': rng.choice(['Matte', 'Glossy'], n),
+        'dress_color': rng.choice(['Red', 'Blue', 'Black', 'White'], n),
+        'occasion': rng.choice(['Party', 'Work', 'Wedding'], n),
+        'recommended_hex_code': [f'#{i:06X}' for i in range(n)],
+        'brand_name': rng.choice(['Essie', 'OPI', 'Revlon'], n),
+    })
+
+
+def profiles(n=300, seed=1):
+    rng = np.random.default_rng(seed)
+    pick = lambda values: [None if v == '' else v for v in rng.choice(values, n)]
+    return [
+        {'skin_tone': s, 'age': int(a), 'finish_type': f, 'dress_color': d, 'occasion': o}
+        for s, a, f, d, o in zip(
+            pick(['fair', 'MEDIUM', ' dark ', 'olive', '']),
+            rng.integers(0, 90, n),
+            pick(['matte', 'glossy', 'shimmer', '']),
+            pick(['red', 'blue', 'green', '']),
+            pick(['party', 'work', '']),
+        )
+    ]
+
+
+@pytest.mark.parametrize('top_n', [1, 3, 10, 50])
+def test_query_matches_scan(top_n):
+    df = dataset()
+    index = DatasetIndex(df)
+    for user_input in profiles(150):
+        assert index.query(user_input, top_n) == scan(df, user_input, top_n)
+
+
+@pytest.mark.parametrize('top_n', [1, 3, 10])
+def test_query_batch_matches_query(top_n):
+    index = DatasetIndex(dataset())
+    inputs = profiles(BATCH_CHUNK * 2 + 7)  # spans several chunks
+    assert index.query_batch(inputs, top_n) == [index.query(p, top_n) for p in inputs]
+
+
+def test_without_age_column_keeps_dataset_order():
+    df = dataset().drop(columns=['age'])
+    index = DatasetIndex(df)
+    for user_input in profiles(50):
+        assert index.query(user_input, 3) == scan(df, user_input, 3)
+        assert index.query_batch([user_input], 3) == [scan(df, user_input, 3)]
+
+
+def test_empty_dataset():
+    index = DatasetIndex(dataset().head(0))
+    assert index.query({'age': 30}, 3) == []
+    assert index.query_batch([{'age': 30}, {}], 3) == [[], []]
@@ -0,0 +1,155 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from file_lock import FileLock
+from upload_maintenance import FRESH_SECONDS, UploadMaintenance
+import upload_store
+
+HASH_A = 'a' * 64
+HASH_B = 'b' * 64
+OLD = time.time() - 10 * 86400
+
+
+@pytest.fixture
+def env(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE nailshapeimages (id INTEGER PRIMARY KEY, user_id INTEGER, '
+                          'image_path VARCHAR(255), uploaded_at DATETIME)'))
+    upload_folder = tmp_path / 'uploads'
+    upload_folder.mkdir()
+    return engine, str(upload_folder), str(tmp_path / 'state')
+
+
+def put(folder, rel, size=1000, mtime=OLD):
+    path = os.path.join(folder, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def add_row(engine, user_id, image_path, days_ago):
+    with engine.begin() as conn:
+        conn.execute(text('INSERT INTO nailshapeimages (user_id, image_path, uploaded_at) VALUES (:u, :p, :t)'),
+                     {'u': user_id, 'p': image_path, 't': datetime.utcnow() - timedelta(days=days_ago)})
+
+
+def rows(engine):
+    with engine.connect() as conn:
+        return sorted(r[0] for r in conn.execute(text('SELECT image_path FROM nailshapeimages')))
+
+
+def maintenance(env, **kwargs):
+    engine, upload_folder, state_dir = env
+    return UploadMaintenance(lambda: engine, upload_folder, state_dir=state_dir, interval_seconds=0, **kwargs)
+
+
+def test_default_pass_only_removes_stale_parts(env):
+    engine, upload_folder, _state = env
+    sample = put(upload_folder, '20251008_160740_hand.jpg')
+    referenced = put(upload_folder, 'legacy.jpg')
+    add_row(engine, 1, 'uploads/legacy.jpg', 30)
+    stale = put(upload_folder, upload_store.PART_PREFIX + 'dead.part')
+    fresh = put(upload_folder, upload_store.PART_PREFIX + 'live.part', mtime=time.time())
+
+    report = maintenance(env).run()
+
+    assert report['stale_parts']['count'] == 1
+    assert report['orphans']['count'] == 0 and report['sharded']['count'] == 0
+    assert os.path.exists(sample) and os.path.exists(referenced) and os.path.exists(fresh)
+    assert not os.path.exists(stale)
+    assert rows(engine) == ['uploads/legacy.jpg']
+
+
+def test_orphans_after_grace(env):
+    engine, upload_folder, _state = env
+    old_orphan = put(upload_folder, 'orphan.jpg')
+    new_orphan = put(upload_folder, 'queued.jpg', mtime=time.time() - FRESH_SECONDS / 2)
+    kept = put(upload_folder, upload_store.shard_name(HASH_A + '.webp'))
+    add_row(engine, 1, 'uploads/' + upload_store.shard_name(HASH_A + '.webp'), 1)
+
+    report = maintenance(env, orphan_grace_seconds=60).run()
+
+    assert report['orphans']['count'] == 1
+    assert not os.path.exists(old_orphan)
+    assert os.path.exists(new_orphan) and os.path.exists(kept)
+
+
+def test_queued_rows_protect_old_files(env):
+    engine, upload_folder, _state = env
+    spilled = put(upload_folder, 'spilled.jpg')
+    orphan = put(upload_folder, 'orphan.jpg')
+
+    report = maintenance(env, orphan_grace_seconds=60, budget_bytes=1, shard_flat=True,
+                         pending_paths=lambda: {'uploads/spilled.jpg'}).run()
+
+    assert report['queued'] == 1 and report['orphans']['count'] == 1
+    assert report['over_budget']['count'] == 0 and report['sharded']['count'] == 0
+    assert os.path.exists(spilled) and not os.path.exists(orphan)
+
+
+def test_ttl_quota_and_budget(env):
+    engine, upload_folder, _state = env
+    for name, user_id, days in [('expired.jpg', 1, 20), ('u2_old.jpg', 2, 5), ('u2_new.jpg', 2, 1),
+                                ('shared.jpg', 2, 3), ('u3.jpg', 3, 2)]:
+        put(upload_folder, name)
+        add_row(engine, user_id, 'uploads/' + name, days)
+    add_row(engine, 3, 'uploads/shared.jpg', 2)
+
+    report = maintenance(env, ttl_days=7, user_quota_bytes=2000).run()
+
+    assert report['expired']['count'] == 1
+    # user 2 keeps its two newest; shared.jpg is within user 3's quota, so it stays
+    assert report['over_quota']['count'] == 1
+    assert sorted(os.listdir(upload_folder)) == ['shared.jpg', 'u2_new.jpg', 'u3.jpg']
+
+    report = maintenance(env, budget_bytes=2000).run()
+    assert report['over_budget']['count'] == 2 and report['bytes_after'] <= 2000 * 0.9
+    assert os.listdir(upload_folder) == ['u2_new.jpg']
+    assert len(rows(engine)) == 6  # rows keep the prediction history
+
+
+def test_shard_flat_moves_files_and_rows(env):
+    engine, upload_folder, _state = env
+    put(upload_folder, HASH_B + '.webp')
+    put(upload_folder, HASH_B + '_thumb.webp')
+    add_row(engine, 1, f'uploads/{HASH_B}.webp', 1)
+    add_row(engine, 2, f'uploads/{HASH_B}.webp', 2)
+
+    dry = maintenance(env, shard_flat=True).run(dry_run=True)
+    assert dry['sharded']['count'] == 1
+    assert os.path.exists(os.path.join(upload_folder, HASH_B + '.webp'))
+
+    maintenance(env, shard_flat=True).run()
+    sharded = upload_store.shard_name(HASH_B + '.webp')
+    assert os.path.exists(os.path.join(upload_folder, sharded))
+    assert os.path.exists(os.path.join(upload_folder, upload_store.thumbnail_name(sharded)))
+    assert not os.path.exists(os.path.join(upload_folder, HASH_B + '.webp'))
+    assert rows(engine) == ['uploads/' + sharded] * 2
+
+
+def test_dry_run_changes_nothing(env):
+    engine, upload_folder, state_dir = env
+    orphan = put(upload_folder, 'orphan.jpg')
+    report = maintenance(env, orphan_grace_seconds=60).run(dry_run=True)
+    assert report['dry_run'] and report['orphans']['samples'] == [orphan]
+    assert os.path.exists(orphan)
+    assert os.path.exists(os.path.join(state_dir, 'last_dry_run.json'))
+    assert not os.path.exists(os.path.join(state_dir, 'last_report.json'))
+
+
+def test_pass_skipped_while_locked(env):
+    job = maintenance(env)
+    lock = FileLock(job.lock_path)
+    assert lock.acquire()
+    try:
+        assert job.run() is None
+    finally:
+        lock.release()
+    assert job.run() is not None
@@ -0,0 +1,172 @@
+import os
+import struct
+import zlib
+
+import pytest
+
+import upload_store
+from upload_store import ImageHeader, UploadRejected, UploadSink
+
+
+def jpeg(width, height, app_bytes=100):
+    app0 = b'\xff\xe0' + struct.pack('>H', app_bytes + 2) + b'\x00' * app_bytes
+    sof0 = b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\x00'
+    return b'\xff\xd8' + app0 + b'\xff\xff' + sof0 + b'\xff\xda' + b'\x00' * 64 + b'\xff\xd9'
+
+
+def png(width, height):
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    chunk = struct.pack('>I', len(ihdr)) + b'IHDR' + ihdr + struct.pack('>I', zlib.crc32(b'IHDR' + ihdr))
+    return b'\x89PNG\r\n\x1a\n' + chunk + b'\x00' * 32
+
+
+def webp(kind, width, height):
+    if kind == b'VP8X':
+        payload = b'\x00' * 4 + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little')
+    elif kind == b'VP8 ':
+        payload = b'\x00' * 3 + b'\x9d\x01\x2a' + struct.pack('<HH', width, height)
+    else:
+        bits = (width - 1) | ((height - 1) << 14)
+        payload = b'\x2f' + bits.to_bytes(4, 'little')
+    body = b'WEBP' + kind + struct.pack('<I', len(payload)) + payload + b'\x00' * 16
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def parse(data, chunk_size=None):
+    header = ImageHeader()
+    step = chunk_size or len(data)
+    for start in range(0, len(data), step):
+        header.feed(data[start:start + step])
+    return header
+
+
+@pytest.mark.parametrize('data, kind', [
+    (jpeg(640, 480), 'jpeg'),
+    (png(640, 480), 'png'),
+    (webp(b'VP8X', 640, 480), 'webp'),
+    (webp(b'VP8 ', 640, 480), 'webp'),
+    (webp(b'VP8L', 640, 480), 'webp'),
+    (b'GIF89a' + struct.pack('<HH', 640, 480) + b'\x00' * 8, 'gif'),
+    (b'BM' + b'\x00' * 16 + struct.pack('<ii', 640, -480) + b'\x00' * 8, 'bmp'),
+])
+@pytest.mark.parametrize('chunk_size', [None, 1, 7])
+def test_header_dimensions_in_any_chunking(data, kind, chunk_size):
+    header = parse(data, chunk_size)
+    assert (header.kind, header.width, header.height) == (kind, 640, 480)
+
+
+def test_jpeg_segments_before_the_frame_are_skipped_not_buffered():
+    header = parse(jpeg(32, 16, app_bytes=60000), chunk_size=4096)
+    assert (header.width, header.height) == (32, 16)
+    assert len(header._buf) == 0
+
+
+@pytest.mark.parametrize('data', [
+    png(640, 480)[:20],
+    jpeg(640, 480)[:40],
+    webp(b'VP8X', 640, 480)[:20],
+    b'\xff\xd8',
+])
+def test_truncated_headers_are_not_done(data):
+    assert not parse(data, 3).done
+
+
+@pytest.mark.parametrize('data, status', [
+    (b'<html><body>not an image</body></html>', 415),
+    (b'%PDF-1.7\n' + b'\x00' * 40, 415),
+    (b'\x89PNG\r\n\x1a\n' + b'\x00\x00\x00\x0dXXXX' + b'\x00' * 16, 400),   # no IHDR
+    (b'\xff\xd8\xff\xda' + b'\x00' * 40, 400),                                # scan before frame header
+    (b'\xff\xd8\xff\xe0\x00\x01' + b'\x00' * 40, 400),                        # impossible segment length
+    (b'RIFF\x00\x00\x00\x00WEBPVP9 ' + b'\x00' * 20, 400),                    # unknown WebP chunk
+    (b'RIFF\x00\x00\x00\x00WEBPVP8 ' + b'\x00' * 7 + b'\x00\x00\x00' + b'\x00' * 8, 400),  # bad VP8 tag
+    (png(0, 480), 400),                                                       # zero width
+])
+def test_fake_or_corrupt_headers_are_rejected(data, status):
+    with pytest.raises(UploadRejected) as info:
+        parse(data, 5)
+    assert info.value.status == status
+
+
+def test_header_without_dimensions_gives_up_at_the_limit():
+    data = b'\xff\xd8' + (b'\xff\xe0\xff\xff' + b'\x00' * 0xfffd) * 5
+    with pytest.raises(UploadRejected):
+        parse(data, 65536)
+
+
+def sink_for(folder, data, max_bytes=10_000, max_pixels=0, chunk=64):
+    sink = UploadSink(str(folder), max_bytes=max_bytes, max_pixels=max_pixels)
+    for start in range(0, len(data), chunk):
+        sink.write(data[start:start + chunk])
+    return sink
+
+
+def part_files(folder):
+    return [n for n in os.listdir(folder) if n.startswith(upload_store.PART_PREFIX)]
+
+
+def test_byte_limit_rejects_while_streaming(tmp_path):
+    with pytest.raises(UploadRejected) as info:
+        sink_for(tmp_path, png(10, 10) + b'\x00' * 5000, max_bytes=1000)
+    assert info.value.status == 413
+    assert part_files(tmp_path) == []
+    with pytest.raises(UploadRejected):
+        UploadSink(str(tmp_path), max_bytes=1000, content_length=5000)
+
+
+def test_pixel_limit_uses_the_declared_size(tmp_path):
+    with pytest.raises(UploadRejected) as info:
+        sink_for(tmp_path, png(5000, 5000), max_pixels=1_000_000)
+    assert info.value.status == 413 and '5000x5000' in str(info.value)
+    assert part_files(tmp_path) == []
+    sink_for(tmp_path, png(1000, 1000), max_pixels=1_000_000).discard()
+
+
+def test_truncated_upload_fails_on_finish(tmp_path):
+    sink = sink_for(tmp_path, png(10, 10)[:20])
+    with pytest.raises(UploadRejected):
+        sink.finish()
+    assert part_files(tmp_path) == []
+
+
+def test_commit_is_content_addressed_and_deduplicated(tmp_path):
+    data = png(64, 48)
+    first = sink_for(tmp_path, data)
+    filename, content_hash = first.commit()
+    assert filename == upload_store.shard_name(content_hash + '.png')
+    assert filename.startswith(f"{content_hash[:2]}/{content_hash[2:4]}/")
+    with open(tmp_path / filename, 'rb') as f:
+        assert f.read() == data
+
+    second = sink_for(tmp_path, data, chunk=7)
+    assert second.commit() == (filename, content_hash)
+    assert part_files(tmp_path) == []
+    assert sink_for(tmp_path, png(65, 48)).commit()[0] != filename
+
+
+def test_store_without_resizing_keeps_the_original(tmp_path):
+    sink = sink_for(tmp_path, jpeg(20, 10))
+    filename, content_hash = upload_store.store(sink, max_side=0)
+    assert filename.endswith(content_hash + '.jpg') and os.path.exists(tmp_path / filename)
+
+
+def test_store_writes_bounded_working_copy_and_thumbnail(tmp_path):
+    cv2 = pytest.importorskip('cv2')
+    import numpy as np
+    ok, encoded = cv2.imencode('.png', np.full((300, 600, 3), 128, np.uint8))
+    sink = sink_for(tmp_path, encoded.tobytes(), max_bytes=1_000_000, chunk=4096)
+    filename, _hash = upload_store.store(sink, working_format='jpeg', max_side=200, thumb_side=50)
+    assert filename.endswith('.jpg')
+    working = cv2.imread(str(tmp_path / filename))
+    thumb = cv2.imread(str(tmp_path / upload_store.thumbnail_name(filename)))
+    assert working.shape[:2] == (100, 200) and thumb.shape[:2] == (25, 50)
+    assert part_files(tmp_path) == []  # the original is not kept by default
+
+
+def test_remove_stale_parts_keeps_fresh_ones(tmp_path):
+    stale = tmp_path / (upload_store.PART_PREFIX + 'old.part')
+    fresh = tmp_path / (upload_store.PART_PREFIX + 'new.part')
+    stale.write_bytes(b'x')
+    fresh.write_bytes(b'x')
+    os.utime(stale, (0, 0))
+    assert upload_store.remove_stale_parts(str(tmp_path), max_age_seconds=60) == 1
+    assert part_files(tmp_path) == [fresh.name]
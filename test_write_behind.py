@@ -0,0 +1,219 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import StaticPool
+
+from file_lock import FileLock
+from write_behind import WriteBehindQueue, spilled_values
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Database:
+    """In-memory SQLite engine that can be switched off to simulate an outage."""
+
+    def __init__(self):
+        self.engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        metadata = MetaData()
+        self.tables = {
+            'quiz': Table('quiz', metadata, Column('x', Integer, nullable=False)),
+            'recs': Table('recs', metadata, Column('x', Integer), Column('note', String(10))),
+        }
+        metadata.create_all(self.engine)
+        self.down = False
+
+    def __call__(self):
+        if self.down:
+            raise OperationalError('connect', {}, ConnectionError('database is down'))
+        return self.engine
+
+    def values(self, table='quiz'):
+        with self.engine.connect() as conn:
+            return sorted(r[0] for r in conn.execute(text(f'SELECT x FROM {table}')))
+
+
+@pytest.fixture
+def db():
+    return Database()
+
+
+def make_queue(db, spill_dir, **kwargs):
+    kwargs.setdefault('flush_ms', 10_000)  # tests flush explicitly
+    return WriteBehindQueue(db, db.tables, spill_dir=str(spill_dir), **kwargs)
+
+
+def spill_files(spill_dir):
+    return sorted(glob.glob(os.path.join(str(spill_dir), 'spill-*.jsonl')))
+
+
+def test_flush_writes_units_and_reports_them(db, tmp_path):
+    flushed = []
+    queue = make_queue(db, tmp_path, on_flushed=flushed.append)
+    queue.submit([('quiz', {'x': 1}), ('recs', {'x': 1, 'note': 'a'})])
+    queue.submit([('quiz', {'x': 2})])
+    queue.flush()
+    assert db.values('quiz') == [1, 2] and db.values('recs') == [1]
+    assert len(flushed) == 2
+    assert queue.stats()['written_rows'] == 3 and queue.stats()['pending_rows'] == 0
+    queue.close()
+
+
+def test_batch_rows_wakes_the_flusher(db, tmp_path):
+    queue = make_queue(db, tmp_path, batch_rows=2)
+    queue.submit([('quiz', {'x': 1}), ('quiz', {'x': 2})])
+    deadline = time.monotonic() + 5
+    while db.values() != [1, 2] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert db.values() == [1, 2]
+    queue.close()
+
+
+def test_rejected_unit_is_dropped_without_losing_the_batch(db, tmp_path):
+    rejected = []
+    queue = make_queue(db, tmp_path, on_rejected=rejected.append)
+    queue.submit([('quiz', {'x': 1})])
+    queue.submit([('quiz', {'x': None})])  # NOT NULL violation
+    queue.submit([('quiz', {'x': 3})])
+    queue.flush()
+    assert db.values() == [1, 3]
+    assert rejected == [[('quiz', {'x': None})]]
+    assert queue.stats()['dropped_rows'] == 1
+    queue.close()
+
+
+def test_outage_spills_and_replays_when_back(db, tmp_path):
+    db.down = True
+    queue = make_queue(db, tmp_path)
+    queue.submit([('quiz', {'x': 1})])
+    queue.flush()
+    assert len(spill_files(tmp_path)) == 1 and queue.stats()['db_healthy'] is False
+
+    db.down = False
+    queue._retry_at = 0.0  # skip the backoff
+    queue.submit([('quiz', {'x': 2})])
+    queue.flush()
+    assert db.values() == [1, 2]
+    assert spill_files(tmp_path) == []
+    assert queue.stats()['replayed_rows'] == 1
+    queue.close()
+
+
+def test_overflow_spills_instead_of_blocking(db, tmp_path):
+    queue = make_queue(db, tmp_path, max_rows=2)
+    queue.submit([('quiz', {'x': 1}), ('quiz', {'x': 2})])
+    queue.submit([('quiz', {'x': 3})])
+    assert len(spill_files(tmp_path)) == 1 and queue.stats()['pending_rows'] == 2
+    queue.flush()
+    assert db.values() == [1, 2, 3]
+    queue.close()
+
+
+def test_pending_paths_cover_queued_and_spilled_rows(db, tmp_path):
+    queue = make_queue(db, tmp_path)
+    queue.submit([('quiz', {'x': 1}), ('recs', {'x': 1, 'note': 'queued'})])
+    assert queue.pending_paths('recs', 'note') == {'queued'}
+
+    db.down = True
+    queue.flush()
+    queue.submit([('recs', {'x': 2, 'note': 'fresh'})])
+    assert queue.pending_paths('recs', 'note') == {'queued', 'fresh'}
+    assert spilled_values(str(tmp_path), 'recs', 'note') == {'queued'}
+
+    db.down = False
+    queue._retry_at = 0.0
+    queue.flush()
+    assert queue.pending_paths('recs', 'note') == set()
+    queue.close()
+
+
+def test_spilled_rows_survive_a_restart(db, tmp_path):
+    from datetime import datetime
+    db.down = True
+    queue = make_queue(db, tmp_path)
+    when = datetime(2025, 1, 2, 3, 4, 5)
+    queue.submit([('recs', {'x': 7, 'note': when})])
+    queue.close()
+    assert len(spill_files(tmp_path)) == 1
+    with open(spill_files(tmp_path)[0], encoding='utf-8') as f:
+        assert json.loads(f.readline()) == [['recs', {'x': 7, 'note': {'__datetime__': when.isoformat()}}]]
+
+    db.down = False
+    restarted = make_queue(db, tmp_path)
+    restarted.flush()
+    assert db.values('recs') == [7]
+    restarted.close()
+
+
+def test_close_spills_what_is_still_queued(db, tmp_path):
+    queue = make_queue(db, tmp_path)
+    db.down = True
+    queue.submit([('quiz', {'x': 1})])
+    queue.close()
+    assert len(spill_files(tmp_path)) == 1
+    with pytest.raises(RuntimeError):
+        queue.submit([('quiz', {'x': 2})])
+
+
+def write_claim(spill_dir, token, x):
+    path = os.path.join(str(spill_dir), f'spill-0000000000000{x}-1-1.jsonl.claimed-{token}')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps([['quiz', {'x': x}]]) + '\n')
+    return path
+
+
+def test_claims_of_a_live_queue_are_left_alone(db, tmp_path):
+    owner = make_queue(db, tmp_path)
+    claimed = write_claim(tmp_path, owner._claim_token, 1)
+    other = make_queue(db, tmp_path)
+    other.flush()
+    assert os.path.exists(claimed) and db.values() == []
+    other.close()
+    owner.close()
+
+
+def test_claims_without_a_held_lock_are_replayed(db, tmp_path):
+    # A queue that died keeps its lock file but no longer holds the lock
+    dead = FileLock(os.path.join(str(tmp_path), 'claim-dead.lock'))
+    assert dead.acquire()
+    dead.release()
+    write_claim(tmp_path, 'dead', 1)
+    # A claim from before claim tokens, named after our own (reused) pid
+    write_claim(tmp_path, str(os.getpid()), 2)
+    queue = make_queue(db, tmp_path)
+    queue.flush()
+    assert db.values() == [1, 2]
+    assert glob.glob(os.path.join(str(tmp_path), '*.claimed-*')) == []
+    assert not os.path.exists(os.path.join(str(tmp_path), 'claim-dead.lock'))
+    queue.close()
+
+
+def test_claims_of_a_killed_process_are_replayed(db, tmp_path):
+    script = (
+        'import os, sys, time\n'
+        'from write_behind import WriteBehindQueue\n'
+        'q = WriteBehindQueue(lambda: None, {}, spill_dir=sys.argv[1], flush_ms=100000)\n'
+        'print(q._claim_token, flush=True)\n'
+        'time.sleep(60)\n'
+    )
+    child = subprocess.Popen([sys.executable, '-c', script, str(tmp_path)], cwd=HERE,
+                             stdout=subprocess.PIPE, text=True)
+    try:
+        token = child.stdout.readline().strip()
+        write_claim(tmp_path, token, 5)
+        queue = make_queue(db, tmp_path)
+        queue.flush()
+        assert db.values() == []  # the child still holds its claim lock
+    finally:
+        child.kill()
+        child.wait()
+        child.stdout.close()
+    queue.flush()
+    assert db.values() == [5]
+    queue.close()
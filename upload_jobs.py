@@ -0,0 +1,116 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# Job lifecycle states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'error'
+FINISHED_STATES = (DONE, FAILED)
+
+
+class JobRegistry:
+    """Runs background classification jobs and tracks their status in memory.
+
+    Every status change bumps the job's ``version`` and wakes waiters, which
+    is what the server-sent-events endpoint blocks on. Finished jobs are kept
+    for ``retention_seconds`` so clients can still poll for the result.
+    Only the process that ran a job knows it; callers that need status from
+    any worker must also keep it somewhere shared.
+    """
+
+    def __init__(self, max_workers: int = 2, retention_seconds: float = 3600.0,
+                 max_jobs: int = 10000) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)),
+                                            thread_name_prefix='upload-job')
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._cond = threading.Condition()
+        self.retention_seconds = float(retention_seconds)
+        self.max_jobs = int(max_jobs)
+
+    def submit(self, fn: Callable[..., Any], *args, job_id: Optional[str] = None, **kwargs) -> str:
+        """Queue ``fn(*args, **kwargs)``; its return value becomes the job result.
+
+        ``job_id`` lets the caller pick an id other processes can resolve too.
+        """
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        with self._cond:
+            self._prune(now)
+            self._jobs[job_id] = {
+                'id': job_id,
+                'status': QUEUED,
+                'result': None,
+                'error': None,
+                'created_at': now,
+                'updated_at': now,
+                'version': 0,
+            }
+        self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _update(self, job_id: str, **fields) -> None:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            job['updated_at'] = time.time()
+            job['version'] += 1
+            self._cond.notify_all()
+
+    def _run(self, job_id: str, fn, args, kwargs) -> None:
+        self._update(job_id, status=RUNNING)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._update(job_id, status=FAILED, error=str(e))
+        else:
+            self._update(job_id, status=DONE, result=result)
+
+    def _prune(self, now: float) -> None:
+        expired = [
+            jid for jid, job in self._jobs.items()
+            if job['status'] in FINISHED_STATES and now - job['updated_at'] > self.retention_seconds
+        ]
+        for jid in expired:
+            del self._jobs[jid]
+        # Hard cap: drop the oldest finished jobs first
+        if len(self._jobs) >= self.max_jobs:
+            finished = sorted(
+                (job['updated_at'], jid) for jid, job in self._jobs.items()
+                if job['status'] in FINISHED_STATES
+            )
+            for _ts, jid in finished[:len(self._jobs) - self.max_jobs + 1]:
+                del self._jobs[jid]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_id: str, seen_version: int, timeout: float) -> Optional[Dict[str, Any]]:
+        """Block until the job changes past ``seen_version`` or ``timeout`` expires."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None or job['version'] > seen_version:
+                    return dict(job) if job else None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return dict(job)
+                self._cond.wait(remaining)
+
+    def stats(self) -> dict:
+        with self._cond:
+            counts: Dict[str, int] = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return {'tracked': len(self._jobs), 'by_status': counts}
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
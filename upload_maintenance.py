@@ -0,0 +1,447 @@
+"""Retention, quotas and sharding for the upload folder.
+
+One pass of ``UploadMaintenance.run()`` scans the upload folder (and the
+originals folder, when originals are kept), reads which files
+``nailshapeimages`` rows still point at and then, in this order:
+
+- deletes part files of interrupted uploads older than ``FRESH_SECONDS``
+- deletes orphans (no row refers to them) older than
+  ``orphan_grace_seconds``, when that is set
+- deletes images whose newest upload is older than ``ttl_days``
+- trims each user to ``user_quota_bytes``, oldest images first; an image
+  shared by several users goes only when it is over quota for all of them
+- deletes the oldest images until the tree fits ``budget_bytes`` again
+  (down to ``BUDGET_LOW_WATERMARK`` of it, so passes do not thrash)
+- with ``shard_flat``, moves flat files into ``ab/cd/`` shard directories
+  (see ``upload_store.shard_name``) and points their rows at the new path
+
+Images whose row has not reached the database yet (``pending_paths``
+returns the paths still queued or spilled by the write-behind queue) are
+left alone by every step, however old the file is.
+
+An image is its working copy together with its thumbnail and original, so
+they are removed together. Rows are kept: they hold the prediction
+history, only the picture is gone. ``dry_run=True`` reports what a pass
+would do without touching anything.
+
+Everything that can delete or move an existing file is off by default:
+the upload folder may hold files that no row knows about (sample images
+checked into the repository, a fresh development database), and a default
+pass must not touch them.
+"""
+import calendar
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from file_lock import FileLock
+import upload_store
+
+BUDGET_LOW_WATERMARK = 0.9
+# Files younger than this may still have their row in the write-behind queue of
+# another process; rows this process can see are covered by pending_paths
+FRESH_SECONDS = 3600
+ROW_BATCH = 5000
+REPORT_SAMPLES = 20
+_CATEGORIES = ('stale_parts', 'orphans', 'expired', 'over_quota', 'over_budget')
+
+
+def _nail_images_table():
+    from sqlalchemy import column, table  # local import
+    return table('nailshapeimages', column('id'), column('user_id'), column('image_path'), column('uploaded_at'))
+
+
+def _timestamp(value) -> Optional[float]:
+    # uploaded_at is stored as naive UTC (datetime.utcnow); SQLite hands back strings
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        return float(calendar.timegm(value.timetuple()))
+    return None
+
+
+def _image_key(name: str) -> str:
+    """Files of one image share a key: the content hash, or the legacy name without '_thumb'."""
+    base = os.path.basename(name)
+    if upload_store.HASH_NAME_RE.match(base):
+        return base[:64]
+    root, ext = os.path.splitext(base)
+    if root.endswith(upload_store.THUMB_SUFFIX):
+        root = root[:-len(upload_store.THUMB_SUFFIX)]
+    return root + ext
+
+
+class _Image:
+    __slots__ = ('files', 'size', 'mtime', 'uploaded', 'users', 'flat', 'queued')
+
+    def __init__(self) -> None:
+        self.files: List[tuple] = []  # (root, path relative to it)
+        self.size = 0
+        self.mtime = 0.0
+        self.uploaded: Optional[float] = None
+        self.users: set = set()
+        self.flat = False
+        self.queued = False  # a row for it is still in the write-behind queue
+
+    @property
+    def label(self) -> str:
+        """Path of the working copy (not the thumbnail), for reports."""
+        root, rel = min(self.files, key=lambda f: (upload_store.THUMB_SUFFIX in f[1], f[1]))
+        return os.path.join(root, rel)
+
+    @property
+    def age_time(self) -> float:
+        return self.uploaded if self.uploaded is not None else self.mtime
+
+
+class UploadMaintenance:
+    """Keeps the upload folder within its budget; runs every ``interval_seconds`` on a daemon thread.
+
+    Passes are serialized across worker processes with a file lock (see
+    file_lock.py) in ``state_dir``, and a pass is skipped when another process finished one
+    less than ``interval_seconds`` ago. The last report is kept in
+    ``state_dir/last_report.json`` (``last_dry_run.json`` for dry runs).
+    Limits set to 0 are off, and so are they by default.
+    """
+
+    def __init__(self, engine_fn: Callable, upload_folder: str, originals_folder: Optional[str] = None,
+                 url_prefix: str = 'uploads/', budget_bytes: int = 0, ttl_days: float = 0,
+                 user_quota_bytes: int = 0, orphan_grace_seconds: float = 0, shard_flat: bool = False,
+                 state_dir: Optional[str] = None, interval_seconds: float = 3600,
+                 pending_paths: Optional[Callable[[], set]] = None,
+                 name: str = 'upload-maintenance') -> None:
+        self.engine_fn = engine_fn
+        self.upload_folder = upload_folder
+        self.originals_folder = originals_folder
+        self.url_prefix = url_prefix
+        self.budget_bytes = int(budget_bytes)
+        self.ttl_days = float(ttl_days)
+        self.user_quota_bytes = int(user_quota_bytes)
+        self.orphan_grace_seconds = float(orphan_grace_seconds)
+        self.shard_flat = bool(shard_flat)
+        self.state_dir = state_dir or os.path.join('data', 'upload_maintenance')
+        self.interval_seconds = float(interval_seconds)
+        self.pending_paths = pending_paths
+        self.name = name
+        self.runs = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.join(self.state_dir, '.lock')
+
+    @property
+    def report_path(self) -> str:
+        return os.path.join(self.state_dir, 'last_report.json')
+
+    @property
+    def dry_run_report_path(self) -> str:
+        return os.path.join(self.state_dir, 'last_dry_run.json')
+
+    # -- scheduling ------------------------------------------------------
+
+    def start(self) -> None:
+        if self.interval_seconds <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        # First check soon after startup so short-lived workers still get passes in
+        delay = min(60.0, self.interval_seconds)
+        while not self._stop.wait(delay):
+            delay = self.interval_seconds
+            try:
+                if time.time() - self._last_report_mtime() >= self.interval_seconds * 0.9:
+                    self.run()
+            except Exception as e:
+                print(f"{self.name}: pass failed: {e}")
+
+    def _last_report_mtime(self) -> float:
+        try:
+            return os.path.getmtime(self.report_path)
+        except OSError:
+            return 0.0
+
+    def close(self) -> None:
+        self._stop.set()
+
+    def last_report(self, dry_run: bool = False) -> Optional[dict]:
+        try:
+            with open(self.dry_run_report_path if dry_run else self.report_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def stats(self) -> dict:
+        report = self.last_report() or {}
+        return {
+            'interval_seconds': self.interval_seconds,
+            'runs': self.runs,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'last_finished_at': report.get('finished_at'),
+            'bytes_before': report.get('bytes_before'),
+            'bytes_after': report.get('bytes_after'),
+        }
+
+    # -- one pass --------------------------------------------------------
+
+    def run(self, dry_run: bool = False) -> Optional[dict]:
+        """One maintenance pass; returns its report, or None if another pass holds the lock."""
+        lock = FileLock(self.lock_path)
+        if not lock.acquire():
+            return None
+        try:
+            report = self._run(dry_run)
+            self.runs += 1
+            self.last_error = None
+            os.makedirs(self.state_dir, exist_ok=True)
+            upload_store.write_atomic(self.dry_run_report_path if dry_run else self.report_path,
+                                      json.dumps(report, indent=2).encode('utf-8'))
+            return report
+        except Exception as e:
+            self.errors += 1
+            self.last_error = str(e)
+            raise
+        finally:
+            lock.release()
+
+    def _run(self, dry_run: bool) -> dict:
+        started = time.time()
+        report = {
+            'dry_run': dry_run,
+            'started_at': datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+            'limits': {
+                'budget_bytes': self.budget_bytes,
+                'ttl_days': self.ttl_days,
+                'user_quota_bytes': self.user_quota_bytes,
+                'orphan_grace_seconds': self.orphan_grace_seconds,
+                'shard_flat': self.shard_flat,
+            },
+        }
+        for category in _CATEGORIES + ('sharded',):
+            report[category] = {'count': 0, 'bytes': 0, 'samples': []}
+
+        images, stale_parts = self._scan(started)
+        # Read the queue before the table, so a row that leaves one is found in the other
+        queued = {_image_key(path) for path in self.pending_paths()} if self.pending_paths else set()
+        self._attach_rows(images)
+        for key in queued & images.keys():
+            images[key].queued = True
+        report['queued'] = len(queued & images.keys())
+        report['files'] = sum(len(image.files) for image in images.values())
+        report['images'] = len(images)
+        report['bytes_before'] = sum(image.size for image in images.values())
+        total = report['bytes_before']
+
+        for path, size in stale_parts:
+            self._count(report, 'stale_parts', path, size)
+            if not dry_run:
+                upload_store.remove_file(path)
+
+        def evict(key: str, category: str) -> None:
+            nonlocal total
+            image = images.pop(key)
+            total -= image.size
+            self._count(report, category, image.label, image.size)
+            if not dry_run:
+                for root, rel in image.files:
+                    upload_store.remove_file(os.path.join(root, rel))
+
+        fresh_cutoff = started - FRESH_SECONDS
+        if self.orphan_grace_seconds > 0:
+            grace_cutoff = started - max(self.orphan_grace_seconds, FRESH_SECONDS)
+            for key in [k for k, image in images.items()
+                        if not image.users and not image.queued and image.mtime < grace_cutoff]:
+                evict(key, 'orphans')
+
+        if self.ttl_days > 0:
+            ttl_cutoff = started - self.ttl_days * 86400
+            for key in [k for k, image in images.items()
+                        if image.users and not image.queued and image.age_time < ttl_cutoff]:
+                evict(key, 'expired')
+
+        if self.user_quota_bytes > 0:
+            for key in self._over_quota(images):
+                if not images[key].queued:
+                    evict(key, 'over_quota')
+
+        if self.budget_bytes > 0 and total > self.budget_bytes:
+            target = self.budget_bytes * BUDGET_LOW_WATERMARK
+            for key in sorted(images, key=lambda k: images[k].age_time):
+                if total <= target:
+                    break
+                if images[key].mtime >= fresh_cutoff or images[key].queued:
+                    continue  # its row may still be queued
+                evict(key, 'over_budget')
+
+        if self.shard_flat:
+            for image in images.values():
+                if image.flat and not image.queued and image.mtime < fresh_cutoff:
+                    self._count(report, 'sharded', image.label, image.size)
+                    if not dry_run:
+                        self._shard(image)
+
+        report['bytes_after'] = total
+        report['over_budget_after'] = bool(self.budget_bytes) and total > self.budget_bytes
+        report['finished_at'] = datetime.now().isoformat(timespec='seconds')
+        report['duration_seconds'] = round(time.time() - started, 3)
+        return report
+
+    @staticmethod
+    def _count(report: dict, category: str, path: str, size: int) -> None:
+        entry = report[category]
+        entry['count'] += 1
+        entry['bytes'] += size
+        if len(entry['samples']) < REPORT_SAMPLES:
+            entry['samples'].append(path)
+
+    def _scan(self, now: float):
+        images: Dict[str, _Image] = {}
+        stale_parts = []
+        part_cutoff = now - FRESH_SECONDS
+        roots = [self.upload_folder] + ([self.originals_folder] if self.originals_folder else [])
+        for root in roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue  # removed while scanning
+                    if name.startswith(upload_store.PART_PREFIX):
+                        if stat.st_mtime < part_cutoff:
+                            stale_parts.append((path, stat.st_size))
+                        continue
+                    if name.startswith('.'):
+                        continue
+                    image = images.get(_image_key(name))
+                    if image is None:
+                        image = images[_image_key(name)] = _Image()
+                    image.files.append((root, os.path.relpath(path, root)))
+                    image.size += stat.st_size
+                    image.mtime = max(image.mtime, stat.st_mtime)
+                    if dirpath == root:
+                        image.flat = True
+        return images, stale_parts
+
+    def _attach_rows(self, images: Dict[str, _Image]) -> None:
+        from sqlalchemy import select  # local import
+        rows = _nail_images_table()
+        last_id = 0
+        with self.engine_fn().connect() as conn:
+            while True:
+                batch = conn.execute(
+                    select(rows.c.id, rows.c.user_id, rows.c.image_path, rows.c.uploaded_at)
+                    .where(rows.c.id > last_id).order_by(rows.c.id).limit(ROW_BATCH)
+                ).fetchall()
+                if not batch:
+                    return
+                last_id = batch[-1][0]
+                for _id, user_id, image_path, uploaded_at in batch:
+                    image = images.get(_image_key(image_path or ''))
+                    if image is None:
+                        continue
+                    image.users.add(user_id)
+                    uploaded = _timestamp(uploaded_at)
+                    if uploaded is not None and (image.uploaded is None or uploaded > image.uploaded):
+                        image.uploaded = uploaded
+
+    def _over_quota(self, images: Dict[str, _Image]) -> List[str]:
+        per_user: Dict[object, List[str]] = {}
+        for key, image in images.items():
+            for user_id in image.users:
+                per_user.setdefault(user_id, []).append(key)
+        over: Dict[str, int] = {}
+        for keys in per_user.values():
+            used = 0
+            for key in sorted(keys, key=lambda k: images[k].age_time, reverse=True):
+                used += images[key].size
+                if used > self.user_quota_bytes:
+                    over[key] = over.get(key, 0) + 1
+        # Shared images go only when every user referring to them is over quota
+        return [key for key, users_over in over.items() if users_over == len(images[key].users)]
+
+    def _shard(self, image: _Image) -> None:
+        """Move a flat image into its shard directory, then repoint its rows."""
+        from sqlalchemy import update  # local import
+        rows = _nail_images_table()
+        moves = []
+        for index, (root, rel) in enumerate(image.files):
+            if os.path.dirname(rel):
+                continue
+            new_rel = upload_store.shard_name(rel)
+            old_path, new_path = os.path.join(root, rel), os.path.join(root, new_rel)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            # A hard link keeps the old path readable until the rows point at the new one
+            try:
+                os.link(old_path, new_path)
+            except FileExistsError:
+                pass
+            except OSError:
+                os.replace(old_path, new_path)
+            moves.append((root, rel, new_rel))
+            image.files[index] = (root, new_rel)
+        served = [(rel, new_rel) for root, rel, new_rel in moves if root == self.upload_folder]
+        if image.users and served:
+            with self.engine_fn().begin() as conn:
+                for rel, new_rel in served:
+                    conn.execute(update(rows).where(rows.c.image_path == self.url_prefix + rel)
+                                 .values(image_path=self.url_prefix + new_rel))
+        for root, rel, _new_rel in moves:
+            upload_store.remove_file(os.path.join(root, rel))
+        image.flat = False
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Apply retention, quotas and sharding to the upload folder')
+    parser.add_argument('--database-uri', default=os.environ.get(
+        'UPLOAD_MAINTENANCE_DATABASE_URI', 'mysql+pymysql://root:@localhost/glossify'))
+    parser.add_argument('--upload-folder', default='static/uploads')
+    parser.add_argument('--originals-folder', default=None)
+    parser.add_argument('--state-dir', default=os.path.join('data', 'upload_maintenance'))
+    parser.add_argument('--budget-mb', type=float, default=0)
+    parser.add_argument('--ttl-days', type=float, default=0)
+    parser.add_argument('--user-quota-mb', type=float, default=0)
+    parser.add_argument('--orphan-grace-seconds', type=float, default=0,
+                        help='Delete files no row refers to once they are this old (0 keeps them)')
+    parser.add_argument('--shard-flat', action='store_true', help='Move flat files into shard directories')
+    parser.add_argument('--write-behind-spill-dir', default=None,
+                        help='Spill directory of the write-behind queue; files its rows refer to are kept')
+    parser.add_argument('--dry-run', action='store_true', help='Report what would happen without changing anything')
+    args = parser.parse_args()
+
+    from sqlalchemy import create_engine
+
+    engine = create_engine(args.database_uri)
+    pending = None
+    if args.write_behind_spill_dir:
+        from write_behind import spilled_values
+
+        def pending():
+            return spilled_values(args.write_behind_spill_dir, 'nailshapeimages', 'image_path')
+    maintenance = UploadMaintenance(
+        lambda: engine, args.upload_folder, originals_folder=args.originals_folder,
+        budget_bytes=int(args.budget_mb * 1024 * 1024), ttl_days=args.ttl_days,
+        user_quota_bytes=int(args.user_quota_mb * 1024 * 1024),
+        orphan_grace_seconds=args.orphan_grace_seconds, shard_flat=args.shard_flat, state_dir=args.state_dir, interval_seconds=0,
+        pending_paths=pending,
+    )
+    result = maintenance.run(dry_run=args.dry_run)
+    if result is None:
+        print('Another maintenance pass is running')
+        raise SystemExit(2)
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,465 @@
+"""Streaming ingestion of uploaded images into the content-addressed upload folder.
+
+Werkzeug hands every multipart file part to a stream factory. ``UploadSink``
+is that stream: each chunk is checked, hashed and written straight into the
+upload folder as it arrives, so a request never holds the whole image in
+memory. The image type comes from the magic bytes and the dimensions from
+the header, both parsed incrementally; non-images and oversized content are
+rejected within the first few KB. ``commit()`` renames the part file to
+``ab/cd/<sha256><ext>`` in the same folder (a rename, not a copy; see
+``shard_name``), or drops it when identical content is already stored.
+``store()`` instead keeps a bounded-resolution working copy and a
+thumbnail of the upload and only optionally the original.
+"""
+import hashlib
+import os
+import re
+import shutil
+import struct
+import time
+import uuid
+from typing import Optional, Tuple
+
+import numpy as np
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_EXTENSION = '.jpg'
+PART_PREFIX = '.incoming-'
+
+# Sniffed image kind -> stored file extension
+IMAGE_EXTENSIONS = {
+    'jpeg': '.jpg',
+    'png': '.png',
+    'gif': '.gif',
+    'webp': '.webp',
+    'bmp': '.bmp',
+}
+# Encoded working copies written at ingestion (see store())
+WORKING_FORMATS = {
+    'webp': '.webp',
+    'jpeg': '.jpg',
+}
+THUMB_SUFFIX = '_thumb'
+HASH_NAME_RE = re.compile(r'^[0-9a-f]{64}')
+# The type must be known after this many bytes and the dimensions after HEADER_LIMIT
+MAGIC_LIMIT = 32
+HEADER_LIMIT = 256 * 1024
+
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_JPEG_STANDALONE = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+
+class UploadRejected(Exception):
+    """An upload refused while it streamed in; ``status`` is the HTTP code to answer with."""
+
+    def __init__(self, message: str, status: int = 400) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def content_filename(content_hash: str, extension: str = DEFAULT_EXTENSION) -> str:
+    """Content-addressed file name: the hash plus the extension of the sniffed type."""
+    return f"{content_hash}{extension}"
+
+
+def shard_name(filename: str) -> str:
+    """'ab/cd/<name>': two directory levels from the content hash the name starts with
+    (or from a hash of the name itself), so no directory grows past a few hundred files."""
+    base = os.path.basename(filename)
+    key = base if HASH_NAME_RE.match(base) else hashlib.sha256(base.encode('utf-8')).hexdigest()
+    return f"{key[:2]}/{key[2:4]}/{base}"
+
+
+def too_large(max_bytes: int) -> UploadRejected:
+    if max_bytes >= 1024 * 1024:
+        limit = f"{max_bytes / (1024 * 1024):g} MB"
+    else:
+        limit = f"{max_bytes // 1024} KB"
+    return UploadRejected(f'File too large (limit {limit})', 413)
+
+
+def exists(upload_folder: str, filename: str) -> bool:
+    return os.path.exists(os.path.join(upload_folder, filename))
+
+
+class ImageHeader:
+    """Incremental parser of an image header: ``kind`` from the magic bytes, then its size.
+
+    ``feed()`` takes chunks of any size and keeps only the few bytes a
+    parse step still needs; JPEG segments before the frame header are
+    skipped without being buffered. Raises ``UploadRejected`` as soon as the
+    data cannot be a supported image.
+    """
+
+    def __init__(self) -> None:
+        self.kind: Optional[str] = None
+        self.width: Optional[int] = None
+        self.height: Optional[int] = None
+        self.seen = 0
+        self._buf = bytearray()
+        self._skip = 0
+
+    @property
+    def done(self) -> bool:
+        return self.width is not None
+
+    def feed(self, chunk: bytes) -> None:
+        self.seen += len(chunk)
+        if self.done:
+            return
+        self._buf.extend(chunk)
+        if self.kind is None:
+            self.kind = self._sniff()
+            if self.kind is None:
+                if len(self._buf) >= MAGIC_LIMIT:
+                    raise UploadRejected('Unsupported file type: upload a JPEG, PNG, GIF, WebP or BMP image', 415)
+                return
+            if self.kind == 'jpeg':
+                del self._buf[:2]  # SOI
+        if self.kind == 'jpeg':
+            self._feed_jpeg()
+        else:
+            self._parse_fixed()
+        if self.done:
+            self._buf = bytearray()
+            if self.width <= 0 or self.height <= 0:
+                raise UploadRejected('Corrupt image header: zero width or height')
+        elif self.seen >= HEADER_LIMIT:
+            raise UploadRejected('Corrupt image header: no dimensions found')
+
+    def _sniff(self) -> Optional[str]:
+        head = bytes(self._buf[:16])
+        if head.startswith(b'\xff\xd8\xff'):
+            return 'jpeg'
+        if head.startswith(b'\x89PNG\r\n\x1a\n'):
+            return 'png'
+        if head.startswith((b'GIF87a', b'GIF89a')):
+            return 'gif'
+        if head.startswith(b'BM'):
+            return 'bmp'
+        if len(head) >= 12 and head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+            return 'webp'
+        # A prefix of a signature, or RIFF still waiting for its WEBP tag at bytes 8-12
+        signatures = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'BM', b'RIFF')
+        if len(head) < 12 and (head.startswith(b'RIFF') or any(sig.startswith(head) for sig in signatures)):
+            return None  # could still become an image; wait for more bytes
+        raise UploadRejected('Unsupported file type: upload a JPEG, PNG, GIF, WebP or BMP image', 415)
+
+    def _parse_fixed(self) -> None:
+        buf = self._buf
+        if self.kind == 'png':
+            if len(buf) >= 24:
+                if buf[12:16] != b'IHDR':
+                    raise UploadRejected('Corrupt PNG header')
+                self.width, self.height = struct.unpack('>II', buf[16:24])
+        elif self.kind == 'gif':
+            if len(buf) >= 10:
+                self.width, self.height = struct.unpack('<HH', buf[6:10])
+        elif self.kind == 'bmp':
+            if len(buf) >= 26:
+                width, height = struct.unpack('<ii', buf[18:26])
+                self.width, self.height = abs(width), abs(height)
+        elif self.kind == 'webp' and len(buf) >= 30:
+            chunk = bytes(buf[12:16])
+            if chunk == b'VP8X':
+                self.width = 1 + int.from_bytes(buf[24:27], 'little')
+                self.height = 1 + int.from_bytes(buf[27:30], 'little')
+            elif chunk == b'VP8 ':
+                if buf[23:26] != b'\x9d\x01\x2a':
+                    raise UploadRejected('Corrupt WebP header')
+                width, height = struct.unpack('<HH', buf[26:30])
+                self.width, self.height = width & 0x3FFF, height & 0x3FFF
+            elif chunk == b'VP8L':
+                if buf[20] != 0x2F:
+                    raise UploadRejected('Corrupt WebP header')
+                bits = int.from_bytes(buf[21:25], 'little')
+                self.width = 1 + (bits & 0x3FFF)
+                self.height = 1 + ((bits >> 14) & 0x3FFF)
+            else:
+                raise UploadRejected('Corrupt WebP header')
+
+    def _feed_jpeg(self) -> None:
+        buf = self._buf
+        while True:
+            if self._skip:
+                n = min(self._skip, len(buf))
+                del buf[:n]
+                self._skip -= n
+                if self._skip:
+                    return
+            if len(buf) < 2:
+                return
+            if buf[0] != 0xFF:
+                raise UploadRejected('Corrupt JPEG header')
+            marker = buf[1]
+            if marker == 0xFF:
+                del buf[:1]  # fill byte
+                continue
+            if marker in _JPEG_STANDALONE:
+                del buf[:2]
+                continue
+            if marker == 0xDA or marker == 0xD9:
+                raise UploadRejected('Corrupt JPEG header: no frame header before the image data')
+            if len(buf) < 4:
+                return
+            length = (buf[2] << 8) | buf[3]
+            if length < 2:
+                raise UploadRejected('Corrupt JPEG header')
+            if marker in _JPEG_SOF:
+                if len(buf) < 9:
+                    return
+                self.height, self.width = struct.unpack('>HH', buf[5:9])
+                return
+            del buf[:2]
+            self._skip = length
+
+
+class UploadSink:
+    """Writable stream for one uploaded file part (see the module docstring).
+
+    ``max_bytes`` caps the stored size and ``max_pixels`` the width times
+    height declared in the header; both are checked while the data arrives.
+    A rejected or abandoned sink removes its part file.
+    """
+
+    def __init__(self, upload_folder: str, max_bytes: int, max_pixels: int = 0,
+                 content_length: Optional[int] = None) -> None:
+        if content_length and content_length > max_bytes:
+            raise too_large(max_bytes)
+        self.upload_folder = upload_folder
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.header = ImageHeader()
+        self.size = 0
+        self.content_hash: Optional[str] = None
+        self.filename: Optional[str] = None
+        self.path: Optional[str] = None
+        self._digest = hashlib.sha256()
+        self._part_path = os.path.join(upload_folder, f"{PART_PREFIX}{uuid.uuid4().hex}.part")
+        self._file = open(self._part_path, 'wb')
+
+    def write(self, chunk: bytes) -> int:
+        if self._file is None:
+            raise ValueError('write to a closed upload')
+        try:
+            self.size += len(chunk)
+            if self.size > self.max_bytes:
+                raise too_large(self.max_bytes)
+            if not self.header.done:
+                self.header.feed(chunk)
+                if self.header.done and self.max_pixels and \
+                        self.header.width * self.header.height > self.max_pixels:
+                    raise UploadRejected(
+                        f'Image too large ({self.header.width}x{self.header.height} pixels)', 413)
+            self._digest.update(chunk)
+            self._file.write(chunk)
+        except BaseException:
+            self.discard()
+            raise
+        return len(chunk)
+
+    # Werkzeug rewinds the container once the part is complete
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return 0 if self._file is None else self._file.tell()
+
+    def tell(self) -> int:
+        return self.size
+
+    def close(self) -> None:
+        if self._file is not None and self.path is None:
+            self.discard()
+
+    @property
+    def committed(self) -> bool:
+        return self.path is not None
+
+    @property
+    def part_path(self) -> str:
+        return self._part_path
+
+    def finish(self) -> str:
+        """Close the part file once the whole upload is in; returns its SHA-256 hex digest."""
+        if self.content_hash is not None:
+            return self.content_hash
+        if self._file is None:
+            raise UploadRejected('Upload was not received completely')
+        if self.size == 0:
+            self.discard()
+            raise UploadRejected('Empty file')
+        if not self.header.done:
+            self.discard()
+            raise UploadRejected('Not a complete image: the header is truncated')
+        self._file.close()
+        self._file = None
+        self.content_hash = self._digest.hexdigest()
+        return self.content_hash
+
+    def commit(self, folder: Optional[str] = None) -> Tuple[str, str]:
+        """Move the finished part to its content-addressed, sharded name in ``folder``
+        (default: the upload folder); returns (filename relative to it, sha256)."""
+        if self.path is not None:
+            return self.filename, self.content_hash
+        self.finish()
+        folder = folder or self.upload_folder
+        self.filename = shard_name(content_filename(self.content_hash, IMAGE_EXTENSIONS[self.header.kind]))
+        path = os.path.join(folder, self.filename)
+        if os.path.exists(path):
+            # Identical content is already stored under this name
+            remove_file(self._part_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(self._part_path, path)  # a rename unless folder is on another disk
+        self.path = path
+        return self.filename, self.content_hash
+
+    def discard(self) -> None:
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+        if self.path is None:
+            remove_file(self._part_path)
+
+
+def thumbnail_name(filename: str) -> str:
+    root, ext = os.path.splitext(filename)
+    return f"{root}{THUMB_SUFFIX}{ext}"
+
+
+def store(sink: UploadSink, working_format: str = 'webp', max_side: int = 1024, thumb_side: int = 256,
+          quality: int = 82, originals_folder: Optional[str] = None) -> Tuple[str, str]:
+    """Finish an upload as a bounded working copy plus a thumbnail; returns (filename, sha256).
+
+    The working copy is at most ``max_side`` pixels on its longer side and is
+    what gets served and classified; ``<name>_thumb`` is at most
+    ``thumb_side``. The original is moved to ``originals_folder`` when one is
+    given and deleted otherwise. ``max_side=0``, or no image library in the
+    process, stores the original itself as before.
+    """
+    content_hash = sink.finish()
+    if max_side <= 0:
+        return sink.commit()
+    filename = shard_name(content_filename(content_hash, WORKING_FORMATS[working_format]))
+    working_path = os.path.join(sink.upload_folder, filename)
+    if not os.path.exists(working_path):
+        img = _decode_bounded(sink.part_path, max_side, max(sink.header.width, sink.header.height))
+        if img is None:
+            return sink.commit()
+        os.makedirs(os.path.dirname(working_path), exist_ok=True)
+        write_atomic(working_path, _encode(_fit(img, max_side), working_format, quality))
+        write_atomic(os.path.join(sink.upload_folder, thumbnail_name(filename)),
+                      _encode(_fit(img, thumb_side), working_format, quality))
+    if originals_folder:
+        sink.commit(originals_folder)
+    else:
+        sink.discard()
+    return filename, content_hash
+
+
+def _cv2():
+    try:
+        import cv2  # type: ignore  # local import: only ingestion needs it
+        return cv2
+    except ImportError:
+        return None
+
+
+def _decode_bounded(path: str, max_side: int, declared_side: int) -> Optional[np.ndarray]:
+    """Decode an image as BGR, letting the JPEG decoder downscale by up to 8x while the
+    result still covers ``max_side``. None when no image library is installed."""
+    cv2 = _cv2()
+    if cv2 is not None:
+        factor = 1
+        while factor < 8 and declared_side // (factor * 2) >= max_side:
+            factor *= 2
+        flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+        img = cv2.imread(path, flags[factor])
+        if img is not None:
+            return img
+    try:
+        from PIL import Image, ImageOps  # type: ignore
+    except ImportError:
+        if cv2 is None:
+            return None
+        raise UploadRejected('Could not decode the image')
+    try:
+        with Image.open(path) as im:
+            im.draft('RGB', (max_side, max_side))  # JPEG DCT scaling, like IMREAD_REDUCED_*
+            rgb = np.asarray(ImageOps.exif_transpose(im).convert('RGB'), dtype=np.uint8)
+    except Exception:
+        raise UploadRejected('Could not decode the image')
+    return np.ascontiguousarray(rgb[:, :, ::-1])
+
+
+def _fit(img: np.ndarray, side: int) -> np.ndarray:
+    height, width = img.shape[:2]
+    scale = side / float(max(height, width))
+    if scale >= 1:
+        return img
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    cv2 = _cv2()
+    if cv2 is not None:
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    from PIL import Image  # type: ignore
+    return np.asarray(Image.fromarray(img).resize(size, Image.BOX))
+
+
+def _encode(img: np.ndarray, working_format: str, quality: int) -> bytes:
+    cv2 = _cv2()
+    if cv2 is not None:
+        if working_format == 'webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+        ok, buf = cv2.imencode(WORKING_FORMATS[working_format], img, params)
+        if not ok:
+            raise UploadRejected('Could not encode the working copy', 500)
+        return buf.tobytes()
+    import io  # local import
+    from PIL import Image  # type: ignore
+    out = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(img[:, :, ::-1])).save(
+        out, format=working_format.upper(), quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Write through a part file in the same directory and rename it into place."""
+    tmp_path = os.path.join(os.path.dirname(path), f"{PART_PREFIX}{uuid.uuid4().hex}.part")
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        remove_file(tmp_path)
+        raise
+
+
+def remove_stale_parts(upload_folder: str, max_age_seconds: float = 3600) -> int:
+    """Delete part files left behind by interrupted uploads; returns how many were removed."""
+    removed = 0
+    cutoff = time.time() - max_age_seconds
+    try:
+        entries = list(os.scandir(upload_folder))
+    except OSError:
+        return 0
+    for entry in entries:
+        if entry.name.startswith(PART_PREFIX) and entry.name.endswith('.part'):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def remove_file(path: str) -> None:
+    """Delete a file if it is there."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
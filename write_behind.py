@@ -0,0 +1,398 @@
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import date, datetime
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from file_lock import FileLock
+
+# One unit is a list of (table name, row) pairs that must be written together
+Unit = List[Tuple[str, dict]]
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    raise TypeError(f"Cannot spill value of type {type(value).__name__}")
+
+
+def _decode(obj: dict):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__date__' in obj:
+        return date.fromisoformat(obj['__date__'])
+    return obj
+
+
+def spilled_values(spill_dir: str, table: str, column: str) -> set:
+    """Values of ``column`` in ``table`` rows sitting in the spill files of ``spill_dir``.
+
+    Includes files being written or replayed. A file renamed while it is
+    read (claimed for replay, or put back) is picked up by a second scan.
+    """
+    values = set()
+    for _attempt in range(3):
+        vanished = False
+        for path in glob.glob(os.path.join(spill_dir, 'spill-*.jsonl*')):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            unit = json.loads(line)
+                        except ValueError:
+                            continue  # a line still being written
+                        values.update(row.get(column) for name, row in unit if name == table)
+            except FileNotFoundError:
+                vanished = True
+        if not vanished:
+            break
+    values.discard(None)
+    return values
+
+
+class WriteBehindQueue:
+    """Buffers insert-only rows and writes them in bulk from a background thread.
+
+    ``submit`` returns immediately. The flusher wakes every ``flush_ms`` (or
+    as soon as ``batch_rows`` rows are waiting), groups the pending rows by
+    table and writes them with one executemany INSERT per table inside a
+    single transaction, which the MySQL driver sends as multi-row INSERTs.
+
+    When the database is unreachable, or the in-memory queue already holds
+    ``max_rows`` rows, units are appended to JSON-lines files in
+    ``spill_dir`` and replayed once writes succeed again, so rows survive a
+    restart. Replay is at-least-once: a crash mid-replay can repeat rows.
+    Units the database rejects outright (constraint or data errors) are
+    dropped and counted.
+
+    A file being replayed is renamed to ``.claimed-<token>``, where the token
+    names a lock file this queue holds for its lifetime. Claims whose lock
+    is free belong to a queue that is gone and are put back for replay.
+    """
+
+    def __init__(self, engine_fn: Callable, tables: Dict[str, object], flush_ms: float = 200.0,
+                 batch_rows: int = 500, max_rows: int = 10000, spill_dir: Optional[str] = None,
+                 spill_max_bytes: int = 256 * 1024 * 1024,
+                 on_flushed: Optional[Callable[[Unit], None]] = None,
+                 on_rejected: Optional[Callable[[Unit], None]] = None,
+                 name: str = 'write-behind') -> None:
+        self.engine_fn = engine_fn
+        self.tables = tables
+        self.flush_interval = max(0.001, float(flush_ms) / 1000.0)
+        self.batch_rows = max(1, int(batch_rows))
+        self.max_rows = max(1, int(max_rows))
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = int(spill_max_bytes)
+        self.on_flushed = on_flushed
+        self.on_rejected = on_rejected
+        self._pending: Deque[Tuple[float, Unit]] = deque()
+        self._pending_rows = 0
+        # Units taken off the queue that are not written or spilled yet
+        self._inflight: List[Unit] = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._db_healthy = True
+        self._spill_seq = 0
+        self._counters = {
+            'submitted_rows': 0, 'written_rows': 0, 'batches': 0, 'spilled_rows': 0,
+            'replayed_rows': 0, 'dropped_rows': 0, 'errors': 0,
+        }
+        self._counter_lock = threading.Lock()
+        self._retry_at = 0.0
+        self._backoff = 0.0
+        self._last_flush_ms = 0.0
+        self._last_flush_at: Optional[float] = None
+        self._max_lag = 0.0
+        self._claim_token = uuid.uuid4().hex
+        self._claim_lock: Optional[FileLock] = None
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._claim_lock = FileLock(self._claim_lock_path(self._claim_token))
+            if not self._claim_lock.acquire():
+                raise RuntimeError(f"Could not lock {self._claim_lock.path}")
+            self._reclaim_orphans()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._counter_lock:
+            self._counters[key] += n
+
+    # -- producer side -------------------------------------------------
+
+    def submit(self, unit: Unit) -> None:
+        """Queue rows for insertion; they are written together or not at all."""
+        if not unit:
+            return
+        if self._closed:
+            raise RuntimeError('WriteBehindQueue is closed')
+        with self._cond:
+            self._count('submitted_rows', len(unit))
+            if self._pending_rows + len(unit) > self.max_rows:
+                overflow = True
+            else:
+                overflow = False
+                self._pending.append((time.monotonic(), unit))
+                self._pending_rows += len(unit)
+                if self._pending_rows >= self.batch_rows:
+                    self._cond.notify()
+        if overflow:
+            # Full queue: keep the rows on disk rather than blocking the request
+            self._spill([unit])
+
+    # -- flusher -------------------------------------------------------
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._closed and self._pending_rows < self.batch_rows:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def _take(self) -> List[Tuple[float, Unit]]:
+        with self._cond:
+            batch = []
+            rows = 0
+            while self._pending and rows < self.batch_rows:
+                enqueued_at, unit = self._pending.popleft()
+                batch.append((enqueued_at, unit))
+                rows += len(unit)
+            self._pending_rows -= rows
+            self._inflight = [unit for _enqueued, unit in batch]
+            return batch
+
+    def flush(self) -> None:
+        """Write everything queued so far (and replay spilled rows if the DB is back)."""
+        with self._flush_lock:
+            try:
+                while True:
+                    batch = self._take()
+                    if not batch:
+                        break
+                    lag = time.monotonic() - batch[0][0]
+                    self._max_lag = max(self._max_lag, lag)
+                    units = [unit for _enqueued, unit in batch]
+                    if time.monotonic() < self._retry_at:
+                        # Database was down moments ago: go straight to disk until the backoff ends
+                        self._spill(units)
+                        continue
+                    if not self._write_units(units):
+                        self._spill(units)
+                        # Leave the rest queued; the next tick retries after a pause
+                        return
+            finally:
+                with self._cond:
+                    self._inflight = []
+            if self._db_healthy and self.spill_dir:
+                self._replay_spill()
+
+    def _write_units(self, units: List[Unit]) -> bool:
+        """True when every unit was written or definitively rejected; False if the DB is unavailable."""
+        started = time.perf_counter()
+        try:
+            self._insert(units)
+        except Exception as e:
+            if self._is_transient(e):
+                self._db_healthy = False
+                self._backoff = min(30.0, max(self.flush_interval, self._backoff * 2))
+                self._retry_at = time.monotonic() + self._backoff
+                self._count('errors', 1)
+                print(f"Write-behind flush failed, spilling {sum(len(u) for u in units)} rows: {e}")
+                return False
+            # A bad row fails the whole batch; retry unit by unit to isolate it
+            if len(units) > 1:
+                for unit in units:
+                    if not self._write_units([unit]):
+                        self._spill([unit])
+                return True
+            self._count('dropped_rows', len(units[0]))
+            print(f"Write-behind dropped rows rejected by the database: {e}")
+            if self.on_rejected:
+                try:
+                    self.on_rejected(units[0])
+                except Exception as cb_err:
+                    print(f"Write-behind reject callback failed: {cb_err}")
+            return True
+        self._db_healthy = True
+        self._backoff = 0.0
+        rows = sum(len(unit) for unit in units)
+        self._count('written_rows', rows)
+        self._count('batches', 1)
+        self._last_flush_ms = (time.perf_counter() - started) * 1000.0
+        self._last_flush_at = time.time()
+        if self.on_flushed:
+            for unit in units:
+                try:
+                    self.on_flushed(unit)
+                except Exception as e:
+                    print(f"Write-behind flush callback failed: {e}")
+        return True
+
+    def _insert(self, units: List[Unit]) -> None:
+        by_table: Dict[str, List[dict]] = {}
+        for unit in units:
+            for table, row in unit:
+                by_table.setdefault(table, []).append(row)
+        with self.engine_fn().begin() as conn:
+            for table, rows in by_table.items():
+                conn.execute(self.tables[table].insert(), rows)
+
+    @staticmethod
+    def _is_transient(error: Exception) -> bool:
+        from sqlalchemy import exc  # local import
+        return isinstance(error, (exc.OperationalError, exc.InterfaceError, exc.TimeoutError)) \
+            or isinstance(error, (ConnectionError, TimeoutError))
+
+    # -- spill files ---------------------------------------------------
+
+    def _spill_bytes(self) -> int:
+        return sum(os.path.getsize(p) for p in glob.glob(os.path.join(self.spill_dir, 'spill-*')))
+
+    def _spill(self, units: List[Unit]) -> None:
+        rows = sum(len(unit) for unit in units)
+        if not self.spill_dir:
+            self._count('dropped_rows', rows)
+            return
+        try:
+            if self._spill_bytes() >= self.spill_max_bytes:
+                raise OSError('spill directory is full')
+            with self._cond:
+                self._spill_seq += 1
+                seq = self._spill_seq
+            path = os.path.join(self.spill_dir, f"spill-{int(time.time() * 1000):015d}-{os.getpid()}-{seq}.jsonl")
+            with open(path + '.part', 'w', encoding='utf-8') as f:
+                for unit in units:
+                    f.write(json.dumps([[table, row] for table, row in unit], default=_encode) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.part', path)
+            self._count('spilled_rows', rows)
+        except Exception as e:
+            self._count('dropped_rows', rows)
+            print(f"Write-behind could not spill {rows} rows, dropping them: {e}")
+
+    def _claim_lock_path(self, token: str) -> str:
+        return os.path.join(self.spill_dir, f"claim-{token}.lock")
+
+    def _reclaim_orphans(self) -> None:
+        """Release files claimed by queues that stopped mid-replay (their claim lock is free)."""
+        claimed = glob.glob(os.path.join(self.spill_dir, 'spill-*.jsonl.claimed-*'))
+        stale_tokens = set()
+        for path in glob.glob(os.path.join(self.spill_dir, 'claim-*.lock')):
+            token = os.path.basename(path)[len('claim-'):-len('.lock')]
+            if token == self._claim_token:
+                continue
+            probe = FileLock(path)
+            if probe.acquire():
+                probe.release()
+                stale_tokens.add(token)
+        for path in claimed:
+            original, token = path.split('.claimed-', 1)
+            # A claim without a lock file predates claim tokens or lost its lock file
+            if token in stale_tokens or (token != self._claim_token
+                                         and not os.path.exists(self._claim_lock_path(token))):
+                try:
+                    os.replace(path, original)
+                except OSError:
+                    pass
+        for token in stale_tokens:
+            try:
+                os.remove(self._claim_lock_path(token))
+            except OSError:
+                pass
+
+    def _replay_spill(self) -> None:
+        self._reclaim_orphans()
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, 'spill-*.jsonl'))):
+            claimed = f"{path}.claimed-{self._claim_token}"
+            try:
+                os.replace(path, claimed)  # only one process gets to replay a file
+            except OSError:
+                continue
+            try:
+                with open(claimed, 'r', encoding='utf-8') as f:
+                    units = [
+                        [(table, row) for table, row in json.loads(line, object_hook=_decode)]
+                        for line in f if line.strip()
+                    ]
+            except (OSError, ValueError) as e:
+                print(f"Write-behind skipping unreadable spill file {claimed}: {e}")
+                continue
+            for start in range(0, len(units), self.batch_rows):
+                chunk = units[start:start + self.batch_rows]
+                if not self._write_units(chunk):
+                    # DB went away again: put the unwritten remainder back on disk
+                    remaining = units[start:]
+                    self._count('spilled_rows', -sum(len(u) for u in remaining))
+                    self._spill(remaining)
+                    os.remove(claimed)
+                    return
+                self._count('replayed_rows', sum(len(u) for u in chunk))
+            os.remove(claimed)
+
+    # -- lifecycle -----------------------------------------------------
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Stop accepting rows and flush what is queued (spilling it if the DB is down)."""
+        if self._closed:
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=timeout)
+        # Anything the flusher could not write in time goes to disk
+        leftover = self._take()
+        while leftover:
+            self._spill([unit for _enqueued, unit in leftover])
+            leftover = self._take()
+        with self._cond:
+            self._inflight = []
+        if self._claim_lock is not None:
+            # Claims still on disk are released by the next queue that starts
+            try:
+                os.remove(self._claim_lock.path)
+            except OSError:
+                pass
+            self._claim_lock.release()
+
+    def pending_paths(self, table: str, column: str) -> set:
+        """Values of ``column`` in ``table`` rows not in the database yet: queued, being written or spilled.
+
+        Used by upload maintenance so files whose row is still on its way
+        are not taken for orphans, however long the row stays spilled.
+        """
+        with self._cond:
+            units = [unit for _enqueued, unit in self._pending] + self._inflight
+        values = {row.get(column) for unit in units for name, row in unit if name == table}
+        values.discard(None)
+        if self.spill_dir:
+            values |= spilled_values(self.spill_dir, table, column)
+        return values
+
+    def stats(self) -> dict:
+        with self._cond:
+            oldest = self._pending[0][0] if self._pending else None
+            pending_rows = self._pending_rows
+        spill_files = glob.glob(os.path.join(self.spill_dir, 'spill-*.jsonl')) if self.spill_dir else []
+        with self._counter_lock:
+            counters = dict(self._counters)
+        return dict(
+            counters,
+            pending_rows=pending_rows,
+            lag_seconds=round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+            max_lag_seconds=round(self._max_lag, 3),
+            last_flush_ms=round(self._last_flush_ms, 3),
+            last_flush_at=self._last_flush_at,
+            spill_files=len(spill_files),
+            db_healthy=self._db_healthy,
+        )